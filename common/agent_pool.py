@@ -0,0 +1,235 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import select
+import subprocess
+import threading
+import time
+
+from django.conf import settings
+
+log = logging.getLogger("log")
+
+AGENT_WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "agent_worker.py")
+
+
+class AgentError(Exception):
+    """Raised when an agent job fails or its worker dies."""
+
+
+class AgentTimeout(AgentError):
+    """Raised when an agent job does not answer within the job timeout."""
+
+
+class AgentWorker:
+    """
+    One warm agent process, spoken to over its stdin/stdout pipes.
+
+    See `common/agent_worker.py` for the protocol.
+    """
+
+    def __init__(self, python, script_path, cwd):
+        """
+        Starts the worker process.
+
+        Args:
+            python (str): Interpreter used to run the agent.
+            script_path (str): Path of the agent script.
+            cwd (str): Working directory of the agent.
+        """
+        self.jobs = 0
+        self.process = subprocess.Popen(
+            [python, AGENT_WORKER_PATH, script_path],
+            cwd=cwd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+        )
+        log.info(f"Started agent worker {self.process.pid}")
+
+    def is_alive(self):
+        """
+        Returns:
+            bool: True while the worker process is running.
+        """
+        return self.process.poll() is None
+
+    def run(self, message_id, timeout):
+        """
+        Sends one job to the worker and waits for its answer.
+
+        Args:
+            message_id (str): The message ID handed to the agent.
+            timeout (float): Seconds to wait for the answer.
+
+        Returns:
+            dict: The return code and the captured stdout and stderr of the job.
+
+        Raises:
+            AgentTimeout: If the worker does not answer in time.
+            AgentError: If the worker died while running the job.
+        """
+        self.jobs += 1
+        try:
+            self.process.stdin.write(json.dumps({"message_id": message_id}) + "\n")
+            self.process.stdin.flush()
+        except OSError as e:
+            raise AgentError(f"Agent worker {self.process.pid} is gone: {e}")
+
+        ready, _, _ = select.select([self.process.stdout], [], [], timeout)
+        if not ready:
+            raise AgentTimeout(
+                f"Agent job for {message_id} did not finish within {timeout} seconds"
+            )
+
+        line = self.process.stdout.readline()
+        if not line:
+            raise AgentError(
+                f"Agent worker {self.process.pid} died with code {self.process.poll()}"
+            )
+        return json.loads(line)
+
+    def stop(self):
+        """
+        Closes the job pipe and waits for the worker to exit, killing it if needed.
+        """
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except Exception:
+            self.process.kill()
+            self.process.wait()
+        log.info(f"Stopped agent worker {self.process.pid}")
+
+
+class AgentPool:
+    """
+    Pool of warm agent processes used by `process_rma_email`.
+
+    Workers are started on demand up to `size`, reused between jobs, replaced
+    after `max_jobs` jobs and killed when a job runs over `timeout`.
+    """
+
+    def __init__(self, size=None, timeout=None, max_jobs=None):
+        """
+        Initializes the AgentPool instance, defaults come from the `AGENT_*` settings.
+
+        Args:
+            size (int): Maximum number of worker processes.
+            timeout (float): Seconds a single job may take.
+            max_jobs (int): Jobs a worker runs before it is recycled.
+        """
+        self.size = size or settings.AGENT_POOL_SIZE
+        self.timeout = timeout or settings.AGENT_JOB_TIMEOUT
+        self.max_jobs = max_jobs or settings.AGENT_MAX_JOBS_PER_WORKER
+        self._idle = queue.LifoQueue()
+        self._started = 0
+        self._lock = threading.Lock()
+
+    def _checkout(self):
+        """
+        Takes an idle worker, starts a new one if the pool is not full, or waits.
+
+        Returns:
+            AgentWorker: A running worker reserved for the caller.
+        """
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    if self._started < self.size:
+                        self._started += 1
+                        break
+                worker = self._idle.get()
+
+            if worker.is_alive():
+                return worker
+            self._discard(worker)
+
+        try:
+            return AgentWorker(
+                settings.AGENT_PYTHON, settings.AGENT_SCRIPT_PATH, settings.AGENT_WORKDIR
+            )
+        except Exception:
+            with self._lock:
+                self._started -= 1
+            raise
+
+    def _discard(self, worker):
+        """
+        Stops a worker and frees its slot in the pool.
+
+        Args:
+            worker (AgentWorker): The worker to get rid of.
+        """
+        worker.stop()
+        with self._lock:
+            self._started -= 1
+
+    def run(self, message_id):
+        """
+        Runs the agent for one message on a warm worker.
+
+        Args:
+            message_id (str): The message ID handed to the agent.
+
+        Returns:
+            dict: The return code and the captured stdout and stderr of the job.
+
+        Raises:
+            AgentTimeout: If the job runs over the pool timeout.
+            AgentError: If the worker died while running the job.
+        """
+        worker = self._checkout()
+        started = time.perf_counter()
+        try:
+            result = worker.run(message_id, self.timeout)
+        except Exception:
+            self._discard(worker)
+            raise
+
+        log.info(
+            f"Agent job for {message_id} finished with code {result['returncode']} "
+            f"in {time.perf_counter() - started:.1f} s"
+        )
+        if worker.jobs >= self.max_jobs or not worker.is_alive():
+            self._discard(worker)
+        else:
+            self._idle.put(worker)
+        return result
+
+    def close(self):
+        """
+        Stops all idle workers.
+        """
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+# One pool per process, Celery's forked children must not share pipes.
+_pools = {}
+
+
+def get_agent_pool():
+    """
+    Returns the agent pool of the current process, creating it on first use.
+
+    Returns:
+        AgentPool: The pool of this process.
+    """
+    global _pools
+
+    pid = os.getpid()
+    pool = _pools.get(pid)
+    if pool is None:
+        pool = AgentPool()
+        _pools = {pid: pool}
+        atexit.register(pool.close)
+    return pool
@@ -0,0 +1,119 @@
+"""
+Long-lived worker process for the email-drafting agent.
+
+Started by `common.agent_pool.AgentPool`, never imported by Django. The agent
+script is loaded once, so its imports and client setup are paid once per
+worker instead of once per email. Jobs arrive as JSON lines on stdin:
+
+    {"message_id": "<id>"}
+
+and each one is answered with one JSON line on the original stdout:
+
+    {"returncode": 0, "stdout": "...", "stderr": "..."}
+
+Each job runs the script's `main()` with `sys.argv` set to
+`[script, "--message_id", <id>]`, exactly like the old command line call. A
+script without `main()` is executed again as `__main__`, which still reuses
+its already imported modules.
+"""
+
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import runpy
+import sys
+import traceback
+
+
+def load_agent(script_path):
+    """
+    Imports the agent script as a module without running its `__main__` block.
+
+    The import path is set up like `python3 <script>` would: the script's
+    directory comes first, so its sibling modules import, and the directory
+    of this worker is removed, so `common/graph.py`, `common/mail.py`, ...
+    cannot shadow the agent's own modules.
+
+    Args:
+        script_path (str): Path of the agent script.
+
+    Returns:
+        module: The loaded module.
+    """
+    worker_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path[:] = [
+        path for path in sys.path if os.path.abspath(path or os.curdir) != worker_dir
+    ]
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script_path)))
+
+    spec = importlib.util.spec_from_file_location("email_agent", script_path)
+    module = importlib.util.module_from_spec(spec)
+    sys.argv = [script_path]
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_job(module, script_path, message_id):
+    """
+    Runs one agent job and captures its output.
+
+    Args:
+        module (module): The loaded agent module.
+        script_path (str): Path of the agent script.
+        message_id (str): The message ID passed as `--message_id`.
+
+    Returns:
+        dict: The return code and the captured stdout and stderr.
+    """
+    stdout, stderr = io.StringIO(), io.StringIO()
+    returncode = 0
+    sys.argv = [script_path, "--message_id", message_id]
+
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            if callable(getattr(module, "main", None)):
+                module.main()
+            else:
+                runpy.run_path(script_path, run_name="__main__")
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                returncode = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                returncode = 1
+        except BaseException:
+            traceback.print_exc()
+            returncode = 1
+
+    return {
+        "returncode": returncode,
+        "stdout": stdout.getvalue(),
+        "stderr": stderr.getvalue(),
+    }
+
+
+def serve(script_path):
+    """
+    Answers jobs from stdin until the pool closes the pipe.
+
+    Args:
+        script_path (str): Path of the agent script.
+    """
+    # Keep the real stdout for the protocol; anything else writing to fd 1
+    # (C extensions, child processes) ends up on stderr instead.
+    protocol = os.fdopen(os.dup(sys.stdout.fileno()), "w", buffering=1)
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    module = load_agent(script_path)
+
+    for line in sys.stdin:
+        job = json.loads(line)
+        result = run_job(module, script_path, job["message_id"])
+        protocol.write(json.dumps(result) + "\n")
+        protocol.flush()
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1])
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class CommonConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'common'
+
+    def ready(self):
+        # Connect the site metadata invalidation signals
+        from common import signals  # noqa: F401
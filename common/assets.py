@@ -0,0 +1,171 @@
+import logging
+import os
+import posixpath
+import re
+
+log = logging.getLogger("log")
+
+# Bundles served by the site, as {bundle: [sources]}, paths relative to the
+# static directory. Sources are concatenated in this order.
+CSS_BUNDLE = "assets/css/site.bundle.css"
+CSS_SOURCES = [
+    "assets/bootstrap/css/bootstrap.min.css",
+    "assets/fonts/font-awesome.min.css",
+    "assets/aos/aos.css",
+    "assets/css/styles.min.css",
+]
+JS_BUNDLE = "assets/js/site.bundle.js"
+JS_SOURCES = [
+    "assets/htmx.min.js",
+    "assets/js/jquery.min.js",
+    "assets/bootstrap/js/bootstrap.min.js",
+    "assets/js/script.min.js",
+    "assets/aos/aos.js",
+]
+
+# Fonts needed for the first paint (navbar icons).
+PRELOAD_FONTS = ["assets/fonts/fontawesome-webfont.woff2"]
+
+# Template with the preload hints, relative to the templates directory.
+PRELOAD_TEMPLATE = "includes/preload.html"
+
+CSS_URL_RE = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+# Comments, except the /*! ... */ license headers that must be kept.
+CSS_COMMENT_RE = re.compile(r"/\*(?!!).*?\*/", re.S)
+
+
+def rebase_css_urls(css, source, bundle):
+    """
+    Rewrites the relative `url()` references of a stylesheet for its new location.
+
+    Args:
+        css (str): The stylesheet.
+        source (str): Path of the stylesheet, relative to the static directory.
+        bundle (str): Path of the bundle it is copied into.
+
+    Returns:
+        str: The stylesheet with every relative URL pointing to the same file from the bundle.
+    """
+    source_dir = posixpath.dirname(source)
+    bundle_dir = posixpath.dirname(bundle)
+
+    def rebase(match):
+        quote, url = match.groups()
+        if url.startswith(("data:", "http:", "https:", "//", "/", "#")):
+            return match.group(0)
+        path, suffix = re.match(r"([^?#]*)(.*)", url).groups()
+        target = posixpath.normpath(posixpath.join(source_dir, path))
+        return f"url({quote}{posixpath.relpath(target, bundle_dir)}{suffix}{quote})"
+
+    return CSS_URL_RE.sub(rebase, css)
+
+
+def minify_css(css):
+    """
+    Removes comments (license headers excepted) and redundant whitespace from a stylesheet.
+
+    Args:
+        css (str): The stylesheet.
+
+    Returns:
+        str: The minified stylesheet.
+    """
+    css = CSS_COMMENT_RE.sub("", css)
+    lines = (line.strip() for line in css.splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def build_css_bundle(static_dir, sources=CSS_SOURCES, bundle=CSS_BUNDLE):
+    """
+    Concatenates and minifies the site stylesheets into one bundle.
+
+    Args:
+        static_dir (str): The static source directory.
+        sources (list): Stylesheets to bundle, in order.
+        bundle (str): Path of the bundle.
+
+    Returns:
+        str: The bundled stylesheet.
+    """
+    parts = []
+    for source in sources:
+        with open(os.path.join(static_dir, source), encoding="utf-8") as f:
+            css = f.read()
+        parts.append(f"/* {source} */\n" + minify_css(rebase_css_urls(css, source, bundle)))
+    return "\n".join(parts) + "\n"
+
+
+def build_js_bundle(static_dir, sources=JS_SOURCES):
+    """
+    Concatenates the site scripts into one bundle.
+
+    The sources are already minified; each one is terminated with `;` so that
+    scripts without a trailing semicolon cannot merge with the next one.
+
+    Args:
+        static_dir (str): The static source directory.
+        sources (list): Scripts to bundle, in order.
+
+    Returns:
+        str: The bundled script.
+    """
+    parts = []
+    for source in sources:
+        with open(os.path.join(static_dir, source), encoding="utf-8") as f:
+            parts.append(f"/* {source} */\n" + f.read().strip() + "\n;")
+    return "\n".join(parts) + "\n"
+
+
+def build_preload_template(bundles=(CSS_BUNDLE, JS_BUNDLE), fonts=PRELOAD_FONTS):
+    """
+    Builds the template with the preload hints of the bundles and fonts.
+
+    The hints go through `{% static %}`, so they point to the hashed file names
+    written by `collectstatic`.
+
+    Args:
+        bundles (tuple): Bundle paths, relative to the static directory.
+        fonts (list): Font paths to preload.
+
+    Returns:
+        str: The template source.
+    """
+    kinds = {".css": "style", ".js": "script"}
+    lines = [
+        "{# Generated by `python manage.py build_static_assets`, do not edit. #}",
+        "{% load static %}",
+    ]
+    for bundle in bundles:
+        kind = kinds[posixpath.splitext(bundle)[1]]
+        lines.append(f'<link rel="preload" href="{{% static \'{bundle}\' %}}" as="{kind}">')
+    for font in fonts:
+        lines.append(
+            f'<link rel="preload" href="{{% static \'{font}\' %}}" as="font" type="font/woff2" crossorigin>'
+        )
+    return "\n".join(lines) + "\n"
+
+
+def build_static_assets(static_dir, templates_dir):
+    """
+    Writes the CSS and JS bundles and the preload hints template.
+
+    Hashing and the gzip/brotli variants are left to `collectstatic`, which
+    runs the bundles through the compressed manifest storage.
+
+    Args:
+        static_dir (str): The static source directory.
+        templates_dir (str): The project templates directory.
+
+    Returns:
+        list: The paths of the written files.
+    """
+    outputs = {
+        os.path.join(static_dir, CSS_BUNDLE): build_css_bundle(static_dir),
+        os.path.join(static_dir, JS_BUNDLE): build_js_bundle(static_dir),
+        os.path.join(templates_dir, PRELOAD_TEMPLATE): build_preload_template(),
+    }
+    for path, content in outputs.items():
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+        log.info(f"Wrote {path} ({len(content)} bytes)")
+    return list(outputs)
@@ -1,56 +1,157 @@
+import logging
+import time
+
+from common.images import largest_variant, srcset
 from common.models import SiteMeta
+from django.conf import settings
 from django.contrib.sites.models import Site
 from django.core.cache import cache
+from redis.exceptions import LockError
 
+log = logging.getLogger("log")
 
-def site_info():
-    """
-    Retrieves site metadata, either from cache or from the database.
 
-    If cached data is available, it is returned immediately. Otherwise,
-    the data is fetched from the database, and if no metadata exists for
-    the site, a default SiteMeta instance is created. The fetched data
-    is then cached for future use.
+# Redis keys: the version is bumped by common.signals on every SiteMeta/Site
+# save, the data of each version is stored under its own key.
+SITE_DATA_VERSION_KEY = "site_data_version"
+SITE_DATA_KEY = "site_data_{}"
+SITE_DATA_LOCK_KEY = "site_data_lock"
 
-    Returns:
-        dict: A dictionary containing site metadata, such as name, title,
-        domain, description, keywords, logo, social media links, and
-        return address.
+# Per-process copy of the site data, so most renders need no Redis call.
+_local = {"version": None, "data": None, "checked_at": 0.0}
+
+
+def site_data_version():
     """
+    Returns the current version of the site metadata, creating it if needed.
 
-    data = cache.get("site_data")
+    Returns:
+        int: The version, bumped on every SiteMeta or Site change.
+    """
+    version = cache.get(SITE_DATA_VERSION_KEY)
+    if version is None:
+        cache.add(SITE_DATA_VERSION_KEY, 1, timeout=None)
+        version = cache.get(SITE_DATA_VERSION_KEY, 1)
+    return version
 
-    if data is not None:
-        return data
 
-    site = Site.objects.get()
+def bump_site_data_version():
+    """
+    Invalidates the cached site metadata in every process.
 
+    Other processes notice the new version within `SITE_DATA_CHECK_INTERVAL`
+    seconds, this process right away.
+    """
     try:
-        meta_data = site.meta_data
-    except SiteMeta.DoesNotExist:
-        meta_data = SiteMeta(site=site)
-        meta_data.save()
+        cache.incr(SITE_DATA_VERSION_KEY)
+    except ValueError:
+        cache.add(SITE_DATA_VERSION_KEY, 2, timeout=None)
+    _local["checked_at"] = 0.0
+
+
+def _load_site_data(version):
+    """
+    Builds the site metadata from the database.
 
-    data = {
-        "name": meta_data.site.name,
+    Args:
+        version (int): The version the data is built for.
+
+    Returns:
+        dict: The site metadata.
+    """
+    site = Site.objects.get()
+    meta_data, _ = SiteMeta.objects.get_or_create(site=site)
+    logo = meta_data.logo.url if meta_data.logo else ""
+
+    return {
+        "name": site.name,
         "title": meta_data.title,
-        "domain": meta_data.site.domain,
+        "domain": site.domain,
         "description": meta_data.description,
         "keywords": meta_data.keywords,
-        "logo": meta_data.logo.url if meta_data.logo else "",
-        "og_image": meta_data.social_logo.url if meta_data.social_logo else "",
+        "logo": logo,
+        # Responsive logo variants, empty until generate_site_meta_variants ran
+        "logo_avif_srcset": srcset(meta_data.logo_variants, "avif"),
+        "logo_webp_srcset": srcset(meta_data.logo_variants, "webp"),
+        "logo_fallback_srcset": srcset(meta_data.logo_variants, "fallback"),
+        "logo_fallback": largest_variant(meta_data.logo_variants) or logo,
+        # Crawlers get the widest PNG/JPEG variant instead of the original upload
+        "og_image": largest_variant(meta_data.social_logo_variants)
+        or (meta_data.social_logo.url if meta_data.social_logo else ""),
         "return_address": meta_data.return_address,
         "facebook": meta_data.facebook,
         "x_twitter": meta_data.x_twitter,
         "linkedin": meta_data.linkedin,
         "instagram": meta_data.instagram,
+        "version": version,
     }
 
-    cache.set("site_data", data, timeout=3600)
 
+def _shared_site_data(version):
+    """
+    Returns the site metadata of a version from Redis, building it once on a miss.
+
+    Only one process rebuilds the data while holding a Redis lock; the others
+    wait for it and read its result instead of all querying the database.
+
+    Args:
+        version (int): The current version.
+
+    Returns:
+        dict: The site metadata.
+    """
+    key = SITE_DATA_KEY.format(version)
+    data = cache.get(key)
+    if data is not None:
+        return data
+
+    try:
+        with cache.lock(SITE_DATA_LOCK_KEY, timeout=10, blocking_timeout=5):
+            data = cache.get(key)
+            if data is None:
+                data = _load_site_data(version)
+                cache.set(key, data, timeout=3600)
+    except LockError:
+        log.warning("Timed out waiting for the site data lock, loading directly")
+        data = _load_site_data(version)
     return data
 
 
+def site_info():
+    """
+    Retrieves site metadata, from process memory, from cache or from the database.
+
+    The copy kept in process memory is used as long as the version in Redis is
+    unchanged, which is checked at most every `SITE_DATA_CHECK_INTERVAL`
+    seconds. When the version changed (an admin edited SiteMeta or Site), the
+    data of the new version is read from Redis, or rebuilt from the database
+    by a single process. If no metadata exists for the site, a default
+    SiteMeta instance is created.
+
+    Returns:
+        dict: A fresh copy (callers may edit it) of the site metadata, such as
+        name, title, domain, description, keywords, logo, social media links,
+        return address and the `version` of the data.
+    """
+    global _local
+
+    now = time.monotonic()
+    if (
+        _local["data"] is not None
+        and now - _local["checked_at"] < settings.SITE_DATA_CHECK_INTERVAL
+    ):
+        return dict(_local["data"])
+
+    version = site_data_version()
+    if version == _local["version"] and _local["data"] is not None:
+        _local["checked_at"] = now
+        return dict(_local["data"])
+
+    data = _shared_site_data(version)
+    _local = {"version": version, "data": data, "checked_at": now}
+    return dict(data)
+
+
 def sd_context(request):
     """
     Provides site metadata to be used in the template context.
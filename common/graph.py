@@ -0,0 +1,479 @@
+import logging
+import os
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from redis.exceptions import LockError
+from requests.adapters import HTTPAdapter
+
+from common.locks import RateLimited, RedisTokenBucket
+from common.metrics import GRAPH_REQUEST_LATENCY
+
+log = logging.getLogger("log")
+
+GRAPH_BASE_URL = "https://graph.microsoft.com/v1.0"
+
+# Maximum number of requests Graph accepts in one JSON $batch call.
+GRAPH_BATCH_LIMIT = 20
+
+GRAPH_TOKEN_CACHE_KEY = "m365_graph_token"
+GRAPH_TOKEN_LOCK_KEY = "m365_graph_token_lock"
+
+# Refresh this many seconds before Microsoft's own expiry so that no worker
+# ever sends a request with a token that is about to die in flight.
+GRAPH_TOKEN_REFRESH_MARGIN = 300
+
+# Status codes Graph uses for throttling and temporary overload.
+GRAPH_THROTTLE_STATUSES = (429, 503)
+
+# Per-process copy of the shared token, saves a Redis round-trip per call.
+_local_token = {}
+
+# One pooled session per process. Celery forks its workers after import, so
+# the session is keyed by pid and a child never reuses its parent's sockets.
+_sessions = {}
+
+
+def get_graph_session():
+    """
+    Returns the keep-alive HTTP session used for all Microsoft calls in this process.
+
+    The session keeps TLS connections to login.microsoftonline.com and
+    graph.microsoft.com open between calls and asks for gzip encoded responses.
+
+    Returns:
+        requests.Session: The pooled session of the current process.
+    """
+    global _sessions
+
+    pid = os.getpid()
+    session = _sessions.get(pid)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=2, pool_maxsize=settings.M65_GRP_POOL_SIZE
+        )
+        session.mount("https://", adapter)
+        session.headers.update(
+            {"Accept": "application/json", "Accept-Encoding": "gzip, deflate"}
+        )
+        _sessions = {pid: session}
+    return session
+
+
+class GraphThrottled(Exception):
+    """Raised when Graph throttles a request or the shared rate limit is exhausted."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """
+    Parses a `Retry-After` header, given either in seconds or as an HTTP date.
+
+    Args:
+        value (str): The header value, or None.
+
+    Returns:
+        float: Seconds to wait, or None if the header is missing or malformed.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def graph_backoff(retries, retry_after=None):
+    """
+    Computes the countdown before retrying a throttled Graph call.
+
+    Exponential backoff with jitter, so throttled workers do not come back in
+    lockstep, but never sooner than Graph asked for in `Retry-After`.
+
+    Args:
+        retries (int): Retries done so far, i.e. `self.request.retries` in a task.
+        retry_after (float): Seconds requested by Graph, if any.
+
+    Returns:
+        int: Seconds to wait before the next attempt.
+    """
+    delay = min(
+        settings.M65_GRP_RETRY_MAX_DELAY,
+        settings.M65_GRP_RETRY_BASE_DELAY * 2**retries,
+    )
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    return int(max(delay, retry_after or 0)) + 1
+
+
+# One bucket object per process, the tokens themselves live in Redis.
+_rate_limiter = None
+
+
+def get_graph_rate_limiter():
+    """
+    Returns the token bucket shared by all workers for Graph calls.
+
+    Returns:
+        RedisTokenBucket: The Graph rate limiter.
+    """
+    global _rate_limiter
+
+    if _rate_limiter is None:
+        _rate_limiter = RedisTokenBucket(
+            "m365_graph",
+            rate=settings.M65_GRP_RATE_LIMIT,
+            capacity=settings.M65_GRP_RATE_BURST,
+        )
+    return _rate_limiter
+
+
+def _token_is_fresh(token):
+    """
+    Checks whether a cached token can still be used without refreshing.
+
+    Args:
+        token (dict): A token entry as stored in the cache, or None.
+
+    Returns:
+        bool: True if the token is valid beyond the refresh margin.
+    """
+    return bool(token) and token["expires_at"] - GRAPH_TOKEN_REFRESH_MARGIN > time.time()
+
+
+def _fetch_graph_token():
+    """
+    Requests a new client-credentials access token from Microsoft identity platform.
+
+    Returns:
+        dict: The token entry with `access_token` and absolute `expires_at` timestamp.
+
+    Raises:
+        requests.RequestException: If the token endpoint cannot be reached.
+        ValueError: If the response does not contain an access token.
+    """
+    token_url = f"https://login.microsoftonline.com/{settings.M65_GRP_TENANT_ID}/oauth2/v2.0/token"
+    token_data = {
+        "grant_type": "client_credentials",
+        "client_id": settings.M65_GRP_APP_ID,
+        "client_secret": settings.M65_GRP_CLIENT_SECRET,
+        "scope": "https://graph.microsoft.com/.default",
+    }
+    token_res = get_graph_session().post(
+        token_url, data=token_data, timeout=settings.M65_GRP_TIMEOUT
+    ).json()
+    access_token = token_res.get("access_token")
+    if not access_token:
+        raise ValueError(f"Could not get access token: {token_res}")
+
+    log.info("Fetched a new Microsoft Graph access token")
+    return {
+        "access_token": access_token,
+        "expires_at": time.time() + int(token_res.get("expires_in", 3599)),
+    }
+
+
+def get_graph_token(force_refresh=False):
+    """
+    Returns a Microsoft Graph access token shared by all workers through the cache.
+
+    The token is looked up in the process memory first, then in Redis. When it is
+    missing or close to expiry, a single worker refreshes it while holding a Redis
+    lock; the others wait for that refresh and reuse its result, so the token
+    endpoint is hit once per token lifetime for the whole deployment.
+
+    Args:
+        force_refresh (bool): Ignore cached tokens, e.g. after Graph answered 401.
+
+    Returns:
+        str: A valid bearer access token.
+
+    Raises:
+        requests.RequestException: If the token endpoint cannot be reached.
+        ValueError: If Microsoft does not return an access token.
+    """
+    global _local_token
+
+    if not force_refresh:
+        if _token_is_fresh(_local_token):
+            return _local_token["access_token"]
+
+        token = cache.get(GRAPH_TOKEN_CACHE_KEY)
+        if _token_is_fresh(token):
+            _local_token = token
+            return token["access_token"]
+
+    stale_token = _local_token.get("access_token")
+    try:
+        with cache.lock(GRAPH_TOKEN_LOCK_KEY, timeout=30, blocking_timeout=15):
+            # Another worker may have refreshed while we were waiting for the lock.
+            token = cache.get(GRAPH_TOKEN_CACHE_KEY)
+            if not _token_is_fresh(token) or (
+                force_refresh and token["access_token"] == stale_token
+            ):
+                token = _fetch_graph_token()
+                cache.set(
+                    GRAPH_TOKEN_CACHE_KEY,
+                    token,
+                    timeout=int(token["expires_at"] - time.time()),
+                )
+    except LockError:
+        # The refreshing worker is stuck; do not queue up behind it forever.
+        log.warning("Timed out waiting for the Graph token lock, fetching directly")
+        token = _fetch_graph_token()
+
+    _local_token = token
+    return token["access_token"]
+
+
+class GraphClient:
+    """
+    Thin Microsoft Graph API client shared by the webhook tasks and management commands.
+
+    Every request goes through the pooled session of the current process, carries
+    the shared access token, uses the configured timeouts and logs its latency.
+    """
+
+    def __init__(self, user_email=None, timeout=None):
+        """
+        Initializes the GraphClient instance.
+
+        Args:
+            user_email (str): Mailbox used by `user_path`, defaults to `settings.M65_GRP_USER_EMAIL`.
+            timeout (tuple): (connect, read) timeout in seconds, defaults to `settings.M65_GRP_TIMEOUT`.
+        """
+        self.user_email = user_email or settings.M65_GRP_USER_EMAIL
+        self.timeout = timeout or settings.M65_GRP_TIMEOUT
+
+    def user_path(self, path):
+        """
+        Builds a path relative to the monitored mailbox.
+
+        Args:
+            path (str): Path below the user resource, e.g. `messages/<id>`.
+
+        Returns:
+            str: The path prefixed with `users/<user_email>/`.
+        """
+        return f"users/{self.user_email}/{path.lstrip('/')}"
+
+    def request(
+        self, method, path, select=None, params=None, headers=None, cost=1, **kwargs
+    ):
+        """
+        Sends a request to Microsoft Graph.
+
+        Each call first takes `cost` tokens from the shared Graph rate limiter.
+        A 401 answer is retried once with a freshly fetched token, in case the
+        shared token was revoked before its expiry.
+
+        Args:
+            method (str): HTTP method.
+            path (str): Path relative to `GRAPH_BASE_URL`, or an absolute URL.
+            select (list): Fields to request through `$select`, trims the response body.
+            params (dict): Additional query parameters.
+            headers (dict): Additional request headers.
+            cost (int): Rate limiter tokens used, the number of requests in a `$batch`.
+            **kwargs: Passed to `requests.Session.request` (e.g. `json`).
+
+        Returns:
+            requests.Response: The Graph response.
+
+        Raises:
+            GraphThrottled: If Graph answers 429 or 503, or the rate limit is exhausted.
+            requests.RequestException: If Graph cannot be reached.
+        """
+        url = path if path.startswith("https://") else f"{GRAPH_BASE_URL}/{path.lstrip('/')}"
+        params = dict(params or {})
+        if select:
+            params["$select"] = ",".join(select)
+
+        session = get_graph_session()
+        force_refresh = False
+        for _ in range(2):
+            try:
+                get_graph_rate_limiter().acquire(
+                    cost=cost, wait=settings.M65_GRP_RATE_WAIT
+                )
+            except RateLimited as e:
+                raise GraphThrottled(str(e), retry_after=e.retry_after)
+
+            request_headers = {
+                "Authorization": f"Bearer {get_graph_token(force_refresh=force_refresh)}"
+            }
+            request_headers.update(headers or {})
+
+            started = time.perf_counter()
+            response = session.request(
+                method,
+                url,
+                params=params,
+                headers=request_headers,
+                timeout=self.timeout,
+                **kwargs,
+            )
+            elapsed = time.perf_counter() - started
+            GRAPH_REQUEST_LATENCY.labels(method, response.status_code).observe(elapsed)
+            log.info(
+                f"Graph {method} {url} -> {response.status_code} in {elapsed * 1000:.0f} ms"
+            )
+
+            if response.status_code != 401:
+                break
+            force_refresh = True
+
+        if response.status_code in GRAPH_THROTTLE_STATUSES:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            raise GraphThrottled(
+                f"Graph {method} {url} throttled with {response.status_code}, "
+                f"retry after {retry_after} seconds",
+                retry_after=retry_after,
+            )
+        return response
+
+    def get(self, path, **kwargs):
+        """Sends a GET request, see `request`."""
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        """Sends a POST request, see `request`."""
+        return self.request("POST", path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        """Sends a PATCH request, see `request`."""
+        return self.request("PATCH", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        """Sends a DELETE request, see `request`."""
+        return self.request("DELETE", path, **kwargs)
+
+
+def resolve_immutable_ids(volatile_ids, graph=None):
+    """
+    Resolves volatile message IDs to their internetMessageId through the JSON `$batch` endpoint.
+
+    IDs are sent in chunks of `GRAPH_BATCH_LIMIT`, so a burst of notifications
+    costs one Graph round-trip per 20 messages instead of one per message. Each
+    item of a batch succeeds or fails on its own.
+
+    Args:
+        volatile_ids (list): Volatile message IDs taken from the notifications.
+        graph (GraphClient): Client to use, a new one is created if omitted.
+
+    Returns:
+        tuple: A `(resolved, failed, throttled, retry_after)` tuple. `resolved` maps each
+        volatile ID to its internetMessageId, or to None when Graph no longer has
+        the message or refused the lookup for good (any other 4xx status).
+        `failed` lists the IDs that hit a transient error (throttling, 5xx,
+        network, unreadable answer) and should be tried again later.
+        `throttled` is True if Graph throttled the batch or one of its items;
+        the remaining chunks are then not sent and are returned as failed.
+        `retry_after` is the longest `Retry-After` Graph asked for, or None
+        when it sent none (the caller then uses its default backoff).
+    """
+    graph = graph or GraphClient()
+    resolved = {}
+    failed = []
+    throttled = False
+    retry_after = None
+
+    for start in range(0, len(volatile_ids), GRAPH_BATCH_LIMIT):
+        if throttled:
+            # The remaining chunks would be throttled as well, keep them for later
+            failed.extend(volatile_ids[start:])
+            break
+
+        chunk = volatile_ids[start : start + GRAPH_BATCH_LIMIT]
+        batch_body = {
+            "requests": [
+                {
+                    "id": str(index),
+                    "method": "GET",
+                    "url": "/"
+                    + graph.user_path(
+                        f"messages/{volatile_id}?$select=internetMessageId"
+                    ),
+                }
+                for index, volatile_id in enumerate(chunk)
+            ]
+        }
+
+        try:
+            response = graph.post("$batch", json=batch_body, cost=len(chunk))
+        except GraphThrottled as e:
+            log.warning(f"Graph $batch request throttled: {e}")
+            failed.extend(chunk)
+            throttled = True
+            retry_after = e.retry_after
+            continue
+        except Exception as e:
+            log.error(f"Graph $batch request failed: {e}")
+            failed.extend(chunk)
+            continue
+
+        if response.status_code != 200:
+            log.error(
+                f"Graph $batch request failed: {response.status_code} - {response.text}"
+            )
+            failed.extend(chunk)
+            continue
+
+        try:
+            items = response.json().get("responses", [])
+        except ValueError as e:
+            log.error(f"Graph $batch answer is not valid JSON: {e}")
+            failed.extend(chunk)
+            continue
+
+        answered = set()
+        for item in items:
+            try:
+                index = int(item.get("id"))
+                volatile_id = chunk[index]
+            except (TypeError, ValueError, IndexError):
+                log.warning(f"Ignoring unexpected Graph $batch item: {item}")
+                continue
+            answered.add(index)
+            status = item.get("status")
+
+            if status == 200:
+                resolved[volatile_id] = item.get("body", {}).get("internetMessageId")
+            elif status == 404:
+                log.warning(f"Graph has no message {volatile_id}, skipping it")
+                resolved[volatile_id] = None
+            elif status in GRAPH_THROTTLE_STATUSES:
+                log.warning(f"Resolution of {volatile_id} throttled: status {status}")
+                failed.append(volatile_id)
+                throttled = True
+                item_retry_after = parse_retry_after(
+                    (item.get("headers") or {}).get("Retry-After")
+                )
+                if item_retry_after is not None:
+                    retry_after = max(retry_after or 0, item_retry_after)
+            elif not isinstance(status, int) or status >= 500:
+                log.warning(f"Could not resolve {volatile_id}: status {status}")
+                failed.append(volatile_id)
+            else:
+                # 400, 403, ...: asking again gives the same answer
+                log.warning(f"Graph refused to resolve {volatile_id}: status {status}, skipping it")
+                resolved[volatile_id] = None
+
+        failed.extend(
+            volatile_id
+            for index, volatile_id in enumerate(chunk)
+            if index not in answered
+        )
+
+    return resolved, failed, throttled, retry_after
+
@@ -0,0 +1,130 @@
+import io
+import logging
+import posixpath
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+log = logging.getLogger("log")
+
+# Storage directory of the generated variants.
+VARIANT_DIR = "site_meta/variants"
+
+
+def avif_supported():
+    """
+    Checks whether this Pillow build can write AVIF (Pillow 11.2+ or pillow-avif-plugin).
+
+    Returns:
+        bool: True if AVIF variants can be generated.
+    """
+    Image.init()
+    return "AVIF" in Image.SAVE
+
+
+def build_image_variants(name, widths):
+    """
+    Generates resized variants of an uploaded image in the default storage.
+
+    Every width gets a WebP file, an AVIF file when Pillow supports it, and a
+    fallback for old browsers: PNG for images with transparency, JPEG
+    otherwise. Widths above the original width are capped, images are never
+    upscaled.
+
+    Args:
+        name (str): Storage name of the original image.
+        widths (list): Target widths in pixels.
+
+    Returns:
+        dict: `{"source": name, "avif": {width: url}, "webp": {...}, "fallback": {...},
+        "files": [storage names]}`, widths as strings (the dict is stored as JSON).
+    """
+    with default_storage.open(name) as f:
+        image = Image.open(f)
+        image.load()
+    image = ImageOps.exif_transpose(image)
+
+    alpha = image.mode in ("RGBA", "LA") or (
+        image.mode == "P" and "transparency" in image.info
+    )
+    image = image.convert("RGBA" if alpha else "RGB")
+
+    formats = [("webp", "webp", "WEBP", {"quality": 80, "method": 6})]
+    if avif_supported():
+        formats.insert(0, ("avif", "avif", "AVIF", {"quality": 60}))
+    if alpha:
+        formats.append(("fallback", "png", "PNG", {"optimize": True}))
+    else:
+        formats.append(
+            ("fallback", "jpg", "JPEG", {"quality": 85, "optimize": True, "progressive": True})
+        )
+
+    stem = posixpath.splitext(posixpath.basename(name))[0]
+    variants = {"source": name, "files": []}
+    for width in sorted({min(width, image.width) for width in widths}):
+        height = max(1, round(image.height * width / image.width))
+        resized = (
+            image
+            if width == image.width
+            else image.resize((width, height), Image.Resampling.LANCZOS)
+        )
+        for kind, extension, image_format, options in formats:
+            buffer = io.BytesIO()
+            resized.save(buffer, image_format, **options)
+            path = default_storage.save(
+                f"{VARIANT_DIR}/{stem}-{width}w.{extension}", ContentFile(buffer.getvalue())
+            )
+            variants["files"].append(path)
+            variants.setdefault(kind, {})[str(width)] = default_storage.url(path)
+
+    log.info(f"Generated {len(variants['files'])} variants of {name}")
+    return variants
+
+
+def delete_image_variants(variants):
+    """
+    Removes the files of variants that were replaced.
+
+    Args:
+        variants (dict): Variants as returned by `build_image_variants`.
+    """
+    for path in (variants or {}).get("files", []):
+        try:
+            default_storage.delete(path)
+        except OSError as e:
+            log.warning(f"Could not delete image variant {path}: {e}")
+
+
+def srcset(variants, kind):
+    """
+    Builds a `srcset` attribute value from the variants of one kind.
+
+    Args:
+        variants (dict): Variants as returned by `build_image_variants`.
+        kind (str): "avif", "webp" or "fallback".
+
+    Returns:
+        str: E.g. `/media/logo-160w.webp 160w, /media/logo-320w.webp 320w`, or "" if none.
+    """
+    urls = (variants or {}).get(kind) or {}
+    return ", ".join(
+        f"{url} {width}w" for width, url in sorted(urls.items(), key=lambda item: int(item[0]))
+    )
+
+
+def largest_variant(variants, kind="fallback"):
+    """
+    Returns the URL of the widest variant of one kind.
+
+    Args:
+        variants (dict): Variants as returned by `build_image_variants`.
+        kind (str): "avif", "webp" or "fallback".
+
+    Returns:
+        str: The URL, or None if there is no such variant.
+    """
+    urls = (variants or {}).get(kind) or {}
+    if not urls:
+        return None
+    return urls[max(urls, key=int)]
@@ -0,0 +1,211 @@
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+
+def add_many(keys, value=True, timeout=300):
+    """
+    Batched version of `cache.add`: sets every key that does not exist yet, in one round-trip.
+
+    Each key is written with `SET NX EX` inside a single pipeline, so deduping
+    a 50-item notification batch costs one Redis call instead of 50. Keys and
+    values go through the cache's own key and value encoding, so they can be
+    read, updated and deleted with the regular `cache` API afterwards.
+
+    Args:
+        keys (list): Cache keys to set, duplicates in the list count once.
+        value: Value stored under every newly set key.
+        timeout (int): Expiry of the keys in seconds.
+
+    Returns:
+        list: The keys that were set by this call, in input order.
+    """
+    if not keys:
+        return []
+
+    encoded = cache.client.encode(value)
+    with get_redis_connection("default").pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.set(cache.make_key(key), encoded, nx=True, ex=timeout)
+        results = pipe.execute()
+
+    return [key for key, added in zip(keys, results) if added]
+
+
+class SemaphoreTimeout(Exception):
+    """Raised when no semaphore slot frees up within the wait time."""
+
+
+class RedisSemaphore:
+    """
+    Counting semaphore shared by every process that talks to the same Redis.
+
+    Each holder owns a lease in a sorted set, scored by its expiry time. Leases
+    of crashed workers are never released explicitly; they simply expire and
+    are swept out by the next acquire, so a slot is never lost for good.
+    """
+
+    # KEYS = [set], ARGV = [limit, lease seconds, token]
+    ACQUIRE_SCRIPT = """
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+    if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[1]) then
+        redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[3])
+        redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[2])))
+        return 1
+    end
+    return 0
+    """
+
+    def __init__(self, name, limit, lease):
+        """
+        Initializes the RedisSemaphore instance.
+
+        Args:
+            name (str): Name of the semaphore, used in the Redis key.
+            limit (int): Maximum number of concurrent holders.
+            lease (int): Seconds after which a slot of a vanished holder is freed.
+        """
+        self.key = f"semaphore_{name}"
+        self.limit = limit
+        self.lease = lease
+        self._acquire = get_redis_connection("default").register_script(
+            self.ACQUIRE_SCRIPT
+        )
+
+    def acquire(self, wait, poll=0.5):
+        """
+        Waits for a free slot.
+
+        Args:
+            wait (float): Maximum seconds to wait.
+            poll (float): Seconds between attempts.
+
+        Returns:
+            tuple: The lease token and the seconds spent waiting.
+
+        Raises:
+            SemaphoreTimeout: If no slot freed up within `wait` seconds.
+        """
+        token = uuid.uuid4().hex
+        started = time.monotonic()
+        while not self._acquire(keys=[self.key], args=[self.limit, self.lease, token]):
+            if time.monotonic() - started >= wait:
+                raise SemaphoreTimeout(
+                    f"No free {self.key} slot after {wait} seconds (limit {self.limit})"
+                )
+            time.sleep(poll)
+        return token, time.monotonic() - started
+
+    def release(self, token):
+        """
+        Gives a slot back.
+
+        Args:
+            token (str): The token returned by `acquire`.
+        """
+        get_redis_connection("default").zrem(self.key, token)
+
+    @contextmanager
+    def hold(self, wait):
+        """
+        Holds a slot for the duration of the `with` block.
+
+        Args:
+            wait (float): Maximum seconds to wait for the slot.
+
+        Yields:
+            float: The seconds spent waiting for the slot.
+
+        Raises:
+            SemaphoreTimeout: If no slot freed up within `wait` seconds.
+        """
+        token, waited = self.acquire(wait)
+        try:
+            yield waited
+        finally:
+            self.release(token)
+
+
+class RateLimited(Exception):
+    """Raised when a token bucket cannot serve a request within the wait time."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RedisTokenBucket:
+    """
+    Token bucket rate limiter shared by every process that talks to the same Redis.
+
+    The bucket refills at `rate` tokens per second up to `capacity`. Refill and
+    take happen in one Lua script, using the Redis clock, so all workers draw
+    from the same budget.
+    """
+
+    # KEYS = [bucket], ARGV = [rate, capacity, cost]
+    TAKE_SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local capacity = tonumber(ARGV[2])
+    local cost = tonumber(ARGV[3])
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    local wait = 0
+    if tokens >= cost then
+        tokens = tokens - cost
+    else
+        wait = (cost - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return tostring(wait)
+    """
+
+    def __init__(self, name, rate, capacity):
+        """
+        Initializes the RedisTokenBucket instance.
+
+        Args:
+            name (str): Name of the bucket, used in the Redis key.
+            rate (float): Tokens added per second.
+            capacity (int): Maximum tokens, i.e. the allowed burst.
+        """
+        self.key = f"token_bucket_{name}"
+        self.rate = rate
+        self.capacity = capacity
+        self._take = get_redis_connection("default").register_script(self.TAKE_SCRIPT)
+
+    def acquire(self, cost=1, wait=0):
+        """
+        Takes `cost` tokens, sleeping until they are available for at most `wait` seconds.
+
+        Args:
+            cost (int): Tokens needed, e.g. the number of requests in a batch.
+            wait (float): Maximum seconds to wait.
+
+        Raises:
+            RateLimited: If the tokens would not be available within `wait` seconds.
+        """
+        cost = min(cost, self.capacity)
+        started = time.monotonic()
+        while True:
+            needed = float(
+                self._take(keys=[self.key], args=[self.rate, self.capacity, cost])
+            )
+            if needed <= 0:
+                return
+            if time.monotonic() - started + needed > wait:
+                raise RateLimited(
+                    f"{self.key} is empty, next tokens in {needed:.1f} seconds",
+                    retry_after=needed,
+                )
+            time.sleep(needed)
@@ -0,0 +1,176 @@
+import atexit
+import logging
+import os
+import smtplib
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail.backends import smtp
+
+log = logging.getLogger("log")
+
+# Idle SMTP connection of each process, as {pid: (connection, last_used)}.
+# Keyed by pid so a forked Celery child never writes to its parent's socket.
+_idle = {}
+_idle_lock = threading.Lock()
+
+
+def is_permanent_smtp_error(error):
+    """
+    Tells whether sending again would fail the same way.
+
+    SMTP answers with a 5xx code (refused recipient or sender, rejected
+    message) are permanent; 4xx codes, dropped connections and network
+    errors are worth a retry.
+
+    Args:
+        error (Exception): The error raised while sending a message.
+
+    Returns:
+        bool: True if the message should not be retried.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code >= 500
+    return False
+
+
+def _quit(connection):
+    """
+    Ends an SMTP session, ignoring errors of an already broken connection.
+
+    Args:
+        connection (smtplib.SMTP): The connection to end.
+    """
+    try:
+        connection.quit()
+    except (smtplib.SMTPException, OSError):
+        connection.close()
+
+
+def _checkout():
+    """
+    Takes the idle connection of this process if it is still usable.
+
+    Connections idle for longer than `EMAIL_POOL_IDLE_TIMEOUT` are dropped, the
+    server has most likely closed them already. Connections idle for longer
+    than `EMAIL_POOL_CHECK_AFTER` are checked with a NOOP first.
+
+    Returns:
+        smtplib.SMTP: A live connection, or None if a new one has to be opened.
+    """
+    with _idle_lock:
+        connection, last_used = _idle.pop(os.getpid(), (None, 0))
+    if connection is None:
+        return None
+
+    idle = time.monotonic() - last_used
+    if idle > settings.EMAIL_POOL_IDLE_TIMEOUT:
+        _quit(connection)
+        return None
+    if idle > settings.EMAIL_POOL_CHECK_AFTER:
+        try:
+            healthy = connection.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            healthy = False
+        if not healthy:
+            log.info("Pooled SMTP connection failed its health check, reconnecting")
+            _quit(connection)
+            return None
+    return connection
+
+
+def _checkin(connection):
+    """
+    Keeps a connection for the next send of this process.
+
+    Only one connection is kept per process; a second one, opened by a
+    concurrent thread, is closed.
+
+    Args:
+        connection (smtplib.SMTP): The connection to keep.
+    """
+    pid = os.getpid()
+    with _idle_lock:
+        if pid not in _idle:
+            _idle[pid] = (connection, time.monotonic())
+            return
+    _quit(connection)
+
+
+def close_idle_connection():
+    """
+    Ends the idle SMTP session of this process, called when the process exits.
+    """
+    with _idle_lock:
+        connection, _ = _idle.pop(os.getpid(), (None, 0))
+    if connection is not None:
+        _quit(connection)
+
+
+atexit.register(close_idle_connection)
+
+
+class PooledEmailBackend(smtp.EmailBackend):
+    """
+    SMTP backend that keeps its connection open between sends.
+
+    The SMTP + STARTTLS + login handshake is paid once per worker process
+    instead of once per email. `close()` hands the connection back to the
+    process instead of ending the session, and a connection that was dropped
+    by the server is replaced transparently.
+    """
+
+    def open(self):
+        """
+        Reuses the idle connection of this process, or opens a new one.
+
+        Returns:
+            bool: True if this call provided the connection, so that `send_messages`
+            gives it back afterwards; False if one was already open.
+        """
+        if self.connection:
+            return False
+
+        connection = _checkout()
+        if connection is not None:
+            self.connection = connection
+            return True
+        return super().open()
+
+    def close(self):
+        """
+        Gives the connection back for reuse instead of ending the session.
+        """
+        if self.connection is None:
+            return
+        connection, self.connection = self.connection, None
+        _checkin(connection)
+
+    def _reconnect(self):
+        """
+        Drops the current connection and opens a fresh one.
+        """
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        super().open()
+
+    def _send(self, email_message):
+        """
+        Sends one message, reconnecting once if the server dropped the connection.
+
+        Args:
+            email_message (EmailMessage): The message to send.
+
+        Returns:
+            bool: True if the message was sent.
+        """
+        try:
+            return super()._send(email_message)
+        except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+            log.warning(f"SMTP connection lost ({e}), reconnecting")
+            self._reconnect()
+            return super()._send(email_message)
@@ -0,0 +1,21 @@
+# ed /common/management/commands/build_static_assets.py
+
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from common.assets import build_static_assets
+
+
+class Command(BaseCommand):
+    help = "Bundle the site CSS and JS and write the preload hints. Run before collectstatic."
+
+    def handle(self, *args, **options):
+        written = build_static_assets(
+            os.path.join(settings.BASE_DIR, "static"),
+            os.path.join(settings.BASE_DIR, "templates"),
+        )
+        for path in written:
+            self.stdout.write(self.style.SUCCESS(f"Wrote {path}"))
+        self.stdout.write("Now run `python manage.py collectstatic` to hash and compress them.")
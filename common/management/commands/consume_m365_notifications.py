@@ -0,0 +1,52 @@
+# ed /common/management/commands/consume_m365_notifications.py
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from common.metrics import start_worker_exporter
+from common.streams import consume_notifications
+from common.tasks import dispatch_notifications
+
+
+class Command(BaseCommand):
+    help = "Read Microsoft Graph notifications from the Redis Stream and dispatch them in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--consumer",
+            help="Consumer name inside the group (defaults to host name and pid).",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Maximum notifications read per round-trip.",
+        )
+        parser.add_argument(
+            "--block",
+            type=int,
+            default=5000,
+            help="Milliseconds a read waits for new notifications.",
+        )
+        parser.add_argument(
+            "--metrics-port",
+            type=int,
+            default=settings.METRICS_CONSUMER_PORT,
+            help="Port to serve the dedupe metrics on (defaults to METRICS_CONSUMER_PORT).",
+        )
+
+    def handle(self, *args, **options):
+        # The dedupe counters live in this process, nothing else exposes them
+        if options["metrics_port"]:
+            start_worker_exporter(options["metrics_port"])
+
+        self.stdout.write("Waiting for Microsoft Graph notifications...")
+        try:
+            consume_notifications(
+                dispatch_notifications,
+                consumer=options["consumer"],
+                batch_size=options["batch_size"],
+                block_ms=options["block"],
+            )
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.WARNING("Stopped."))
@@ -1,71 +1,41 @@
 # ed /common/management/commands/setup_m365_webhook.py
 
-import requests
 import datetime
 from django.core.management.base import BaseCommand
 from django.conf import settings
 from django.utils import timezone
 
+from common.graph import GraphClient
+
 
 class Command(BaseCommand):
     help = "Clean old subscriptions and register a fresh Microsoft Graph Webhook for the Inbox."
 
     def handle(self, *args, **options):
-        # 1. CREDENTIALS FROM SETTINGS
-        TENANT_ID = settings.M65_GRP_TENANT_ID
-        CLIENT_ID = settings.M65_GRP_APP_ID
-        CLIENT_SECRET = settings.M65_GRP_CLIENT_SECRET
-
-        NOTIFICATION_URL = "https://return.edsystemsinc.com/webhooks/msgraph/"
-        USER_EMAIL = "ehaines@edsystemsinc.com"
-
-        # 2. GET ACCESS TOKEN
-        token_url = f"https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/token"
-        token_data = {
-            "grant_type": "client_credentials",
-            "client_id": CLIENT_ID,
-            "client_secret": CLIENT_SECRET,
-            "scope": "https://graph.microsoft.com/.default",
-        }
-
-        try:
-            token_res = requests.post(token_url, data=token_data).json()
-            access_token = token_res.get("access_token")
-        except Exception as e:
-            self.stdout.write(self.style.ERROR(f"Auth Request Failed: {e}"))
-            return
-
-        if not access_token:
-            self.stdout.write(
-                self.style.ERROR(f"Could not get access token: {token_res}")
-            )
-            return
+        NOTIFICATION_URL = settings.M65_GRP_NOTIFICATION_URL
+        USER_EMAIL = settings.M65_GRP_USER_EMAIL
 
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json",
-        }
-        sub_url = "https://graph.microsoft.com/v1.0/subscriptions"
+        # 1. GRAPH CLIENT (pooled session, shared token, uniform timeouts)
+        graph = GraphClient(user_email=USER_EMAIL)
 
-        # 3. CLEANUP OLD SUBSCRIPTIONS
+        # 2. CLEANUP OLD SUBSCRIPTIONS
         # This prevents the "Double Draft" flood from old active webhooks
         self.stdout.write("Checking for existing subscriptions...")
         try:
-            current_subs = (
-                requests.get(sub_url, headers=headers).json().get("value", [])
-            )
+            current_subs = graph.get("subscriptions").json().get("value", [])
             for sub in current_subs:
                 # We only delete subs that point to our specific endpoint
                 if NOTIFICATION_URL in sub.get("notificationUrl", ""):
                     sub_id = sub.get("id")
                     self.stdout.write(f"Removing old subscription: {sub_id}")
-                    requests.delete(f"{sub_url}/{sub_id}", headers=headers)
+                    graph.delete(f"subscriptions/{sub_id}")
         except Exception as e:
             self.stdout.write(self.style.WARNING(f"Cleanup failed (skipping): {e}"))
 
-        # 4. PREPARE NEW SUBSCRIPTION
+        # 3. PREPARE NEW SUBSCRIPTION
         # Expiration must be < 4230 minutes. We'll use 4000 (roughly 2.7 days).
-        expiry_date = timezone.now() + datetime.timedelta(minutes=4000)
+        lifetime = datetime.timedelta(minutes=4000)
+        expiry_date = timezone.now() + lifetime
         expiry = expiry_date.strftime("%Y-%m-%dT%H:%M:%SZ")
 
         sub_body = {
@@ -77,9 +47,20 @@ class Command(BaseCommand):
             "clientState": "SecretToken123",  # Used in your view to verify the POST
         }
 
-        # 5. REGISTER
+        # Ask Graph to put immutable IDs in the notifications, so an ID stays
+        # valid if the message is moved before it is resolved to its
+        # internetMessageId. Turned off by M65_GRP_IMMUTABLE_IDS=False.
+        sub_headers = {}
+        if settings.M65_GRP_IMMUTABLE_IDS:
+            sub_headers["Prefer"] = 'IdType="ImmutableId"'
+
+        # 4. REGISTER
         self.stdout.write(f"Registering new webhook for {USER_EMAIL}...")
-        response = requests.post(sub_url, headers=headers, json=sub_body)
+        try:
+            response = graph.post("subscriptions", json=sub_body, headers=sub_headers)
+        except Exception as e:
+            self.stdout.write(self.style.ERROR(f"Graph Request Failed: {e}"))
+            return
 
         if response.status_code == 201:
             res_data = response.json()
@@ -87,6 +68,8 @@ class Command(BaseCommand):
                 self.style.SUCCESS(f"SUCCESS! Webhook active. ID: {res_data.get('id')}")
             )
             self.stdout.write(f"Expires at: {res_data.get('expirationDateTime')}")
+            if settings.M65_GRP_IMMUTABLE_IDS:
+                self.stdout.write("Notifications will carry immutable message IDs.")
         else:
             self.stdout.write(
                 self.style.ERROR(
@@ -0,0 +1,88 @@
+import logging
+import os
+
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    multiprocess,
+    start_http_server,
+)
+
+log = logging.getLogger("log")
+
+WEBHOOK_LATENCY = Histogram(
+    "ed_webhook_request_seconds",
+    "Time spent answering a Microsoft Graph webhook request.",
+    ["view"],
+)
+WEBHOOK_NOTIFICATIONS = Counter(
+    "ed_webhook_notifications_total",
+    "Change notifications received by the webhook.",
+)
+NOTIFICATION_DEDUPE = Counter(
+    "ed_notification_dedupe_total",
+    "Notifications checked against the msg_ping_lock keys, by result (new or duplicate).",
+    ["result"],
+)
+RMA_EMAIL_STAGE = Histogram(
+    "ed_process_rma_email_stage_seconds",
+    "Duration of each stage of process_rma_email.",
+    ["stage"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+GRAPH_REQUEST_LATENCY = Histogram(
+    "ed_graph_request_seconds",
+    "Latency of Microsoft Graph requests, by method and status code.",
+    ["method", "status"],
+)
+EMAIL_SEND_LATENCY = Histogram(
+    "ed_email_send_seconds",
+    "Time spent handing emails to the SMTP server, by task.",
+    ["task"],
+)
+EMAIL_SEND_FAILURES = Counter(
+    "ed_email_send_failures_total",
+    "Email tasks that failed to send, by task.",
+    ["task"],
+)
+
+
+def get_registry():
+    """
+    Returns the registry to expose.
+
+    With `PROMETHEUS_MULTIPROC_DIR` set (gunicorn workers, Celery prefork
+    children), the values of all processes are collected from that directory.
+
+    Returns:
+        CollectorRegistry: The registry holding the metrics of this deployment.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def start_worker_exporter(port):
+    """
+    Serves the metrics of a Celery worker or of the notification consumer over HTTP on `port`.
+
+    Args:
+        port (int): The port Prometheus scrapes.
+    """
+    start_http_server(port, registry=get_registry())
+    log.info(f"Serving metrics of process {os.getpid()} on port {port}")
+
+
+def mark_process_dead(pid):
+    """
+    Drops the live gauges of a finished process in multiprocess mode.
+
+    Args:
+        pid (int): The pid of the process that exited.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('common', '0006_alter_sitemeta_return_address'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sitemeta',
+            name='logo_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+        migrations.AddField(
+            model_name='sitemeta',
+            name='social_logo_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
@@ -21,6 +21,8 @@ class SiteMeta(models.Model):
         x_twitter (URLField): Twitter page URL for the site.
         linkedin (URLField): LinkedIn profile URL for the site.
         instagram (URLField): Instagram profile URL for the site.
+        logo_variants (dict): Resized WebP/AVIF/fallback versions of the logo, see `common.images`.
+        social_logo_variants (dict): Resized versions of the social logo.
     """
 
     site = models.OneToOneField(
@@ -41,6 +43,9 @@ class SiteMeta(models.Model):
     x_twitter = models.URLField(default="#")
     linkedin = models.URLField(default="#")
     instagram = models.URLField(default="#")
+    # Filled in the background by the generate_site_meta_variants task
+    logo_variants = models.JSONField(default=dict, blank=True, editable=False)
+    social_logo_variants = models.JSONField(default=dict, blank=True, editable=False)
 
     def __str__(self):
         """
@@ -0,0 +1,45 @@
+from django.contrib.sites.models import Site
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from common.context_processor import bump_site_data_version
+from common.models import SiteMeta
+
+
+@receiver(post_save, sender=SiteMeta)
+@receiver(post_delete, sender=SiteMeta)
+@receiver(post_save, sender=Site)
+@receiver(post_delete, sender=Site)
+def invalidate_site_data(sender, **kwargs):
+    """
+    Bumps the site metadata version when SiteMeta or Site changes, so edits show up right away.
+
+    The bump waits for the commit, otherwise another process could rebuild and
+    cache the old data under the new version.
+
+    Args:
+        sender (Model): The model class that was saved or deleted.
+    """
+    transaction.on_commit(bump_site_data_version)
+
+
+@receiver(post_save, sender=SiteMeta)
+def queue_image_variants(sender, instance, **kwargs):
+    """
+    Queues the generation of responsive variants for a newly uploaded logo or social logo.
+
+    Args:
+        sender (Model): The SiteMeta class.
+        instance (SiteMeta): The saved SiteMeta.
+    """
+    # Imported here, common.tasks pulls in Celery and Pillow
+    from common.tasks import generate_site_meta_variants
+
+    for field in ("logo", "social_logo"):
+        image = getattr(instance, field)
+        variants = getattr(instance, f"{field}_variants") or {}
+        if image and variants.get("source") != image.name:
+            transaction.on_commit(
+                lambda field=field: generate_site_meta_variants.delay(instance.pk, field)
+            )
@@ -0,0 +1,326 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import weakref
+
+import redis.asyncio as aioredis
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from redis.exceptions import ResponseError
+
+log = logging.getLogger("log")
+
+# Redis Stream the webhook appends every Graph change notification to.
+NOTIFICATION_STREAM = "m365_notifications"
+NOTIFICATION_GROUP = "m365_dispatchers"
+
+# Approximate cap of the stream. MAXLEN trims the oldest entries whether they
+# were acknowledged or not; a pending entry trimmed away comes back from
+# XAUTOCLAIM without fields and is only acknowledged, so keep the cap far
+# above the backlog the consumers can fall behind by.
+NOTIFICATION_STREAM_MAXLEN = 100000
+
+# Entries delivered more often than this are moved to the dead-letter stream
+# instead of being replayed forever.
+NOTIFICATION_MAX_DELIVERIES = 5
+NOTIFICATION_DEAD_STREAM = "m365_notifications_dead"
+
+# Entries read but not acknowledged for this long belong to a dead consumer
+# and are claimed again, which gives at-least-once delivery.
+NOTIFICATION_CLAIM_IDLE_MS = 60 * 1000
+
+# Seconds a message ID is remembered at ingress by the async webhook, which
+# absorbs Microsoft's redelivered pings before they reach the stream.
+INGRESS_SEEN_TIMEOUT = 60
+
+# Dedupes and appends a whole batch in a single round-trip:
+# KEYS = [stream, seen_key_1, ...], ARGV = [ttl, maxlen, id_1, ...]
+APPEND_NEW_SCRIPT = """
+local added = 0
+for i = 2, #KEYS do
+    if redis.call('SET', KEYS[i], '1', 'NX', 'EX', ARGV[1]) then
+        redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[2], '*',
+            'message_id', ARGV[i + 1])
+        added = added + 1
+    end
+end
+return added
+"""
+
+# redis.asyncio clients are bound to the event loop that created them.
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def append_notifications(notifications):
+    """
+    Appends a batch of Graph change notifications to the notification stream.
+
+    All entries are written with one pipelined round-trip, so the webhook can
+    answer Microsoft right away no matter how many notifications it received.
+
+    Args:
+        notifications (list): The `value` list of the Graph notification payload.
+
+    Returns:
+        int: The number of entries appended.
+    """
+    message_ids = [
+        notification.get("resourceData", {}).get("id") for notification in notifications
+    ]
+    message_ids = [message_id for message_id in message_ids if message_id]
+
+    if message_ids:
+        with get_redis_connection("default").pipeline(transaction=False) as pipe:
+            for message_id in message_ids:
+                pipe.xadd(
+                    NOTIFICATION_STREAM,
+                    {"message_id": message_id},
+                    maxlen=NOTIFICATION_STREAM_MAXLEN,
+                    approximate=True,
+                )
+            pipe.execute()
+    return len(message_ids)
+
+
+def get_async_redis():
+    """
+    Returns the non-blocking Redis client of the running event loop.
+
+    Clients are reused only as long as their loop lives, which is the whole
+    process under an ASGI server. Do not call it under WSGI, where each
+    request gets a new loop and would build a new client and pool.
+
+    Returns:
+        redis.asyncio.Redis: A client connected to the cache Redis server.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = aioredis.from_url(settings.CACHES["default"]["LOCATION"])
+        _async_clients[loop] = client
+    return client
+
+
+async def aappend_notifications(notifications):
+    """
+    Async version of `append_notifications` that also drops duplicate pings.
+
+    A Lua script sets a short-lived `msg_ping_seen_<id>` key per message and
+    appends only the messages seen for the first time, all in one non-blocking
+    round-trip. The consumer keeps doing the authoritative dedupe.
+
+    Args:
+        notifications (list): The `value` list of the Graph notification payload.
+
+    Returns:
+        int: The number of entries appended.
+    """
+    keys = [NOTIFICATION_STREAM]
+    args = [INGRESS_SEEN_TIMEOUT, NOTIFICATION_STREAM_MAXLEN]
+    for notification in notifications:
+        message_id = notification.get("resourceData", {}).get("id")
+        if message_id:
+            keys.append(cache.make_key(f"msg_ping_seen_{message_id}"))
+            args.append(message_id)
+
+    if len(keys) == 1:
+        return 0
+    append_new = get_async_redis().register_script(APPEND_NEW_SCRIPT)
+    return await append_new(keys=keys, args=args)
+
+
+def ensure_notification_group(redis_conn):
+    """
+    Creates the consumer group (and the stream) if they do not exist yet.
+
+    Args:
+        redis_conn (Redis): The raw Redis connection.
+    """
+    try:
+        redis_conn.xgroup_create(
+            NOTIFICATION_STREAM, NOTIFICATION_GROUP, id="0", mkstream=True
+        )
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def default_consumer_name():
+    """
+    Returns a consumer name unique to this host and process.
+
+    Returns:
+        str: The consumer name.
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def _decode_entries(entries):
+    """
+    Converts raw stream entries into `(entry_id, message_id)` tuples.
+
+    Entries trimmed from the stream while pending come back without fields and
+    are returned with a None message ID, they only need to be acknowledged.
+
+    Args:
+        entries (list): Entries as returned by XREADGROUP / XAUTOCLAIM.
+
+    Returns:
+        list: The decoded entries.
+    """
+    decoded = []
+    for entry_id, fields in entries:
+        message_id = (fields or {}).get(b"message_id")
+        decoded.append((entry_id, message_id.decode() if message_id else None))
+    return decoded
+
+
+def _delivery_counts(redis_conn, entry_ids):
+    """
+    Reads how often each pending entry was delivered, in one pipelined round-trip.
+
+    Args:
+        redis_conn (Redis): The raw Redis connection.
+        entry_ids (list): IDs of pending entries.
+
+    Returns:
+        list: The delivery count of each entry, 0 if it is no longer pending.
+    """
+    with redis_conn.pipeline(transaction=False) as pipe:
+        for entry_id in entry_ids:
+            pipe.xpending_range(
+                NOTIFICATION_STREAM, NOTIFICATION_GROUP, min=entry_id, max=entry_id, count=1
+            )
+        pending = pipe.execute()
+    return [info[0]["times_delivered"] if info else 0 for info in pending]
+
+
+def _claim_stale_entries(redis_conn, consumer, start_id, count):
+    """
+    Claims entries left pending by dead consumers and dead-letters the ones that keep failing.
+
+    Entries delivered more than `NOTIFICATION_MAX_DELIVERIES` times are copied
+    to `NOTIFICATION_DEAD_STREAM` and acknowledged, so a batch that always
+    fails is not replayed forever.
+
+    Args:
+        redis_conn (Redis): The raw Redis connection.
+        consumer (str): Consumer name inside the group.
+        start_id (str): Where the XAUTOCLAIM scan continues, "0-0" to start over.
+        count (int): Maximum entries claimed.
+
+    Returns:
+        tuple: `(next_start_id, entries)`; `next_start_id` is "0-0" once the
+        whole pending list was scanned.
+    """
+    claimed = redis_conn.xautoclaim(
+        NOTIFICATION_STREAM,
+        NOTIFICATION_GROUP,
+        consumer,
+        min_idle_time=NOTIFICATION_CLAIM_IDLE_MS,
+        start_id=start_id,
+        count=count,
+    )
+    next_start_id, entries = claimed[0], claimed[1]
+    if isinstance(next_start_id, bytes):
+        next_start_id = next_start_id.decode()
+    if not entries:
+        return next_start_id, []
+
+    deliveries = _delivery_counts(redis_conn, [entry_id for entry_id, _ in entries])
+    dead = [
+        (entry_id, fields)
+        for (entry_id, fields), delivered in zip(entries, deliveries)
+        if fields and delivered > NOTIFICATION_MAX_DELIVERIES
+    ]
+    if dead:
+        with redis_conn.pipeline() as pipe:
+            for entry_id, fields in dead:
+                pipe.xadd(
+                    NOTIFICATION_DEAD_STREAM,
+                    {**fields, "entry_id": entry_id},
+                    maxlen=NOTIFICATION_STREAM_MAXLEN,
+                    approximate=True,
+                )
+            pipe.xack(
+                NOTIFICATION_STREAM,
+                NOTIFICATION_GROUP,
+                *[entry_id for entry_id, _ in dead],
+            )
+            pipe.execute()
+        log.error(
+            f"Moved {len(dead)} notifications delivered more than "
+            f"{NOTIFICATION_MAX_DELIVERIES} times to {NOTIFICATION_DEAD_STREAM}"
+        )
+        dead_ids = {entry_id for entry_id, _ in dead}
+        entries = [entry for entry in entries if entry[0] not in dead_ids]
+
+    if entries:
+        log.warning(f"Replaying {len(entries)} unacknowledged notifications")
+    return next_start_id, entries
+
+
+def consume_notifications(
+    handler, consumer=None, batch_size=100, block_ms=5000, claim_every=30
+):
+    """
+    Reads the notification stream as a consumer-group member and hands batches to `handler`.
+
+    Entries are acknowledged only after `handler` returned, so a crash in the
+    middle of a batch leaves them pending; they are claimed again after
+    `NOTIFICATION_CLAIM_IDLE_MS` by any consumer of the group, until they were
+    delivered `NOTIFICATION_MAX_DELIVERIES` times (see `_claim_stale_entries`).
+
+    Args:
+        handler (callable): Called with a list of message IDs.
+        consumer (str): Consumer name inside the group, defaults to host and pid.
+        batch_size (int): Maximum entries read per round-trip.
+        block_ms (int): How long a read blocks waiting for new entries.
+        claim_every (int): Seconds between scans for entries of dead consumers.
+    """
+    consumer = consumer or default_consumer_name()
+    redis_conn = get_redis_connection("default")
+    ensure_notification_group(redis_conn)
+    log.info(f"Consuming {NOTIFICATION_STREAM} as {consumer}")
+
+    next_claim = 0
+    claim_cursor = "0-0"
+    while True:
+        entries = []
+        if time.monotonic() >= next_claim:
+            claim_cursor, entries = _claim_stale_entries(
+                redis_conn, consumer, claim_cursor, batch_size
+            )
+            # Keep scanning on the next loop until the whole pending list was covered
+            if claim_cursor == "0-0":
+                next_claim = time.monotonic() + claim_every
+
+        if not entries:
+            response = redis_conn.xreadgroup(
+                NOTIFICATION_GROUP,
+                consumer,
+                {NOTIFICATION_STREAM: ">"},
+                count=batch_size,
+                block=block_ms,
+            )
+            entries = response[0][1] if response else []
+
+        if not entries:
+            continue
+
+        decoded = _decode_entries(entries)
+        try:
+            handler([message_id for _, message_id in decoded if message_id])
+        except Exception as e:
+            # Left unacknowledged, the batch is claimed again once it is idle.
+            log.error(f"Error while dispatching notifications: {e}")
+            continue
+
+        redis_conn.xack(
+            NOTIFICATION_STREAM,
+            NOTIFICATION_GROUP,
+            *[entry_id for entry_id, _ in decoded],
+        )
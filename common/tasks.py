@@ -1,14 +1,39 @@
 import subprocess
 from celery import shared_task
-from django.core.mail import send_mail, send_mass_mail
+from django.core.mail import get_connection, send_mail, send_mass_mail
 import logging
-from django.core.cache import cache
-
 from django.conf import settings
-import requests
+from django.core.cache import cache
+from django.db import transaction
+from django_redis import get_redis_connection
+
+from common.agent_pool import AgentError, AgentTimeout, get_agent_pool
+from common.context_processor import bump_site_data_version
+from common.graph import (
+    GRAPH_BATCH_LIMIT,
+    GraphClient,
+    GraphThrottled,
+    graph_backoff,
+    resolve_immutable_ids,
+)
+from common.images import build_image_variants, delete_image_variants
+from common.locks import RedisSemaphore, SemaphoreTimeout, add_many
+from common.metrics import (
+    EMAIL_SEND_FAILURES,
+    EMAIL_SEND_LATENCY,
+    NOTIFICATION_DEDUPE,
+    RMA_EMAIL_STAGE,
+)
+from common.models import SiteMeta
 
 log = logging.getLogger("log")
 
+# Redis list of volatile message IDs waiting for batched resolution.
+PENDING_VOLATILE_IDS_KEY = "m365_pending_volatile_ids"
+RESOLVE_SCHEDULED_KEY = "m365_resolve_scheduled"
+# Redis hash of failed resolution attempts per volatile ID.
+RESOLVE_ATTEMPTS_KEY = "m365_resolve_attempts"
+
 
 # def get_immutable_id(volatile_message_id):
 #     # 1. Get an access token
@@ -33,60 +58,296 @@ log = logging.getLogger("log")
 
 
 def get_immutable_id(volatile_id):
-    """Fetch the permanent internetMessageId from Graph."""
-    token_url = f"https://login.microsoftonline.com/{settings.M65_GRP_TENANT_ID}/oauth2/v2.0/token"
-    token_data = {
-        "grant_type": "client_credentials",
-        "client_id": settings.M65_GRP_APP_ID,
-        "client_secret": settings.M65_GRP_CLIENT_SECRET,
-        "scope": "https://graph.microsoft.com/.default",
-    }
-    try:
-        token_res = requests.post(token_url, data=token_data, timeout=10).json()
-        access_token = token_res.get("access_token")
-
-        graph_url = f"https://graph.microsoft.com/v1.0/users/ehaines@edsystemsinc.com/messages/{volatile_id}?$select=internetMessageId"
-        headers = {"Authorization": f"Bearer {access_token}"}
+    """
+    Fetch the permanent internetMessageId from Graph.
 
-        response = requests.get(graph_url, headers=headers, timeout=10)
+    Raises:
+        GraphThrottled: If Graph throttled the lookup, so the caller can retry it.
+    """
+    try:
+        graph = GraphClient()
+        response = graph.get(
+            graph.user_path(f"messages/{volatile_id}"), select=["internetMessageId"]
+        )
         if response.status_code == 200:
             return response.json().get("internetMessageId")
+    except GraphThrottled:
+        raise
     except Exception as e:
-        print(f"Error fetching immutable ID: {e}")
+        log.error(f"Error fetching immutable ID: {e}")
     return None
 
 
+def agent_semaphore():
+    """
+    Returns the semaphore capping concurrent agent runs across all Celery workers.
+
+    The lease outlives the job timeout, so the slot of a worker that crashed
+    mid-run is freed automatically once the lease expires.
+
+    Returns:
+        RedisSemaphore: The agent semaphore.
+    """
+    return RedisSemaphore(
+        "agent_runs",
+        limit=settings.AGENT_MAX_CONCURRENCY,
+        lease=settings.AGENT_JOB_TIMEOUT + 60,
+    )
+
+
+def run_agent(message_id):
+    """
+    Runs the email-drafting agent for one message and logs its output.
+
+    Uses the warm worker pool of this process, or a fresh interpreter per
+    email when `AGENT_POOL_ENABLED` is off. Both honor `AGENT_JOB_TIMEOUT`.
+
+    Args:
+        message_id (str): The message ID handed to the agent as `--message_id`.
+
+    Raises:
+        AgentError: If the agent exits with an error, dies or times out.
+    """
+    if settings.AGENT_POOL_ENABLED:
+        result = get_agent_pool().run(message_id)
+    else:
+        try:
+            completed = subprocess.run(
+                [
+                    settings.AGENT_PYTHON,
+                    settings.AGENT_SCRIPT_PATH,
+                    "--message_id",
+                    message_id,
+                ],
+                cwd=settings.AGENT_WORKDIR,
+                capture_output=True,
+                text=True,
+                timeout=settings.AGENT_JOB_TIMEOUT,
+            )
+        except subprocess.TimeoutExpired as e:
+            raise AgentTimeout(str(e))
+        result = {
+            "returncode": completed.returncode,
+            "stdout": completed.stdout,
+            "stderr": completed.stderr,
+        }
+
+    if result["stdout"]:
+        log.info(f"Agent output for {message_id}:\n{result['stdout']}")
+    if result["stderr"]:
+        log.warning(f"Agent errors for {message_id}:\n{result['stderr']}")
+    if result["returncode"] != 0:
+        raise AgentError(f"Agent exited with code {result['returncode']}")
+
+
+def queue_message_id_resolution(volatile_ids):
+    """
+    Adds volatile message IDs to the pending list resolved by `resolve_pending_message_ids`.
+
+    All IDs are pushed with a single Redis call. A resolve task is scheduled only
+    if none is pending yet, so a flood of notifications is collected and resolved
+    through Graph `$batch` instead of one lookup per message.
+
+    Args:
+        volatile_ids (list): Volatile message IDs taken from the notifications.
+    """
+    if not volatile_ids:
+        return
+
+    get_redis_connection("default").rpush(PENDING_VOLATILE_IDS_KEY, *volatile_ids)
+    if cache.add(RESOLVE_SCHEDULED_KEY, True, timeout=60):
+        resolve_pending_message_ids.apply_async(countdown=1)
+
+
+def dispatch_notifications(message_ids):
+    """
+    Dedupes a batch of notifications and queues the work for the new ones.
+
+    Every new message ID, immutable or not, is queued for batched resolution
+    to its internetMessageId, the ID the agent and the `rma_done_` locks use.
+    If queueing fails, the locks taken here are released so a replay of the same
+    notifications is not mistaken for a duplicate.
+
+    Args:
+        message_ids (list): Message IDs taken from the notifications.
+    """
+    # ATOMIC LOCKS: One SET NX per message ID, all in one round-trip.
+    # Only the IDs whose lock was taken here are new.
+    locked = set(
+        add_many(
+            [f"msg_ping_lock_{message_id}" for message_id in message_ids],
+            True,
+            timeout=300,
+        )
+    )
+    new_ids = []
+    for message_id in message_ids:
+        lock_key = f"msg_ping_lock_{message_id}"
+        if lock_key in locked:
+            locked.discard(lock_key)
+            new_ids.append(message_id)
+    NOTIFICATION_DEDUPE.labels("new").inc(len(new_ids))
+    NOTIFICATION_DEDUPE.labels("duplicate").inc(len(message_ids) - len(new_ids))
+
+    try:
+        queue_message_id_resolution(new_ids)
+    except Exception:
+        cache.delete_many([f"msg_ping_lock_{message_id}" for message_id in new_ids])
+        raise
+
+
+def _count_failed_attempts(redis_conn, failed):
+    """
+    Counts one more failed resolution attempt for each ID and drops the ones over the cap.
+
+    Args:
+        redis_conn (Redis): The raw Redis connection.
+        failed (list): Volatile IDs whose resolution failed.
+
+    Returns:
+        list: The IDs that may be retried, at most `M65_GRP_MAX_RETRIES` times each.
+    """
+    with redis_conn.pipeline() as pipe:
+        for volatile_id in failed:
+            pipe.hincrby(RESOLVE_ATTEMPTS_KEY, volatile_id, 1)
+        pipe.expire(RESOLVE_ATTEMPTS_KEY, 86400)
+        attempts = pipe.execute()[:-1]
+
+    retry_ids, dropped = [], []
+    for volatile_id, attempt in zip(failed, attempts):
+        if attempt > settings.M65_GRP_MAX_RETRIES:
+            dropped.append(volatile_id)
+        else:
+            retry_ids.append(volatile_id)
+    if dropped:
+        redis_conn.hdel(RESOLVE_ATTEMPTS_KEY, *dropped)
+        log.error(
+            f"Giving up resolving {len(dropped)} message IDs after "
+            f"{settings.M65_GRP_MAX_RETRIES} retries: {dropped}"
+        )
+    return retry_ids
+
+
+@shared_task(bind=True)
+def resolve_pending_message_ids(self):
+    """
+    Drains the pending volatile IDs, resolves them in batches of 20 and queues `process_rma_email`.
+
+    IDs that failed with a transient Graph error are pushed back and the task is
+    retried with backoff, honoring Graph's `Retry-After`; each ID is retried at
+    most `M65_GRP_MAX_RETRIES` times. Draining stops at the first throttled
+    batch. IDs of messages Graph no longer has, or refuses to look up, are
+    dropped. A batch is never lost once it left the list: if resolving or
+    queueing it fails unexpectedly, the whole batch is retried.
+    """
+    # Clear the flag first, IDs pushed from now on will schedule a new run.
+    cache.delete(RESOLVE_SCHEDULED_KEY)
+
+    redis_conn = get_redis_connection("default")
+    failed = []
+    retry_after = None
+    while True:
+        with redis_conn.pipeline() as pipe:
+            pipe.lrange(PENDING_VOLATILE_IDS_KEY, 0, GRAPH_BATCH_LIMIT - 1)
+            pipe.ltrim(PENDING_VOLATILE_IDS_KEY, GRAPH_BATCH_LIMIT, -1)
+            volatile_ids, _ = pipe.execute()
+
+        if not volatile_ids:
+            break
+
+        batch = [volatile_id.decode() for volatile_id in volatile_ids]
+        try:
+            resolved, chunk_failed, throttled, retry_after = resolve_immutable_ids(batch)
+            for volatile_id, immutable_id in resolved.items():
+                if immutable_id:
+                    process_rma_email.delay(volatile_id, immutable_id=immutable_id)
+            if resolved:
+                redis_conn.hdel(RESOLVE_ATTEMPTS_KEY, *resolved)
+        except Exception as e:
+            # Duplicates of already queued emails are stopped by their rma_done lock
+            log.error(f"Error while resolving message IDs {batch}: {e}")
+            failed.extend(batch)
+            break
+        failed.extend(chunk_failed)
+        if throttled:
+            break
+
+    failed = _count_failed_attempts(redis_conn, failed) if failed else []
+    if failed:
+        countdown = graph_backoff(self.request.retries, retry_after)
+        log.warning(
+            f"Retrying resolution of {len(failed)} message IDs in {countdown} s"
+        )
+        redis_conn.rpush(PENDING_VOLATILE_IDS_KEY, *failed)
+        # Keep the flag while waiting, new IDs join this retry instead of
+        # scheduling more runs against a throttled Graph.
+        cache.set(RESOLVE_SCHEDULED_KEY, True, timeout=countdown + 60)
+        raise self.retry(countdown=countdown, max_retries=None)
+
+
 @shared_task(bind=True)
-def process_rma_email(self, volatile_id):
-    # 1. Resolve to Permanent ID
-    immutable_id = get_immutable_id(volatile_id)
+def process_rma_email(self, volatile_id, immutable_id=None):
+    # 1. Resolve to Permanent ID (internetMessageId), unless the batch resolver
+    # already did it.
+    if immutable_id is None:
+        try:
+            with RMA_EMAIL_STAGE.labels("resolve").time():
+                immutable_id = get_immutable_id(volatile_id)
+        except GraphThrottled as e:
+            # Throttled: retry with backoff instead of losing the email
+            countdown = graph_backoff(self.request.retries, e.retry_after)
+            log.warning(f"{e}, retrying {volatile_id} in {countdown} s")
+            raise self.retry(
+                exc=e, countdown=countdown, max_retries=settings.M65_GRP_MAX_RETRIES
+            )
     if not immutable_id:
         return
 
     # 2. Check if already done - DO NOT DELETE THIS LOCK
+    # The lock names the task holding it: with acks_late, a task whose worker
+    # crashed is redelivered with the same id and must take over its own lock.
+    # It outlives the wait for an agent slot plus the agent run, so it cannot
+    # expire while the draft is still being created.
     final_lock = f"rma_done_{immutable_id}"
-    if not cache.add(final_lock, "PROCESSING", timeout=600):
+    owner = f"PROCESSING:{self.request.id}"
+    lock_timeout = settings.AGENT_SLOT_WAIT + settings.AGENT_JOB_TIMEOUT + 60
+    with RMA_EMAIL_STAGE.labels("lock").time():
+        locked = add_many([final_lock], owner, timeout=lock_timeout)
+    if not locked:
         status = cache.get(final_lock)
-        print(f"Skipping {immutable_id} - Status: {status}")
-        return
+        if status != owner:
+            log.info(f"Skipping {immutable_id} - Status: {status}")
+            return
+        log.warning(f"Resuming {immutable_id} after a redelivery of task {self.request.id}")
 
     try:
-        # 3. Execute script
-        script_path = "/home/adminuser/.openclaw/workspace/build_email_agent6.py"
-        subprocess.run(
-            ["python3", script_path, "--message_id", immutable_id],
-            cwd="/home/adminuser/.openclaw/workspace",
-            check=True,
-        )
+        # 3. Execute script on a warm agent worker, within the host-wide cap
+        with agent_semaphore().hold(wait=settings.AGENT_SLOT_WAIT) as waited:
+            RMA_EMAIL_STAGE.labels("agent_slot_wait").observe(waited)
+            log.info(f"Agent slot for {immutable_id} granted after {waited:.1f} s")
+            with RMA_EMAIL_STAGE.labels("agent_run").time():
+                run_agent(immutable_id)
 
         # 4. Set PERMANENT LOCK on success
         cache.set(final_lock, "COMPLETED", timeout=86400)
-        print(f"SUCCESS: Draft created for {immutable_id}")
+        log.info(f"SUCCESS: Draft created for {immutable_id}")
+
+    except SemaphoreTimeout as e:
+        # Host is saturated: give the email back to the queue instead of dropping it
+        cache.delete(final_lock)
+        log.warning(f"{e}, retrying {immutable_id} later")
+        raise self.retry(
+            exc=e,
+            countdown=settings.AGENT_SLOT_RETRY_DELAY,
+            max_retries=None,
+            args=(volatile_id,),
+            kwargs={"immutable_id": immutable_id},
+        )
 
     except Exception as e:
         # ONLY delete if it failed, so it can try again on the next notification
         cache.delete(final_lock)
-        print(f"FAILED: {immutable_id} - Error: {e}")
+        log.error(f"FAILED: {immutable_id} - Error: {e}")
 
 
 # @shared_task(bind=True)
@@ -133,7 +394,7 @@ def process_rma_email(self, volatile_id):
 #         if result.returncode == 0:
 #             # Mark as COMPLETED permanently (24 hours)
 #             cache.set(final_lock, "COMPLETED", timeout=86400)
-#             print(f"SUCCESS: Draft created for {immutable_id}")
+#             log.info(f"SUCCESS: Draft created for {immutable_id}")
 #         else:
 #             # If the script failed, release the lock so it can be retried
 #             cache.delete(final_lock)
@@ -150,6 +411,7 @@ def send_ed_mass_email(bundle: tuple):
     Sends a mass email to multiple recipients as celery tasks.
 
     This function uses Django's `send_mass_mail` function to send multiple email in a single conenction.
+    The connection comes from `TASK_EMAIL_BACKEND` and stays open for the next task of this worker.
 
     Each email's details are provided within the `bundle` tuple.
 
@@ -164,11 +426,15 @@ def send_ed_mass_email(bundle: tuple):
 
     """
     try:
-        sta = send_mass_mail(bundle)
+        with EMAIL_SEND_LATENCY.labels("send_ed_mass_email").time():
+            sta = send_mass_mail(
+                bundle, connection=get_connection(settings.TASK_EMAIL_BACKEND)
+            )
         msg = f"Mass email send total in a conenction: {sta}"
         log.info(msg)
         return msg
     except Exception as e:
+        EMAIL_SEND_FAILURES.labels("send_ed_mass_email").inc()
         log.error(
             f"Error while sending mass mail (send_ed_mass_email) through celery queue: {e}"
         )
@@ -180,7 +446,7 @@ def send_ed_email(sub: str, msg: str, from_email: str, to_list: list):
     Sends a single email to a list of recipients as a Celery task.
 
     This fucntion uses Django's `send_email` function to send an individual email with the specified
-    subject, message and sender to a list of recipients.
+    subject, message and sender to a list of recipients, over the pooled `TASK_EMAIL_BACKEND` connection.
 
     Args:
         sub (str): Subject of the email.
@@ -195,11 +461,70 @@ def send_ed_email(sub: str, msg: str, from_email: str, to_list: list):
         Exception: If an error occurs while sending the email, logs an error message with details.
     """
     try:
-        sta = send_mail(sub, msg, from_email, to_list)
+        with EMAIL_SEND_LATENCY.labels("send_ed_email").time():
+            sta = send_mail(
+                sub,
+                msg,
+                from_email,
+                to_list,
+                connection=get_connection(settings.TASK_EMAIL_BACKEND),
+            )
         msg = f"Email send total in a conenction: {sta}"
         log.info(msg)
         return msg
     except Exception as e:
+        EMAIL_SEND_FAILURES.labels("send_ed_email").inc()
         log.error(
             f"Error while sending email (send_ed_email) through celery queue: {e}"
         )
+
+
+@shared_task
+def generate_site_meta_variants(site_id: int, field: str):
+    """
+    Generates the resized WebP, AVIF and fallback variants of a SiteMeta image as a Celery task.
+
+    Queued by `common.signals` when `logo` or `social_logo` is uploaded. The
+    variants are stored only if the image was not replaced in the meantime;
+    the variants of the previous upload are deleted and the site data
+    version is bumped, so pages pick up the new `srcset` right away.
+
+    Args:
+        site_id (int): Primary key of the SiteMeta (the Site id).
+        field (str): "logo" or "social_logo".
+
+    Returns:
+        str: A log message indicating the number of variants generated.
+
+    Raises:
+        Exception: If the image cannot be processed, logs an error message with details.
+    """
+    meta = SiteMeta.objects.filter(pk=site_id).first()
+    if meta is None or not getattr(meta, field):
+        return
+
+    name = getattr(meta, field).name
+    previous = getattr(meta, f"{field}_variants") or {}
+    if previous.get("source") == name:
+        return
+
+    try:
+        variants = build_image_variants(name, settings.SITE_META_IMAGE_WIDTHS[field])
+    except Exception as e:
+        log.error(f"Error while generating variants of {field} {name}: {e}")
+        return
+
+    updated = SiteMeta.objects.filter(pk=site_id, **{field: name}).update(
+        **{f"{field}_variants": variants}
+    )
+    if not updated:
+        # Replaced by a newer upload, whose own task generates its variants
+        delete_image_variants(variants)
+        return
+
+    delete_image_variants(previous)
+    transaction.on_commit(bump_site_data_version)
+    msg = f"Generated {len(variants['files'])} variants of {field} {name}"
+    log.info(msg)
+    return msg
+
@@ -1,3 +1,1023 @@
-from django.test import TestCase
+import io
+import json
+import os
+import smtplib
+import sys
+import tempfile
+import textwrap
+import time
+from email.utils import formatdate
+from unittest import mock
 
-# Create your tests here.
+import fakeredis
+import redis
+import requests
+from celery.exceptions import Retry
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.mail import EmailMessage
+from django.template import engines
+from django.test import (
+    AsyncRequestFactory,
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    override_settings,
+)
+from django_redis import get_redis_connection
+from fakeredis import FakeConnection
+from PIL import Image
+
+from common import assets, context_processor, graph, mail, streams, tasks
+from common.agent_pool import AgentPool, AgentTimeout
+from common.images import build_image_variants, largest_variant, srcset
+from common.locks import (
+    RateLimited,
+    RedisSemaphore,
+    RedisTokenBucket,
+    SemaphoreTimeout,
+    add_many,
+)
+from common.models import SiteMeta
+from common.tasks import process_rma_email
+from common.views import metrics_view, ms_graph_webhook_async
+
+# django-redis backed by an in-process fakeredis server (with Lua support), so
+# the scripts run as they do against Redis without a server.
+FAKE_REDIS_CACHES = {
+    alias: {
+        "BACKEND": "django_redis.cache.RedisCache",
+        "LOCATION": "redis://fake-redis:6379/0",
+        "OPTIONS": {"CONNECTION_POOL_KWARGS": {"connection_class": FakeConnection}},
+    }
+    for alias in ("default", "template_fragments")
+}
+
+
+class FakeRedisTestMixin:
+    """
+    Runs each test against an empty fakeredis server.
+    """
+
+    def setUp(self):
+        super().setUp()
+        fake_caches = self.settings(CACHES=FAKE_REDIS_CACHES)
+        fake_caches.enable()
+        self.addCleanup(fake_caches.disable)
+        get_redis_connection("default").flushall()
+
+
+class AddManyTests(FakeRedisTestMixin, SimpleTestCase):
+    def test_sets_only_missing_keys(self):
+        self.assertEqual(add_many(["a", "b"]), ["a", "b"])
+        self.assertEqual(add_many(["b", "c"]), ["c"])
+
+
+class RedisSemaphoreTests(FakeRedisTestMixin, SimpleTestCase):
+    def test_caps_concurrent_holders(self):
+        semaphore = RedisSemaphore("test", limit=2, lease=60)
+        semaphore.acquire(wait=0)
+        semaphore.acquire(wait=0)
+
+        with self.assertRaises(SemaphoreTimeout):
+            semaphore.acquire(wait=0)
+
+    def test_release_frees_a_slot(self):
+        semaphore = RedisSemaphore("test", limit=1, lease=60)
+        token, _ = semaphore.acquire(wait=0)
+        semaphore.release(token)
+
+        semaphore.acquire(wait=0)
+
+    def test_hold_releases_on_error(self):
+        semaphore = RedisSemaphore("test", limit=1, lease=60)
+        with self.assertRaises(ValueError):
+            with semaphore.hold(wait=0):
+                raise ValueError
+
+        with semaphore.hold(wait=0):
+            pass
+
+    def test_expired_lease_is_swept(self):
+        # The holder "crashed" without releasing, its lease expires
+        semaphore = RedisSemaphore("test", limit=1, lease=0.2)
+        semaphore.acquire(wait=0)
+        time.sleep(0.3)
+
+        semaphore.acquire(wait=0)
+
+    def test_waits_for_a_slot(self):
+        semaphore = RedisSemaphore("test", limit=1, lease=0.2)
+        semaphore.acquire(wait=0)
+
+        _, waited = semaphore.acquire(wait=2, poll=0.05)
+        self.assertGreater(waited, 0)
+
+
+class RedisTokenBucketTests(FakeRedisTestMixin, SimpleTestCase):
+    def test_serves_the_burst_then_limits(self):
+        bucket = RedisTokenBucket("test", rate=1, capacity=2)
+        bucket.acquire()
+        bucket.acquire()
+
+        with self.assertRaises(RateLimited) as raised:
+            bucket.acquire(wait=0)
+        self.assertGreater(raised.exception.retry_after, 0)
+        self.assertLessEqual(raised.exception.retry_after, 1)
+
+    def test_batch_cost_is_taken_at_once(self):
+        bucket = RedisTokenBucket("test", rate=1, capacity=20)
+        bucket.acquire(cost=20)
+
+        with self.assertRaises(RateLimited):
+            bucket.acquire(wait=0)
+
+    def test_cost_is_capped_at_the_capacity(self):
+        bucket = RedisTokenBucket("test", rate=1, capacity=2)
+        bucket.acquire(cost=5)
+
+    def test_refills_over_time(self):
+        bucket = RedisTokenBucket("test", rate=20, capacity=1)
+        bucket.acquire()
+
+        started = time.monotonic()
+        bucket.acquire(wait=1)
+        self.assertGreater(time.monotonic() - started, 0)
+
+    def test_buckets_share_tokens_through_redis(self):
+        # Two workers, one budget
+        RedisTokenBucket("test", rate=1, capacity=1).acquire()
+
+        with self.assertRaises(RateLimited):
+            RedisTokenBucket("test", rate=1, capacity=1).acquire(wait=0)
+
+
+@override_settings(AGENT_SLOT_WAIT=120, AGENT_JOB_TIMEOUT=600, AGENT_MAX_CONCURRENCY=1)
+class ProcessRmaEmailLockTests(FakeRedisTestMixin, SimpleTestCase):
+    def test_done_lock_outlives_the_slot_wait_and_the_agent_run(self):
+        lock_key = cache.make_key("rma_done_<id@example.com>")
+        ttls = []
+
+        def run_agent(message_id):
+            ttls.append(get_redis_connection("default").ttl(lock_key))
+
+        with mock.patch("common.tasks.run_agent", side_effect=run_agent):
+            process_rma_email("volatile", immutable_id="<id@example.com>")
+
+        self.assertGreater(ttls[0], 120 + 600)
+        self.assertEqual(cache.get("rma_done_<id@example.com>"), "COMPLETED")
+
+
+class MetricsViewTests(SimpleTestCase):
+    def scrape(self, **headers):
+        request = RequestFactory().get("/metrics/", REMOTE_ADDR="127.0.0.1", headers=headers)
+        return metrics_view(request)
+
+    @override_settings(METRICS_BEARER_TOKEN="s3cret")
+    def test_requires_the_bearer_token_even_from_localhost(self):
+        self.assertEqual(self.scrape().status_code, 403)
+        self.assertEqual(self.scrape(Authorization="Bearer wrong").status_code, 403)
+
+        response = self.scrape(Authorization="Bearer s3cret")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"ed_webhook_notifications_total", response.content)
+
+    @override_settings(METRICS_BEARER_TOKEN="")
+    def test_is_closed_without_a_configured_token(self):
+        self.assertEqual(self.scrape(Authorization="Bearer ").status_code, 403)
+
+
+class GraphTokenTests(FakeRedisTestMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        # Every test starts as a fresh process without a token in memory
+        local_token = mock.patch.object(graph, "_local_token", {})
+        local_token.start()
+        self.addCleanup(local_token.stop)
+        self.fetched = []
+        fetch = mock.patch.object(graph, "_fetch_graph_token", side_effect=self.fetch_token)
+        fetch.start()
+        self.addCleanup(fetch.stop)
+
+    def fetch_token(self, expires_in=3600):
+        token = {
+            "access_token": f"token-{len(self.fetched) + 1}",
+            "expires_at": time.time() + expires_in,
+        }
+        self.fetched.append(token)
+        return token
+
+    def test_workers_share_one_token(self):
+        self.assertEqual(graph.get_graph_token(), "token-1")
+        # Another process, with nothing in memory, reads it from Redis
+        graph._local_token = {}
+
+        self.assertEqual(graph.get_graph_token(), "token-1")
+        self.assertEqual(len(self.fetched), 1)
+
+    def test_token_is_refreshed_before_it_expires(self):
+        cache.set(
+            graph.GRAPH_TOKEN_CACHE_KEY,
+            {
+                "access_token": "expiring",
+                "expires_at": time.time() + graph.GRAPH_TOKEN_REFRESH_MARGIN - 1,
+            },
+        )
+
+        self.assertEqual(graph.get_graph_token(), "token-1")
+        self.assertEqual(cache.get(graph.GRAPH_TOKEN_CACHE_KEY)["access_token"], "token-1")
+
+    def test_forced_refresh_replaces_a_revoked_token_once(self):
+        graph.get_graph_token()
+
+        self.assertEqual(graph.get_graph_token(force_refresh=True), "token-2")
+        # A second worker rejected by the same token reuses the new one
+        graph._local_token = self.fetched[0]
+        self.assertEqual(graph.get_graph_token(force_refresh=True), "token-2")
+        self.assertEqual(len(self.fetched), 2)
+
+
+def graph_response(status, body=None, headers=None):
+    """
+    Builds a Microsoft Graph HTTP response.
+
+    Args:
+        status (int): The status code.
+        body (dict): The JSON body.
+        headers (dict): The response headers.
+
+    Returns:
+        requests.Response: The response.
+    """
+    response = requests.Response()
+    response.status_code = status
+    response._content = json.dumps(body or {}).encode()
+    response.headers.update(headers or {})
+    return response
+
+
+class GraphClientTests(SimpleTestCase):
+    def setUp(self):
+        self.session = mock.Mock()
+        for target, value in (
+            ("get_graph_session", self.session),
+            ("get_graph_rate_limiter", mock.Mock()),
+        ):
+            patcher = mock.patch.object(graph, target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        token = mock.patch.object(graph, "get_graph_token", side_effect=self.token)
+        self.get_graph_token = token.start()
+        self.addCleanup(token.stop)
+
+    def token(self, force_refresh=False):
+        return "fresh" if force_refresh else "cached"
+
+    def test_sends_the_shared_token_and_select(self):
+        self.session.request.return_value = graph_response(200, {"internetMessageId": "<a>"})
+
+        client = graph.GraphClient(user_email="box@example.com")
+        response = client.get(client.user_path("messages/1"), select=["internetMessageId"])
+
+        self.assertEqual(response.json(), {"internetMessageId": "<a>"})
+        method, url = self.session.request.call_args.args
+        kwargs = self.session.request.call_args.kwargs
+        self.assertEqual(url, f"{graph.GRAPH_BASE_URL}/users/box@example.com/messages/1")
+        self.assertEqual(kwargs["params"], {"$select": "internetMessageId"})
+        self.assertEqual(kwargs["headers"]["Authorization"], "Bearer cached")
+
+    def test_retries_once_with_a_fresh_token_after_401(self):
+        self.session.request.side_effect = [graph_response(401), graph_response(200)]
+
+        response = graph.GraphClient().get("subscriptions")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self.session.request.call_args.kwargs["headers"]["Authorization"], "Bearer fresh"
+        )
+
+    def test_429_raises_graph_throttled_with_its_retry_after(self):
+        self.session.request.return_value = graph_response(429, headers={"Retry-After": "30"})
+
+        with self.assertRaises(graph.GraphThrottled) as raised:
+            graph.GraphClient().get("subscriptions")
+
+        self.assertEqual(raised.exception.retry_after, 30)
+
+    def test_exhausted_rate_limit_raises_graph_throttled(self):
+        graph.get_graph_rate_limiter().acquire.side_effect = RateLimited("empty", 2.5)
+
+        with self.assertRaises(graph.GraphThrottled) as raised:
+            graph.GraphClient().get("subscriptions")
+
+        self.assertEqual(raised.exception.retry_after, 2.5)
+        self.session.request.assert_not_called()
+
+
+class RetryAfterTests(SimpleTestCase):
+    def test_parses_seconds_and_http_dates(self):
+        self.assertEqual(graph.parse_retry_after("7"), 7)
+        self.assertEqual(graph.parse_retry_after("-3"), 0)
+        self.assertAlmostEqual(
+            graph.parse_retry_after(formatdate(time.time() + 30, usegmt=True)), 30, delta=2
+        )
+        self.assertIsNone(graph.parse_retry_after(None))
+        self.assertIsNone(graph.parse_retry_after("soon"))
+
+    @override_settings(M65_GRP_RETRY_BASE_DELAY=5, M65_GRP_RETRY_MAX_DELAY=600)
+    def test_backoff_grows_but_never_undercuts_retry_after(self):
+        self.assertTrue(3 <= graph.graph_backoff(0) <= 6)
+        self.assertTrue(301 <= graph.graph_backoff(10) <= 601)
+        self.assertEqual(graph.graph_backoff(0, retry_after=120), 121)
+
+
+class GraphSessionTests(SimpleTestCase):
+    @mock.patch.object(graph, "_sessions", {})
+    def test_one_pooled_session_per_process(self):
+        session = graph.get_graph_session()
+        self.assertIs(graph.get_graph_session(), session)
+
+        # A forked child builds its own instead of sharing the parent's sockets
+        with mock.patch("common.graph.os.getpid", return_value=os.getpid() + 1):
+            self.assertIsNot(graph.get_graph_session(), session)
+
+
+def batch_answer(statuses, headers=None):
+    """
+    Builds a fake `GraphClient.post` answering `$batch` calls.
+
+    Args:
+        statuses (dict): Status of each volatile ID, 200 when missing; None leaves it unanswered.
+        headers (dict): Response headers of each volatile ID's item.
+
+    Returns:
+        callable: The fake `post`.
+    """
+
+    def post(path, json=None, cost=1):
+        responses = []
+        for item in json["requests"]:
+            volatile_id = item["url"].split("/messages/")[1].split("?")[0]
+            status = statuses.get(volatile_id, 200)
+            if status is None:
+                continue
+            body = {"internetMessageId": f"<{volatile_id}>"} if status == 200 else {}
+            responses.append(
+                {
+                    "id": item["id"],
+                    "status": status,
+                    "headers": (headers or {}).get(volatile_id, {}),
+                    "body": body,
+                }
+            )
+        return graph_response(200, {"responses": responses})
+
+    return post
+
+
+class ResolveImmutableIdsTests(SimpleTestCase):
+    def setUp(self):
+        self.client = graph.GraphClient(user_email="box@example.com")
+
+    def test_resolves_in_batches_of_20(self):
+        volatile_ids = [f"id{index}" for index in range(45)]
+        self.client.post = mock.Mock(side_effect=batch_answer({}))
+
+        resolved, failed, throttled, _ = graph.resolve_immutable_ids(volatile_ids, self.client)
+
+        self.assertEqual(
+            [call.kwargs["cost"] for call in self.client.post.call_args_list], [20, 20, 5]
+        )
+        self.assertEqual(resolved, {value: f"<{value}>" for value in volatile_ids})
+        self.assertEqual((failed, throttled), ([], False))
+
+    def test_each_item_succeeds_or_fails_on_its_own(self):
+        self.client.post = mock.Mock(
+            side_effect=batch_answer({"gone": 404, "denied": 403, "broken": 500, "lost": None})
+        )
+
+        resolved, failed, throttled, _ = graph.resolve_immutable_ids(
+            ["ok", "gone", "denied", "broken", "lost"], self.client
+        )
+
+        self.assertEqual(resolved, {"ok": "<ok>", "gone": None, "denied": None})
+        self.assertEqual(sorted(failed), ["broken", "lost"])
+        self.assertFalse(throttled)
+
+    def test_unreadable_answer_fails_the_whole_chunk(self):
+        response = graph_response(200)
+        response._content = b"<html>"
+        self.client.post = mock.Mock(return_value=response)
+
+        resolved, failed, _, _ = graph.resolve_immutable_ids(["a", "b"], self.client)
+
+        self.assertEqual((resolved, failed), ({}, ["a", "b"]))
+
+    def test_throttled_batch_keeps_the_remaining_chunks_for_later(self):
+        volatile_ids = [f"id{index}" for index in range(45)]
+        self.client.post = mock.Mock(side_effect=graph.GraphThrottled("429", retry_after=30))
+
+        resolved, failed, throttled, retry_after = graph.resolve_immutable_ids(
+            volatile_ids, self.client
+        )
+
+        self.client.post.assert_called_once()
+        self.assertEqual((resolved, failed), ({}, volatile_ids))
+        self.assertEqual((throttled, retry_after), (True, 30))
+
+    def test_longest_item_retry_after_is_kept(self):
+        self.client.post = mock.Mock(
+            side_effect=batch_answer(
+                {"a": 429, "b": 503},
+                headers={"a": {"Retry-After": "5"}, "b": {"Retry-After": "12"}},
+            )
+        )
+
+        resolved, failed, throttled, retry_after = graph.resolve_immutable_ids(
+            ["ok", "a", "b"], self.client
+        )
+
+        self.assertEqual((resolved, failed), ({"ok": "<ok>"}, ["a", "b"]))
+        self.assertEqual((throttled, retry_after), (True, 12))
+
+
+class ResolvePendingMessageIdsTests(FakeRedisTestMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.redis = get_redis_connection("default")
+        for patcher in (
+            mock.patch.object(tasks.resolve_pending_message_ids, "apply_async"),
+            mock.patch.object(tasks.resolve_pending_message_ids, "retry", side_effect=Retry()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        delay = mock.patch.object(tasks.process_rma_email, "delay")
+        self.delay = delay.start()
+        self.addCleanup(delay.stop)
+
+    def run_task(self, outcome):
+        with mock.patch.object(tasks, "resolve_immutable_ids", side_effect=outcome):
+            try:
+                tasks.resolve_pending_message_ids()
+            except Retry:
+                return True
+        return False
+
+    def pending(self):
+        return [
+            value.decode()
+            for value in self.redis.lrange(tasks.PENDING_VOLATILE_IDS_KEY, 0, -1)
+        ]
+
+    def test_queues_resolved_ids_and_pushes_back_the_failed_ones(self):
+        tasks.queue_message_id_resolution(["a", "b", "c"])
+
+        retried = self.run_task(lambda batch: ({"a": "<a>", "b": None}, ["c"], False, None))
+
+        self.assertTrue(retried)
+        self.delay.assert_called_once_with("a", immutable_id="<a>")
+        self.assertEqual(self.pending(), ["c"])
+        self.assertEqual(self.redis.hget(tasks.RESOLVE_ATTEMPTS_KEY, "c"), b"1")
+
+    def test_a_batch_that_fails_unexpectedly_is_not_lost(self):
+        self.redis.rpush(tasks.PENDING_VOLATILE_IDS_KEY, "a", "b")
+
+        retried = self.run_task(ValueError("unreadable"))
+
+        self.assertTrue(retried)
+        self.assertEqual(self.pending(), ["a", "b"])
+
+    def test_throttled_retry_waits_at_least_retry_after(self):
+        self.redis.rpush(tasks.PENDING_VOLATILE_IDS_KEY, "a")
+
+        self.assertTrue(self.run_task(lambda batch: ({}, ["a"], True, 300)))
+
+        countdown = tasks.resolve_pending_message_ids.retry.call_args.kwargs["countdown"]
+        self.assertGreaterEqual(countdown, 300)
+
+    @override_settings(M65_GRP_MAX_RETRIES=1)
+    def test_gives_up_after_the_retry_cap(self):
+        self.redis.rpush(tasks.PENDING_VOLATILE_IDS_KEY, "c")
+
+        def failing(batch):
+            return {}, list(batch), False, None
+
+        self.assertTrue(self.run_task(failing))
+        self.assertFalse(self.run_task(failing))
+        self.assertEqual(self.pending(), [])
+        self.assertFalse(self.redis.hexists(tasks.RESOLVE_ATTEMPTS_KEY, "c"))
+
+
+class NotificationStreamTests(FakeRedisTestMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.redis = get_redis_connection("default")
+        streams.ensure_notification_group(self.redis)
+
+    def append(self, *message_ids):
+        streams.append_notifications(
+            [{"resourceData": {"id": message_id}} for message_id in message_ids]
+        )
+
+    def read_as(self, consumer):
+        return self.redis.xreadgroup(
+            streams.NOTIFICATION_GROUP, consumer, {streams.NOTIFICATION_STREAM: ">"}
+        )[0][1]
+
+    def consume_one_batch(self, handler):
+        # xack ends the loop, right after the batch was acknowledged; fakeredis
+        # never wakes up a blocking XREADGROUP, so the read does not block
+        xack = redis.Redis.xack
+
+        def ack_and_stop(conn, *args):
+            xack(conn, *args)
+            raise KeyboardInterrupt
+
+        with mock.patch.object(redis.Redis, "xack", ack_and_stop):
+            with self.assertRaises(KeyboardInterrupt):
+                streams.consume_notifications(handler, consumer="live", block_ms=None)
+
+    def test_appends_one_entry_per_message(self):
+        self.append("a", "b")
+        streams.append_notifications([{"resourceData": {}}])
+
+        entries = self.redis.xrange(streams.NOTIFICATION_STREAM)
+        self.assertEqual(
+            [fields for _, fields in entries], [{b"message_id": b"a"}, {b"message_id": b"b"}]
+        )
+
+    def test_batch_is_acknowledged_after_the_handler_returned(self):
+        self.append("a", "b")
+        handler = mock.Mock()
+
+        self.consume_one_batch(handler)
+
+        handler.assert_called_once_with(["a", "b"])
+        pending = self.redis.xpending(streams.NOTIFICATION_STREAM, streams.NOTIFICATION_GROUP)
+        self.assertEqual(pending["pending"], 0)
+
+    # fakeredis does not count deliveries, so XPENDING's counts are stubbed
+    @mock.patch.object(streams, "NOTIFICATION_CLAIM_IDLE_MS", 0)
+    @mock.patch.object(streams, "_delivery_counts", return_value=[2])
+    def test_entries_of_a_dead_consumer_are_replayed(self, _):
+        self.append("a")
+        self.read_as("dead")
+
+        _, entries = streams._claim_stale_entries(self.redis, "live", "0-0", 10)
+
+        self.assertEqual(
+            [message_id for _, message_id in streams._decode_entries(entries)], ["a"]
+        )
+
+    @mock.patch.object(streams, "NOTIFICATION_CLAIM_IDLE_MS", 0)
+    def test_poison_entries_are_dead_lettered(self):
+        self.append("poison")
+        self.read_as("dead")
+        deliveries = [streams.NOTIFICATION_MAX_DELIVERIES + 1]
+
+        with mock.patch.object(streams, "_delivery_counts", return_value=deliveries):
+            _, entries = streams._claim_stale_entries(self.redis, "live", "0-0", 10)
+
+        self.assertEqual(entries, [])
+        dead = self.redis.xrange(streams.NOTIFICATION_DEAD_STREAM)
+        self.assertEqual(dead[0][1][b"message_id"], b"poison")
+        pending = self.redis.xpending(streams.NOTIFICATION_STREAM, streams.NOTIFICATION_GROUP)
+        self.assertEqual(pending["pending"], 0)
+
+
+class AsyncIngressTests(FakeRedisTestMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.async_redis = fakeredis.aioredis.FakeRedis()
+        patcher = mock.patch.object(
+            streams, "get_async_redis", return_value=self.async_redis
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def payload(self, *message_ids):
+        notifications = [{"resourceData": {"id": message_id}} for message_id in message_ids]
+        return {"value": notifications}
+
+    async def async_entries(self):
+        entries = await self.async_redis.xrange(streams.NOTIFICATION_STREAM)
+        return [fields[b"message_id"] for _, fields in entries]
+
+    async def test_redelivered_pings_are_appended_once(self):
+        notifications = self.payload("a", "a", "b")["value"]
+
+        self.assertEqual(await streams.aappend_notifications(notifications), 2)
+        self.assertEqual(await streams.aappend_notifications(notifications), 0)
+        self.assertEqual(await self.async_entries(), [b"a", b"b"])
+
+    async def test_asgi_request_appends_through_the_async_client(self):
+        request = AsyncRequestFactory().post(
+            "/webhook/", self.payload("a"), content_type="application/json"
+        )
+
+        response = await ms_graph_webhook_async(request)
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(await self.async_entries(), [b"a"])
+
+    async def test_wsgi_request_falls_back_to_the_sync_client(self):
+        request = RequestFactory().post(
+            "/webhook/", self.payload("a"), content_type="application/json"
+        )
+
+        response = await ms_graph_webhook_async(request)
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(await self.async_entries(), [])
+        entries = get_redis_connection("default").xrange(streams.NOTIFICATION_STREAM)
+        self.assertEqual([fields[b"message_id"] for _, fields in entries], [b"a"])
+
+
+class DispatchNotificationsTests(FakeRedisTestMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.redis = get_redis_connection("default")
+        apply_async = mock.patch.object(tasks.resolve_pending_message_ids, "apply_async")
+        self.apply_async = apply_async.start()
+        self.addCleanup(apply_async.stop)
+
+    def pending(self):
+        return [
+            value.decode()
+            for value in self.redis.lrange(tasks.PENDING_VOLATILE_IDS_KEY, 0, -1)
+        ]
+
+    def test_queues_each_new_message_once(self):
+        tasks.dispatch_notifications(["a", "a", "b"])
+        tasks.dispatch_notifications(["b", "c"])
+
+        self.assertEqual(self.pending(), ["a", "b", "c"])
+        self.apply_async.assert_called_once_with(countdown=1)
+
+    def test_releases_the_locks_when_queueing_fails(self):
+        with mock.patch.object(
+            tasks, "queue_message_id_resolution", side_effect=ConnectionError
+        ):
+            with self.assertRaises(ConnectionError):
+                tasks.dispatch_notifications(["a"])
+
+        tasks.dispatch_notifications(["a"])
+
+        self.assertEqual(self.pending(), ["a"])
+
+
+# Stands in for the email agent: imports a sibling module named like one of
+# `common`'s, and answers with what it saw.
+FAKE_AGENT = """
+import os
+import sys
+import time
+
+import graph
+
+
+def main():
+    message_id = sys.argv[2]
+    if message_id == "hang":
+        time.sleep(2)
+    if message_id == "fail":
+        sys.exit(3)
+    print(graph.ORIGIN, message_id, os.getpid())
+"""
+
+
+class AgentPoolTests(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        script_path = os.path.join(workdir.name, "agent.py")
+        with open(script_path, "w") as f:
+            f.write(textwrap.dedent(FAKE_AGENT))
+        with open(os.path.join(workdir.name, "graph.py"), "w") as f:
+            f.write('ORIGIN = "agent"\n')
+
+        agent_settings = self.settings(
+            AGENT_PYTHON=sys.executable,
+            AGENT_SCRIPT_PATH=script_path,
+            AGENT_WORKDIR=workdir.name,
+        )
+        agent_settings.enable()
+        self.addCleanup(agent_settings.disable)
+
+        self.pool = AgentPool(size=1, timeout=5, max_jobs=2)
+        self.addCleanup(self.pool.close)
+
+    def run_job(self, message_id):
+        result = self.pool.run(message_id)
+        origin, answered_id, pid = result["stdout"].split()
+        self.assertEqual((origin, answered_id), ("agent", message_id))
+        return int(pid)
+
+    def test_worker_is_reused_then_recycled(self):
+        first = self.run_job("a")
+        second = self.run_job("b")
+        third = self.run_job("c")
+
+        self.assertEqual(first, second)
+        self.assertNotEqual(second, third)
+
+    def test_exit_code_of_the_agent_is_returned(self):
+        self.assertEqual(self.pool.run("fail")["returncode"], 3)
+        self.run_job("a")
+
+    def test_job_over_the_timeout_kills_the_worker(self):
+        self.pool.timeout = 0.5
+        with self.assertRaises(AgentTimeout):
+            self.pool.run("hang")
+
+        self.pool.timeout = 5
+        self.run_job("a")
+
+
+@override_settings(
+    EMAIL_USE_TLS=False,
+    EMAIL_USE_SSL=False,
+    EMAIL_POOL_IDLE_TIMEOUT=120,
+    EMAIL_POOL_CHECK_AFTER=10,
+)
+class PooledEmailBackendTests(SimpleTestCase):
+    def setUp(self):
+        mail._idle.clear()
+        self.addCleanup(mail._idle.clear)
+        smtp = mock.patch.object(smtplib, "SMTP", side_effect=self.new_connection)
+        smtp.start()
+        self.addCleanup(smtp.stop)
+        self.connections = []
+
+    def new_connection(self, *args, **kwargs):
+        connection = mock.Mock()
+        connection.sendmail.return_value = {}
+        connection.noop.return_value = (250, b"OK")
+        self.connections.append(connection)
+        return connection
+
+    def send(self):
+        message = EmailMessage("Subject", "Body", "rma@example.com", ["customer@example.com"])
+        return mail.PooledEmailBackend().send_messages([message])
+
+    def idle_for(self, seconds):
+        connection, last_used = mail._idle[os.getpid()]
+        mail._idle[os.getpid()] = (connection, last_used - seconds)
+
+    def test_connection_is_kept_open_between_sends(self):
+        self.assertEqual(self.send(), 1)
+        self.assertEqual(self.send(), 1)
+
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(self.connections[0].sendmail.call_count, 2)
+        self.connections[0].quit.assert_not_called()
+
+    def test_connection_failing_its_health_check_is_replaced(self):
+        self.send()
+        self.idle_for(30)
+        self.connections[0].noop.return_value = (421, b"Timeout")
+
+        self.send()
+
+        self.assertEqual(len(self.connections), 2)
+        self.connections[0].quit.assert_called_once()
+        self.connections[1].sendmail.assert_called_once()
+
+    def test_long_idle_connection_is_dropped_unchecked(self):
+        self.send()
+        self.idle_for(300)
+
+        self.send()
+
+        self.connections[0].noop.assert_not_called()
+        self.assertEqual(len(self.connections), 2)
+
+    def test_dropped_connection_is_replaced_while_sending(self):
+        self.send()
+        self.connections[0].sendmail.side_effect = smtplib.SMTPServerDisconnected
+
+        self.assertEqual(self.send(), 1)
+
+        self.assertEqual(len(self.connections), 2)
+        self.connections[1].sendmail.assert_called_once()
+
+    def test_only_5xx_answers_are_permanent(self):
+        self.assertTrue(mail.is_permanent_smtp_error(smtplib.SMTPDataError(554, b"Rejected")))
+        self.assertFalse(mail.is_permanent_smtp_error(smtplib.SMTPDataError(451, b"Later")))
+        self.assertFalse(
+            mail.is_permanent_smtp_error(
+                smtplib.SMTPRecipientsRefused(
+                    {"a@example.com": (550, b"Unknown"), "b@example.com": (452, b"Full")}
+                )
+            )
+        )
+        self.assertFalse(mail.is_permanent_smtp_error(smtplib.SMTPServerDisconnected()))
+
+
+class SiteDataCacheTests(FakeRedisTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.forget_local_copy()
+
+    def forget_local_copy(self):
+        # What a freshly started process knows
+        local = mock.patch.object(
+            context_processor, "_local", {"version": None, "data": None, "checked_at": 0.0}
+        )
+        local.start()
+        self.addCleanup(local.stop)
+
+    def test_renders_within_the_check_interval_use_the_process_copy(self):
+        context_processor.site_info()
+
+        with self.assertNumQueries(0), mock.patch.object(
+            context_processor, "site_data_version"
+        ) as site_data_version:
+            context_processor.site_info()
+
+        site_data_version.assert_not_called()
+
+    def test_other_processes_read_the_data_from_redis(self):
+        context_processor.site_info()
+        self.forget_local_copy()
+
+        with self.assertNumQueries(0):
+            data = context_processor.site_info()
+
+        self.assertEqual(data["domain"], "example.com")
+
+    @override_settings(SITE_DATA_CHECK_INTERVAL=0)
+    def test_saved_site_meta_shows_up_right_away(self):
+        self.assertIsNone(context_processor.site_info()["title"])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            meta_data = SiteMeta.objects.get()
+            meta_data.title = "Returns"
+            meta_data.save()
+
+        self.assertEqual(context_processor.site_info()["title"], "Returns")
+
+    def test_callers_get_a_copy(self):
+        context_processor.site_info()["title"] = "edited"
+
+        self.assertNotEqual(context_processor.site_info()["title"], "edited")
+
+
+class StaticAssetsTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.static_dir = os.path.join(directory.name, "static")
+        self.templates_dir = os.path.join(directory.name, "templates")
+
+    def write_static(self, path, content=""):
+        path = os.path.join(self.static_dir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+    def test_relative_urls_point_to_the_same_files_from_the_bundle(self):
+        css = (
+            "a{background:url('../img/a.png?v=1#x')}"
+            "b{background:url(data:image/png;base64,AAAA)}"
+            'c{background:url("/static/c.png")}'
+        )
+
+        rebased = assets.rebase_css_urls(
+            css, "assets/bootstrap/css/bootstrap.min.css", assets.CSS_BUNDLE
+        )
+
+        self.assertIn("url('../bootstrap/img/a.png?v=1#x')", rebased)
+        self.assertIn("url(data:image/png;base64,AAAA)", rebased)
+        self.assertIn('url("/static/c.png")', rebased)
+
+    def test_minify_keeps_license_headers_only(self):
+        css = "/*! MIT License */\n\n  /* colors */\n  a { color: red; }\n\n"
+
+        self.assertEqual(assets.minify_css(css), "/*! MIT License */\na { color: red; }")
+
+    def test_scripts_cannot_merge_with_the_next_one(self):
+        self.write_static("one.js", "var a=1\n")
+        self.write_static("two.js", "(function(){})()")
+
+        bundle = assets.build_js_bundle(self.static_dir, sources=["one.js", "two.js"])
+
+        self.assertEqual(
+            bundle, "/* one.js */\nvar a=1\n;\n/* two.js */\n(function(){})()\n;\n"
+        )
+
+    @override_settings(
+        STORAGES={
+            "staticfiles": {
+                "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"
+            }
+        },
+        STATIC_URL="/static/",
+    )
+    def test_build_writes_the_bundles_and_a_loadable_preload_template(self):
+        for source in assets.CSS_SOURCES + assets.JS_SOURCES:
+            self.write_static(source, "/* source */")
+        os.makedirs(os.path.join(self.templates_dir, "includes"))
+
+        written = assets.build_static_assets(self.static_dir, self.templates_dir)
+
+        self.assertTrue(all(os.path.exists(path) for path in written))
+        with open(os.path.join(self.templates_dir, assets.PRELOAD_TEMPLATE)) as f:
+            preload = engines["django"].from_string(f.read()).render()
+        self.assertIn('href="/static/assets/css/site.bundle.css" as="style"', preload)
+        self.assertIn('href="/static/assets/js/site.bundle.js" as="script"', preload)
+
+
+def image_file(name, size, mode="RGB"):
+    """
+    Builds an uploaded image.
+
+    Args:
+        name (str): The file name, its extension picks the format.
+        size (tuple): Width and height in pixels.
+        mode (str): The Pillow image mode.
+
+    Returns:
+        ContentFile: The image file.
+    """
+    buffer = io.BytesIO()
+    Image.new(mode, size).save(buffer, "PNG" if name.endswith(".png") else "JPEG")
+    return ContentFile(buffer.getvalue(), name=name)
+
+
+@override_settings(SITE_META_IMAGE_WIDTHS={"logo": [160, 320, 480]})
+class ImageVariantsTests(FakeRedisTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_root = self.settings(MEDIA_ROOT=media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+
+    def upload_logo(self, image):
+        meta, _ = SiteMeta.objects.get_or_create(site=Site.objects.get())
+        meta.logo = image
+        meta.save()
+        return meta
+
+    def test_variants_are_capped_at_the_original_width(self):
+        name = default_storage.save("site_meta/logo.jpg", image_file("logo.jpg", (400, 200)))
+
+        variants = build_image_variants(name, [160, 320, 480])
+
+        self.assertEqual(list(variants["webp"]), ["160", "320", "400"])
+        self.assertTrue(variants["fallback"]["400"].endswith(".jpg"))
+        self.assertTrue(all(default_storage.exists(path) for path in variants["files"]))
+        with default_storage.open(variants["files"][0]) as f:
+            self.assertEqual(Image.open(f).size, (160, 80))
+
+    def test_transparent_images_fall_back_to_png(self):
+        name = default_storage.save(
+            "site_meta/logo.png", image_file("logo.png", (200, 100), mode="RGBA")
+        )
+
+        variants = build_image_variants(name, [160])
+
+        self.assertTrue(variants["fallback"]["160"].endswith(".png"))
+
+    def test_srcset_is_ordered_by_width(self):
+        variants = {"webp": {"1200": "/l.webp", "160": "/s.webp"}}
+
+        self.assertEqual(srcset(variants, "webp"), "/s.webp 160w, /l.webp 1200w")
+        self.assertEqual(largest_variant(variants, "webp"), "/l.webp")
+        self.assertIsNone(largest_variant({}, "webp"))
+
+    def test_task_replaces_the_variants_of_the_previous_upload(self):
+        meta = self.upload_logo(image_file("first.jpg", (400, 200)))
+        with self.captureOnCommitCallbacks(execute=True):
+            tasks.generate_site_meta_variants(meta.pk, "logo")
+        previous = SiteMeta.objects.get().logo_variants["files"]
+
+        meta = self.upload_logo(image_file("second.jpg", (400, 200)))
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            tasks.generate_site_meta_variants(meta.pk, "logo")
+
+        variants = SiteMeta.objects.get().logo_variants
+        self.assertEqual(variants["source"], meta.logo.name)
+        self.assertFalse(any(default_storage.exists(path) for path in previous))
+        self.assertTrue(all(default_storage.exists(path) for path in variants["files"]))
+        self.assertEqual(len(callbacks), 1)
+
+    def test_task_drops_the_variants_of_an_image_replaced_meanwhile(self):
+        meta = self.upload_logo(image_file("first.jpg", (400, 200)))
+        newer = default_storage.save("site_meta/newer.jpg", image_file("newer.jpg", (400, 200)))
+
+        def replace_upload(name, widths):
+            variants = build_image_variants(name, widths)
+            SiteMeta.objects.filter(pk=meta.pk).update(logo=newer)
+            return variants
+
+        with mock.patch.object(tasks, "build_image_variants", side_effect=replace_upload):
+            tasks.generate_site_meta_variants(meta.pk, "logo")
+
+        self.assertEqual(SiteMeta.objects.get().logo_variants, {})
+        self.assertEqual(default_storage.listdir("site_meta/variants")[1], [])
@@ -1,13 +1,21 @@
+from django.conf import settings
 from django.urls import path
 
-from rma.views import rma_request_view
-from common.views import ms_graph_webhook
+from rma.views import rma_form_view, rma_request_view
+from common.views import metrics_view, ms_graph_webhook, ms_graph_webhook_async
 
 app_name = "common"
 
 urlpatterns = [
     path("", rma_request_view, name="rma_request"),
-    path("webhooks/msgraph/", ms_graph_webhook, name="ms_graph_webhook"),
+    path("rma-form/", rma_form_view, name="rma_form"),
+    path(
+        "webhooks/msgraph/",
+        # The async view only pays off when served by an ASGI server.
+        ms_graph_webhook_async if settings.M65_GRP_ASYNC_WEBHOOK else ms_graph_webhook,
+        name="ms_graph_webhook",
+    ),
+    path("metrics/", metrics_view, name="metrics"),
 ]
 
 """
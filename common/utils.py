@@ -1,5 +1,3 @@
-from .tasks import send_ed_email, send_ed_mass_email
-from django.core.cache import cache
 from common.context_processor import site_info
 from ed import settings
 from django.template.loader import render_to_string
@@ -12,8 +10,8 @@ class SdMailService:
     """
     Service for handling email operations related to RMA (Return Merchandise Authorization).
 
-    This service manages sending emails for RMA requests and instructions,
-    using Django's email utilities and caching mechanisms.
+    This service renders the emails for RMA requests and instructions from
+    one `RmaSnapshot` per RMA; the tasks in `rma/tasks.py` send them.
     """
 
     def __init__(self):
@@ -26,80 +24,16 @@ class SdMailService:
         self.admin_list = settings.ADMIN
         self.from_email = settings.DEFAULT_FROM_EMAIL
 
-    def get_rma_from_cache(self, rma_id):
-        """
-        Retrieves an RMA request from the cache.
-
-        Args:
-            rma_id (int): The ID of the RMA request.
-
-        Returns:
-            RmaRequests: The RMA request object retrieved from the cache.
-        """
-        rma = cache.get(f"rma_{rma_id}")
-        return rma
-
-    def get_rma_email(self, rma_id):
-        """
-        Gets the email address associated with an RMA request.
-
-        Args:
-            rma_id (int): The ID of the RMA request.
-
-        Returns:
-            str: The email address associated with the RMA request.
-        """
-        return self.get_rma_from_cache(rma_id).email
-
-    def get_rma_product_sku(self, rma_id):
-        """
-        Gets the product SKU associated with an RMA request.
-
-        Args:
-            rma_id (int): The ID of the RMA request.
-
-        Returns:
-            str: The product SKU associated with the RMA request.
-        """
-        return self.get_rma_from_cache(rma_id).product_sku
-
-    def get_rma_rma_number(self, rma_id):
-        """
-        Gets the RMA number associated with an RMA request.
-
-        Args:
-            rma_id (int): The ID of the RMA request.
-
-        Returns:
-            str: The RMA number associated with the request.
-        """
-        return self.get_rma_from_cache(rma_id).rma_number
-
-    def get_rma_admin_instruction(self, rma_id):
-        """
-        Retrieves the admin instructions for an RMA request.
-
-        Args:
-            rma_id (int): The ID of the RMA request.
-
-        Returns:
-            str: The admin instructions for the RMA, with the RMA number included.
-        """
-        rma = self.get_rma_from_cache(rma_id)
-        return (rma.rma_instructions).replace("$rma_number", rma.rma_number)
-
-    def get_context(self, rma_id):
+    def build_context(self, rma):
         """
         Prepares the context data for an RMA email template.
 
         Args:
-            rma_id (int): The ID of the RMA request.
+            rma (RmaSnapshot): The RMA request snapshot (or model instance).
 
         Returns:
             dict: The context dictionary containing RMA details and site information.
         """
-        rma = self.get_rma_from_cache(rma_id) 
-
         context = {
             "rma_number": rma.rma_number,
             "customer_name": rma.customer_name,
@@ -113,80 +47,56 @@ class SdMailService:
         }
         return context
 
-    def send_rma_genaration_email(self, rma_id):
+    def rma_generation_bundle(self, rma):
         """
-        Sends RMA generation emails to the admin and the customer.
+        Renders the RMA generation emails for the admin and the customer.
 
-        Uses `send_ed_mass_email` to send multiple emails in one connection through celery.
-        Emails are sent to the addresses configured in the admin list, as well
-        as the customer who created the RMA request. Once done, the cache is cleared.
+        The context is built once and shared by both templates.
 
         Args:
-            rma_id (int): The ID of the RMA request.
-        """
-        recepients = {
-            "admin": self.admin_list,
-            "customer": [self.get_rma_email(rma_id)],
-        }
+            rma (RmaSnapshot): The newly created RMA request snapshot (or model instance).
 
-        admin_msg = render_to_string(
-            "emails/rma_request_admin_msg.txt", context=self.get_context(rma_id)
-        )
+        Returns:
+            tuple: `(subject, message, from_email, recipient_list)` tuples for `send_mass_mail`.
+        """
+        context = self.build_context(rma)
+        admin_msg = render_to_string("emails/rma_request_admin_msg.txt", context=context)
         customer_msg = render_to_string(
-            "emails/rma_genaration_customer_msg.txt", context=self.get_context(rma_id)
+            "emails/rma_genaration_customer_msg.txt", context=context
+        )
+        return (
+            (
+                f"[{self.site.get('name')}] New RMA Submitted for Product SKU #{rma.product_sku}",
+                admin_msg,
+                self.from_email,
+                self.admin_list,
+            ),
+            (
+                f"[{self.site.get('name')}] We Have Received Your RMA for Product SKU #{rma.product_sku}",
+                customer_msg,
+                self.from_email,
+                [rma.email],
+            ),
         )
 
-        email_bundle = []
-
-        try:
-            for key, email_list in recepients.items():
-                if key == "admin":
-                    email_bundle.append(
-                        (
-                            f"[{self.site.get('name')}] New RMA Submitted for Product SKU #{self.get_rma_product_sku(rma_id)}",
-                            admin_msg,
-                            self.from_email,
-                            email_list,
-                        )
-                    )
-                elif key == "customer":
-                    email_bundle.append(
-                        (
-                            f"[{self.site.get('name')}] We Have Received Your RMA for Product SKU #{self.get_rma_product_sku(rma_id)}",
-                            customer_msg,
-                            self.from_email,
-                            email_list,
-                        )
-                    )
-
-            send_ed_mass_email.delay(tuple(email_bundle))
-        except Exception as e:
-            log.error(f"Error during sending send_rma_genaration_email: {e}")
-        cache.delete(f"rma_{rma_id}")
-
-    def send_rma_instruction_to_customer(self, rma_id):
+    def rma_instruction_message(self, rma):
         """
-        Sends RMA instructions to the customer when the RMA status is updated.
-
-        Uses `send_ed_email` to send a single email to the customer with instructions through celery.
-        The cache is cleared after the operation.
+        Renders the RMA instruction email of one customer.
 
         Args:
-            rma_id (int): The ID of the RMA request.
+            rma (RmaSnapshot): The RMA request snapshot (or model instance).
+
+        Returns:
+            tuple: `(subject, message, from_email, recipient_list)` for `send_mass_mail`.
         """
-        context = self.get_context(rma_id)
-        context["admin_instruction"] = self.get_rma_admin_instruction(rma_id)
+        context = self.build_context(rma)
+        context["admin_instruction"] = rma.admin_instruction()
 
-        rma_instruction_msg = render_to_string(
-            "emails/rma_instruction_msg.txt", context
+        rma_instruction_msg = render_to_string("emails/rma_instruction_msg.txt", context)
+        return (
+            f"[{self.site.get('name')}] Instruction to Return Product with SKU #{rma.product_sku} for RMA {rma.rma_number}",
+            rma_instruction_msg,
+            self.from_email,
+            [rma.email],
         )
-        try:
-            send_ed_email.delay(
-                f"[{self.site.get('name')}] Instruction to Return Product with SKU #{self.get_rma_product_sku(rma_id)} for RMA {self.get_rma_rma_number(rma_id)}",
-                rma_instruction_msg,
-                self.from_email,
-                [self.get_rma_email(rma_id)],
-            )
-        except Exception as e:
-            log.error(f"Error during sending RMA instructions email: {e}")
-        cache.delete(f"rma_{rma_id}")
+
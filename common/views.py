@@ -1,10 +1,14 @@
-from django.http import HttpResponse
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, HttpResponseForbidden
 from django.views.decorators.csrf import csrf_exempt
+import hmac
 import json
-from common.tasks import process_rma_email
-import logging
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
-from django.core.cache import cache
+from common.metrics import WEBHOOK_LATENCY, WEBHOOK_NOTIFICATIONS, get_registry
+from common.streams import aappend_notifications, append_notifications
+import logging
 
 log = logging.getLogger("log")
 
@@ -19,18 +23,14 @@ def ms_graph_webhook(request):
     # STEP B: Process Actual Email Notification (POST)
     if request.method == "POST":
         try:
-            data = json.loads(request.body)
+            with WEBHOOK_LATENCY.labels("sync").time():
+                data = json.loads(request.body)
+                notifications = data.get("value", [])
+                WEBHOOK_NOTIFICATIONS.inc(len(notifications))
 
-            for notification in data.get("value", []):
-                resource_data = notification.get("resourceData", {})
-                volatile_id = resource_data.get("id")
-
-                if volatile_id:
-                    # ATOMIC LOCK: Try to add this volatile ID to cache.
-                    # If it returns False, we are already processing this specific ping.
-                    lock_key = f"msg_ping_lock_{volatile_id}"
-                    if cache.add(lock_key, True, timeout=300):
-                        process_rma_email.delay(volatile_id)
+                # One pipelined XADD for the whole batch, the stream consumer
+                # (consume_m365_notifications) dedupes and dispatches the work.
+                append_notifications(notifications)
 
             # ALWAYS return 202/200 immediately so Microsoft doesn't retry
             return HttpResponse(status=202)
@@ -42,6 +42,81 @@ def ms_graph_webhook(request):
     return HttpResponse(validation_token, status=400)
 
 
+async def ms_graph_webhook_async(request):
+    """
+    Async version of `ms_graph_webhook`, for deployments served over ASGI.
+
+    The validation handshake is unchanged. Notifications are deduped and
+    appended to the stream through `redis.asyncio` in one round-trip, so the
+    event loop keeps accepting other POSTs while Redis answers.
+
+    Under WSGI Django runs every async view on a throwaway event loop, so a
+    `redis.asyncio` client (and its connection pool) would be built per
+    request. There the view uses the pooled sync client instead, like
+    `ms_graph_webhook`.
+
+    Args:
+        request (HttpRequest): The request sent by Microsoft Graph.
+
+    Returns:
+        HttpResponse: The validation token, 202 for notifications, or 400.
+    """
+    # STEP A: Microsoft Validation Handshake (GET)
+    validation_token = request.GET.get("validationToken")
+    if validation_token:
+        return HttpResponse(validation_token, content_type="text/plain", status=200)
+
+    # STEP B: Process Actual Email Notification (POST)
+    if request.method == "POST":
+        try:
+            with WEBHOOK_LATENCY.labels("async").time():
+                data = json.loads(request.body)
+                notifications = data.get("value", [])
+                WEBHOOK_NOTIFICATIONS.inc(len(notifications))
+                if isinstance(request, ASGIRequest):
+                    await aappend_notifications(notifications)
+                else:
+                    append_notifications(notifications)
+
+            # ALWAYS return 202/200 immediately so Microsoft doesn't retry
+            return HttpResponse(status=202)
+
+        except Exception as e:
+            log.error(f"Error in async webhook view: {e}")
+            return HttpResponse(status=200)  # Still return 200 to stop retries
+
+    return HttpResponse(validation_token, status=400)
+
+
+# csrf_exempt only learned to wrap coroutines in Django 5.0, mark it by hand.
+ms_graph_webhook_async.csrf_exempt = True
+
+
+def metrics_view(request):
+    """
+    Exposes the Prometheus metrics of the web processes.
+
+    Scrapers authenticate with `Authorization: Bearer <METRICS_BEARER_TOKEN>`.
+    The peer address is not trusted: behind the reverse proxy every request
+    comes from 127.0.0.1. Without a configured token the endpoint is closed.
+
+    Args:
+        request (HttpRequest): The scrape request.
+
+    Returns:
+        HttpResponse: The metrics in the Prometheus text format, or 403.
+    """
+    token = settings.METRICS_BEARER_TOKEN
+    scheme, _, credentials = request.headers.get("Authorization", "").partition(" ")
+    if not (
+        token
+        and scheme.lower() == "bearer"
+        and hmac.compare_digest(credentials.strip().encode(), token.encode())
+    ):
+        return HttpResponseForbidden()
+    return HttpResponse(generate_latest(get_registry()), content_type=CONTENT_TYPE_LATEST)
+
+
 # @csrf_exempt
 # def ms_graph_webhook(request):
 #     # STEP A: Microsoft Validation Handshake
@@ -3,6 +3,9 @@ ASGI config for ed project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Set ``M65_GRP_ASYNC_WEBHOOK=True`` to serve the Microsoft Graph webhook with its
+async view, e.g. ``uvicorn ed.asgi:application --workers 4``.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
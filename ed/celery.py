@@ -1,6 +1,7 @@
 from __future__ import absolute_import, unicode_literals
 import os
 from celery import Celery
+from celery.signals import worker_init, worker_process_shutdown
 
 # from celery.schedules import crontab, solar
 from datetime import timedelta
@@ -14,11 +15,80 @@ app.autodiscover_tasks()
 app.conf.task_track_started = True
 app.conf.worker_send_task_events = True
 
+
+def apply_worker_profile(profile):
+    """
+    Limits this worker to the queues of a profile from `CELERY_WORKER_PROFILES`
+    and applies its pool, concurrency, prefetch and acknowledgement settings.
+
+    Args:
+        profile (str): Name of the profile, e.g. "email" or "agent".
+    """
+    from django.conf import settings
+    from kombu import Queue
+
+    config = settings.CELERY_WORKER_PROFILES[profile]
+    app.conf.task_queues = [Queue(name) for name in config["queues"]]
+    app.conf.worker_pool = config["pool"]
+    app.conf.worker_concurrency = config["concurrency"]
+    app.conf.worker_prefetch_multiplier = config["prefetch_multiplier"]
+    app.conf.task_acks_late = config["acks_late"]
+    app.conf.task_reject_on_worker_lost = config["acks_late"]
+    if "max_tasks_per_child" in config:
+        app.conf.worker_max_tasks_per_child = config["max_tasks_per_child"]
+
+
+def consume_all_queues():
+    """
+    Makes a worker started without a profile consume every queue, like the
+    single worker service did before the queues were split.
+    """
+    from django.conf import settings
+    from kombu import Queue
+
+    names = []
+    for config in settings.CELERY_WORKER_PROFILES.values():
+        names.extend(name for name in config["queues"] if name not in names)
+    app.conf.task_queues = [Queue(name) for name in names]
+
+
+if os.environ.get("CELERY_WORKER_PROFILE"):
+    apply_worker_profile(os.environ["CELERY_WORKER_PROFILE"])
+else:
+    consume_all_queues()
+
+
+@worker_init.connect
+def start_metrics_exporter(**kwargs):
+    """
+    Serves the worker's Prometheus metrics when `METRICS_WORKER_PORT` is set.
+    """
+    from django.conf import settings
+    from common.metrics import start_worker_exporter
+
+    if settings.METRICS_WORKER_PORT:
+        start_worker_exporter(settings.METRICS_WORKER_PORT)
+
+
+@worker_process_shutdown.connect
+def clean_metrics(pid=None, **kwargs):
+    """
+    Removes the metrics of a prefork child that exited.
+    """
+    from common.metrics import mark_process_dead
+
+    mark_process_dead(pid)
+
+
 app.conf.beat_schedule = {
     "process-rma-email-every-48-hours": {
         "task": "common.tasks.process_rma_email",
         "schedule": timedelta(hours=48),  # Every 48 hours
     },
+    "relay-rma-outbox-every-minute": {
+        "task": "rma.tasks.relay_rma_outbox",
+        "schedule": timedelta(minutes=1),  # Picks up notifications whose relay kick was lost
+    },
     # 'clear-user-auth-activity-each-90-days': {
     #     'task': 'account.tasks.clear_user_auth_activity',
     #     'schedule': timedelta(days=1),  # Every 1 day, 2 hours, and 30 minutes
@@ -67,6 +67,8 @@ AUTHENTICATION_BACKENDS = ["django.contrib.auth.backends.ModelBackend"]
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
+    # Compress HTML responses, static files are precompressed by collectstatic
+    "django.middleware.gzip.GZipMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.contrib.sites.middleware.CurrentSiteMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -158,9 +160,22 @@ CACHES = {
         "OPTIONS": {
             "CLIENT_CLASS": "django_redis.client.DefaultClient",
         },
-    }
+    },
+    # Rendered layout fragments ({% cache ... using="template_fragments" %}).
+    # Kept in process memory; keys include the site data version, so edits
+    # in the admin switch to new entries without any invalidation.
+    "template_fragments": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "template_fragments",
+        "TIMEOUT": 3600,
+        "OPTIONS": {"MAX_ENTRIES": 1000},
+    },
 }
 
+# Seconds each process serves its in-memory copy of the site metadata before
+# checking the version in Redis again (see common/context_processor.py)
+SITE_DATA_CHECK_INTERVAL = env.float("SITE_DATA_CHECK_INTERVAL", default=5)
+
 
 CELERY_TIMEZONE = "UTC"
 CELERY_TASK_TRACK_STARTED = True
@@ -170,12 +185,115 @@ CELERY_CACHE_BACKEND = "default"
 CELERY_RESULT_EXTENDED = True
 
 CELERY_BROKER_URL = env("CELERY_BROKER_URL")
+
+# Queues per workload class. Short customer emails never wait behind the
+# seconds-long agent runs of process_rma_email.
+CELERY_TASK_DEFAULT_QUEUE = "default"
+CELERY_TASK_ROUTES = {
+    "common.tasks.send_ed_email": {"queue": "email"},
+    "common.tasks.send_ed_mass_email": {"queue": "email"},
+    "rma.tasks.*": {"queue": "email"},
+    "common.tasks.resolve_pending_message_ids": {"queue": "graph"},
+    "common.tasks.process_rma_email": {"queue": "agent"},
+}
+
+# Worker profiles, picked with CELERY_WORKER_PROFILE=<name> (see ed/celery.py):
+#   CELERY_WORKER_PROFILE=email celery -A ed worker -n email@%h
+#   CELERY_WORKER_PROFILE=graph celery -A ed worker -n graph@%h
+#   CELERY_WORKER_PROFILE=agent celery -A ed worker -n agent@%h
+CELERY_WORKER_PROFILES = {
+    # Fast SMTP hand-offs and anything unrouted: many slots, prefetch a few
+    "email": {
+        "queues": ["email", "default"],
+        "pool": "prefork",
+        "concurrency": 4,
+        "prefetch_multiplier": 4,
+        "acks_late": False,
+    },
+    # Graph ID resolution is I/O bound
+    "graph": {
+        "queues": ["graph"],
+        "pool": "threads",
+        "concurrency": 8,
+        "prefetch_multiplier": 2,
+        "acks_late": True,
+    },
+    # Long agent runs: one task at a time per slot, never prefetch, and
+    # acknowledge only when done so a crash hands the email to another worker
+    # (process_rma_email takes over the rma_done_ lock of its own task id)
+    "agent": {
+        "queues": ["agent"],
+        "pool": "prefork",
+        "concurrency": 2,
+        "prefetch_multiplier": 1,
+        "acks_late": True,
+        "max_tasks_per_child": 100,
+    },
+}
 CELERY_BROKER_CONNECTION_RETRY_ON_STARTUP = True
 CELERY_BEAT_SCHEDULER = "django_celery_beat.schedulers:DatabaseScheduler"
 
 M65_GRP_TENANT_ID = env("M65_GRP_TENANT_ID")
 M65_GRP_APP_ID = env("M65_GRP_APP_ID")
 M65_GRP_CLIENT_SECRET = env("M65_GRP_CLIENT_SECRET")
+# Mailbox watched by the webhook and the public endpoint Microsoft posts to
+M65_GRP_USER_EMAIL = env("M65_GRP_USER_EMAIL", default="ehaines@edsystemsinc.com")
+M65_GRP_NOTIFICATION_URL = env(
+    "M65_GRP_NOTIFICATION_URL",
+    default="https://return.edsystemsinc.com/webhooks/msgraph/",
+)
+# Register subscriptions that deliver immutable message IDs, which stay valid
+# if the message is moved before it is resolved. Set to False for volatile IDs.
+M65_GRP_IMMUTABLE_IDS = env.bool("M65_GRP_IMMUTABLE_IDS", default=True)
+# Serve the webhook with the async view. Enable when running ed.asgi (uvicorn).
+M65_GRP_ASYNC_WEBHOOK = env.bool("M65_GRP_ASYNC_WEBHOOK", default=False)
+# (connect, read) timeout in seconds for every Microsoft Graph call
+M65_GRP_TIMEOUT = (
+    env.float("M65_GRP_CONNECT_TIMEOUT", default=3.05),
+    env.float("M65_GRP_READ_TIMEOUT", default=10),
+)
+# Keep-alive connections per host in the pooled Graph session of each process
+M65_GRP_POOL_SIZE = env.int("M65_GRP_POOL_SIZE", default=10)
+# Graph calls per second shared by all workers (token bucket in Redis) and the
+# burst allowed on top. Graph allows 10000 requests per 10 minutes per mailbox.
+M65_GRP_RATE_LIMIT = env.float("M65_GRP_RATE_LIMIT", default=15)
+M65_GRP_RATE_BURST = env.int("M65_GRP_RATE_BURST", default=30)
+# Seconds a call may wait for a rate limit token before it is retried later
+M65_GRP_RATE_WAIT = env.float("M65_GRP_RATE_WAIT", default=5)
+# Backoff of throttled Graph calls (429/503): base * 2^retry with jitter, capped,
+# never shorter than Graph's Retry-After
+M65_GRP_RETRY_BASE_DELAY = env.int("M65_GRP_RETRY_BASE_DELAY", default=5)
+M65_GRP_RETRY_MAX_DELAY = env.int("M65_GRP_RETRY_MAX_DELAY", default=600)
+M65_GRP_MAX_RETRIES = env.int("M65_GRP_MAX_RETRIES", default=8)
+
+# Email-drafting agent run by process_rma_email
+AGENT_SCRIPT_PATH = env(
+    "AGENT_SCRIPT_PATH",
+    default="/home/adminuser/.openclaw/workspace/build_email_agent6.py",
+)
+AGENT_WORKDIR = env("AGENT_WORKDIR", default="/home/adminuser/.openclaw/workspace")
+AGENT_PYTHON = env("AGENT_PYTHON", default="python3")
+# Keep warm agent processes per Celery worker process instead of one interpreter per email
+AGENT_POOL_ENABLED = env.bool("AGENT_POOL_ENABLED", default=True)
+AGENT_POOL_SIZE = env.int("AGENT_POOL_SIZE", default=1)
+# Seconds a single agent run may take before its process is killed
+AGENT_JOB_TIMEOUT = env.int("AGENT_JOB_TIMEOUT", default=600)
+# Jobs a warm agent process runs before it is replaced by a fresh one
+AGENT_MAX_JOBS_PER_WORKER = env.int("AGENT_MAX_JOBS_PER_WORKER", default=50)
+# Agent runs allowed at once across all Celery workers (Redis semaphore)
+AGENT_MAX_CONCURRENCY = env.int("AGENT_MAX_CONCURRENCY", default=4)
+# Seconds a task waits for a free agent slot before it is requeued
+AGENT_SLOT_WAIT = env.int("AGENT_SLOT_WAIT", default=120)
+AGENT_SLOT_RETRY_DELAY = env.int("AGENT_SLOT_RETRY_DELAY", default=60)
+
+# Prometheus: bearer token required to scrape /metrics/ (unset = closed), and
+# the port each Celery worker serves its own metrics on (unset = no worker
+# exporter). Set PROMETHEUS_MULTIPROC_DIR in the environment when running
+# several processes.
+METRICS_BEARER_TOKEN = env("METRICS_BEARER_TOKEN", default="")
+METRICS_WORKER_PORT = env.int("METRICS_WORKER_PORT", default=None)
+# Port the consume_m365_notifications command serves its metrics on (unset = none)
+METRICS_CONSUMER_PORT = env.int("METRICS_CONSUMER_PORT", default=None)
 
 # Localization settings
 LANGUAGE_CODE = "en-us"
@@ -185,15 +303,33 @@ USE_TZ = True
 
 # Static and media files configuration
 STATIC_URL = "/static/"
-if DEBUG:
-    STATICFILES_DIRS = [
-        os.path.join(BASE_DIR, "static"),
-    ]
-else:
-    STATIC_ROOT = os.path.join(BASE_DIR, "static")
+STATICFILES_DIRS = [
+    os.path.join(BASE_DIR, "static"),
+]
+# collectstatic writes the hashed, gzip and brotli compressed files here
+STATIC_ROOT = env("STATIC_ROOT", default=os.path.join(BASE_DIR, "staticfiles"))
+
+STORAGES = {
+    "default": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+    },
+    # Hashed file names (served with far-future cache headers by WhiteNoise)
+    # and precompressed .gz/.br variants in production
+    "staticfiles": {
+        "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"
+        if DEBUG
+        else "whitenoise.storage.CompressedManifestStaticFilesStorage",
+    },
+}
 
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
+# Widths in pixels of the responsive variants generated for the SiteMeta
+# images (the header shows the logo 160px wide, social cards use 1200px)
+SITE_META_IMAGE_WIDTHS = {
+    "logo": [160, 320, 480],
+    "social_logo": [600, 1200],
+}
 
 # Set the default auto field type
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
@@ -217,6 +353,17 @@ if DEBUG:
 else:
     EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
 
+# Backend of the Celery email tasks: keeps one SMTP connection open per worker
+# process instead of a new SMTP + STARTTLS session per email
+if DEBUG:
+    TASK_EMAIL_BACKEND = "django.core.mail.backends.console.EmailBackend"
+else:
+    TASK_EMAIL_BACKEND = "common.mail.PooledEmailBackend"
+# Seconds a pooled SMTP connection may stay idle before it is dropped, and
+# idle seconds after which it is checked with a NOOP before reuse
+EMAIL_POOL_IDLE_TIMEOUT = env.int("EMAIL_POOL_IDLE_TIMEOUT", default=120)
+EMAIL_POOL_CHECK_AFTER = env.int("EMAIL_POOL_CHECK_AFTER", default=10)
+
 DEFAULT_FROM_EMAIL = env("DEFAULT_FROM_EMAIL")
 EMAIL_HOST = env("EMAIL_HOST")
 EMAIL_PORT = env("EMAIL_PORT")
@@ -256,6 +403,21 @@ RMA_STATUS = [
     ("product_received", "Product Received"),
 ]
 
+# RMA numbers each process reserves at once from the Redis counter (see
+# rma/utils.py). Unused numbers of a stopped process are skipped.
+RMA_NUMBER_BLOCK_SIZE = env.int("RMA_NUMBER_BLOCK_SIZE", default=10)
+# RMA instruction emails rendered and sent per batch by the bulk admin action
+RMA_INSTRUCTION_CHUNK_SIZE = env.int("RMA_INSTRUCTION_CHUNK_SIZE", default=100)
+# Retries of RMA emails that failed with a transient SMTP error, with a delay
+# of base * 2^retry seconds
+RMA_EMAIL_MAX_RETRIES = env.int("RMA_EMAIL_MAX_RETRIES", default=5)
+RMA_EMAIL_RETRY_BASE_DELAY = env.int("RMA_EMAIL_RETRY_BASE_DELAY", default=60)
+# RMA outbox rows locked, published and deleted per transaction by the relay
+RMA_OUTBOX_BATCH_SIZE = env.int("RMA_OUTBOX_BATCH_SIZE", default=500)
+# Seconds the rendered RMA page shell is cached (the form is loaded separately
+# by htmx). 0 disables the cache.
+RMA_PAGE_CACHE_TIMEOUT = env.int("RMA_PAGE_CACHE_TIMEOUT", default=0 if DEBUG else 600)
+
 
 # Logging configuration
 FORMATTERS = (
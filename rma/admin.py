@@ -1,8 +1,98 @@
-from django.contrib import admin
-from django.core.cache import cache
-from common.utils import SdMailService
+import re
+
+from django.contrib import admin, messages
+from django.core.paginator import Paginator
+from django.db import connection, transaction
+from django.db.models import BooleanField, Q
+from django.db.models.expressions import RawSQL
+from django.utils.functional import cached_property
+from rma.tasks import queue_rma_notifications
 from .models import *
 
+# Above this many rows the changelist shows estimated counts.
+APPROXIMATE_COUNT_THRESHOLD = 10000
+
+RMA_NUMBER_RE = re.compile(r"^(?:RMA-)?(\d+)$", re.I)
+# Characters with a meaning in MySQL boolean mode full-text queries.
+FULLTEXT_OPERATORS_RE = re.compile(r'[+\-<>()~*"@]+')
+# Words InnoDB leaves out of the FULLTEXT index: shorter than
+# innodb_ft_min_token_size (default 3), or in its default stopword list.
+# A required "+word*" on them would never match.
+FULLTEXT_MIN_TOKEN_SIZE = 3
+FULLTEXT_STOPWORDS = frozenset(
+    "a about an are as at be by com de en for from how i in is it la of on or "
+    "that the this to was what when where who will with und www".split()
+)
+
+
+def split_fulltext_words(term):
+    """
+    Splits a search term into the words the FULLTEXT index can match and the others.
+
+    Args:
+        term (str): The text typed in the search box.
+
+    Returns:
+        tuple: `(indexed, unindexed)` lists of words. The indexed words are
+        stripped of boolean mode operators.
+    """
+    indexed, unindexed = [], []
+    for word in term.split():
+        cleaned = FULLTEXT_OPERATORS_RE.sub(" ", word).split()
+        if cleaned and all(
+            len(part) >= FULLTEXT_MIN_TOKEN_SIZE and part.lower() not in FULLTEXT_STOPWORDS
+            for part in cleaned
+        ):
+            indexed.extend(cleaned)
+        else:
+            unindexed.append(word)
+    return indexed, unindexed
+
+
+class ApproximateCountPaginator(Paginator):
+    """
+    Paginator that avoids an exact `COUNT(*)` over large result sets.
+
+    The unfiltered changelist uses the row estimate MySQL keeps in
+    information_schema. Filtered results are counted up to
+    `APPROXIMATE_COUNT_THRESHOLD` rows only; beyond that the threshold is
+    reported, which still allows paging through the first pages.
+
+    `count_qualifier` is "about" or "more than" when the count is not exact,
+    and is shown in front of it by `admin/rma/rmarequests/pagination.html`.
+    """
+
+    count_qualifier = ""
+
+    @cached_property
+    def count(self):
+        """
+        Counts the objects, estimating the count of large result sets.
+
+        Returns:
+            int: The exact number of objects for small result sets, the MySQL
+            row estimate for the unfiltered table, or `APPROXIMATE_COUNT_THRESHOLD`
+            for larger filtered results.
+        """
+        query = self.object_list.query
+        if connection.vendor == "mysql" and not query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT TABLE_ROWS FROM information_schema.TABLES "
+                    "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+                    [self.object_list.model._meta.db_table],
+                )
+                row = cursor.fetchone()
+            if row and row[0] and row[0] > APPROXIMATE_COUNT_THRESHOLD:
+                self.count_qualifier = "about"
+                return row[0]
+
+        counted = self.object_list[: APPROXIMATE_COUNT_THRESHOLD + 1].count()
+        if counted > APPROXIMATE_COUNT_THRESHOLD:
+            self.count_qualifier = "more than"
+            return APPROXIMATE_COUNT_THRESHOLD
+        return counted
+
 
 class RmaRequestsAdmin(admin.ModelAdmin):
     """
@@ -21,12 +111,18 @@ class RmaRequestsAdmin(admin.ModelAdmin):
         "rma_instructions",
         "status",
     )
-    list_filter = ("status",)
-    date_hierarchy = "created_at"
+    # A created_at range filter instead of date_hierarchy, which runs extra aggregate queries
+    list_filter = ("status", "created_at")
     ordering = ("-created_at",)
     search_fields = ["rma_number", "order_ref", "product_sku", "email"]
-    search_help_text = "Search by rma_number or order_ref or product_sku or email"
+    search_help_text = (
+        "Search by rma_number, order_ref or email (exact or beginning), product_sku (beginning), "
+        "or several words of the name, email, order_ref and product_sku"
+    )
     list_per_page = 20
+    paginator = ApproximateCountPaginator
+    show_full_result_count = False
+    actions = ["send_rma_instructions_action"]
     readonly_fields = [
         "rma_number",
         "customer_name",
@@ -37,12 +133,115 @@ class RmaRequestsAdmin(admin.ModelAdmin):
         "reason_for_return",
     ]
 
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Searches with index lookups instead of `icontains` table scans.
+
+        - An RMA number (`RMA-00042` or `42`) is looked up exactly.
+        - An email address matches exactly or by its beginning.
+        - Any other single word matches order_ref exactly or by its beginning,
+          or product_sku or email by their beginning.
+        - Several words use the MySQL FULLTEXT index over customer name, email,
+          order_ref and product_sku, every word must match (as a prefix). Words
+          the index leaves out (short words and stopwords, e.g. "SO" in
+          "SO 123") must instead begin one of those fields. On other databases
+          they fall back to the default search.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+            queryset (QuerySet): The changelist queryset.
+            search_term (str): The text typed in the search box.
+
+        Returns:
+            tuple: The filtered queryset and False, as no lookup can return duplicates.
+        """
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+
+        words = term.split()
+        if len(words) > 1:
+            if connection.vendor != "mysql":
+                return super().get_search_results(request, queryset, search_term)
+            indexed, unindexed = split_fulltext_words(term)
+            if indexed:
+                match = RawSQL(
+                    "MATCH (customer_name, email, order_ref, product_sku) AGAINST (%s IN BOOLEAN MODE)",
+                    (" ".join(f"+{word}*" for word in indexed),),
+                    output_field=BooleanField(),
+                )
+                queryset = queryset.filter(match)
+            for word in unindexed:
+                queryset = queryset.filter(
+                    Q(customer_name__istartswith=word)
+                    | Q(email__istartswith=word)
+                    | Q(order_ref__istartswith=word)
+                    | Q(product_sku__istartswith=word)
+                )
+            return queryset, False
+
+        number = RMA_NUMBER_RE.match(term)
+        if number and term.upper().startswith("RMA-"):
+            return queryset.filter(rma_number=f"RMA-{int(number.group(1)):05d}"), False
+
+        if "@" in term:
+            return queryset.filter(email__istartswith=term), False
+
+        lookups = (
+            Q(order_ref__istartswith=term)
+            | Q(product_sku__istartswith=term)
+            | Q(email__istartswith=term)
+        )
+        if number:
+            lookups |= Q(rma_number=f"RMA-{int(number.group(1)):05d}")
+        return queryset.filter(lookups), False
+
+    @admin.action(description="Send RMA instructions to the selected customers")
+    def send_rma_instructions_action(self, request, queryset):
+        """
+        Marks the selected RMAs as 'rma_sent' and emails their instructions in bulk.
+
+        The status of all selected RMAs is updated with one query, in the same
+        transaction as their outbox rows; the outbox relay then publishes a
+        single `send_rma_instructions` task that sends every email in chunks
+        over one SMTP connection. RMAs that are already 'rma_sent' are skipped,
+        so their customers do not get the instructions twice; RMAs whose email
+        could not be delivered are set back to 'pending' by the task. The
+        selected rows are locked before their status is read, so concurrent
+        actions on overlapping selections never queue the same RMA twice.
+
+        Args:
+            request (HttpRequest): The HTTP request object.
+            queryset (QuerySet): The selected RMA requests.
+        """
+        selected_ids = list(queryset.values_list("id", flat=True))
+        with transaction.atomic():
+            rows = (
+                RmaRequests.objects.select_for_update()
+                .filter(pk__in=selected_ids)
+                .values_list("id", "status")
+            )
+            rma_ids = [rma_id for rma_id, status in rows if status != "rma_sent"]
+            if rma_ids:
+                RmaRequests.objects.filter(pk__in=rma_ids).update(status="rma_sent")
+                queue_rma_notifications(rma_ids, RmaOutbox.KIND_INSTRUCTION)
+        skipped = len(selected_ids) - len(rma_ids)
+
+        self.message_user(
+            request,
+            f"Sending RMA instructions to {len(rma_ids)} customers"
+            + (f", skipped {skipped} already sent" if skipped else "")
+            + ".",
+            messages.SUCCESS,
+        )
+
     def save_model(self, request, obj, form, change):
         """
         Override the save_model method to send an email when the RMA status changes.
 
-        This method checks if the RMA status is 'rma_sent' and sends an email
-        to the customer with the RMA instructions.
+        When the status is changed to 'rma_sent', the instruction email is
+        recorded in the outbox in the same transaction as the change (the admin
+        wraps `save_model` in one), and sent by the worker once committed.
 
         Args:
             request (HttpRequest): The HTTP request object.
@@ -50,16 +249,10 @@ class RmaRequestsAdmin(admin.ModelAdmin):
             form (ModelForm): The form used to edit the object.
             change (bool): True if the object is being changed, False if it is being created.
         """
-
-        mail_service = SdMailService()
-        if change:
-            rma_id = obj.id
-            # Cache the RMA request to reduce database hits.
-            cache.set(f"rma_{rma_id}", obj, timeout=900)
-            if obj.status == "rma_sent":
-                mail_service.send_rma_instruction_to_customer(rma_id)
-
         super().save_model(request, obj, form, change)
 
+        if change and obj.status == "rma_sent" and "status" in form.changed_data:
+            queue_rma_notifications([obj.id], RmaOutbox.KIND_INSTRUCTION)
+
 
 admin.site.register(RmaRequests, RmaRequestsAdmin)
@@ -1,5 +1,5 @@
 from django import forms
-from .models import RmaRequests
+from .models import RmaRequests, rma_fingerprint
 from django_recaptcha.fields import ReCaptchaField
 from django_recaptcha import widgets
 
@@ -107,7 +107,9 @@ class RmaForm(forms.ModelForm):
         Validate the form data to prevent duplicate RMA requests.
 
         This method ensures that no RMA request exists with the same
-        email, order reference, and product SKU combination.
+        email, order reference, and product SKU combination, with a single
+        probe of the unique fingerprint index. The index also rejects a
+        duplicate submitted concurrently, see `rma_request_view`.
 
         Returns:
             dict: The cleaned data.
@@ -120,11 +122,26 @@ class RmaForm(forms.ModelForm):
         order_ref = cleaned_data.get("order_ref")
         product_sku = cleaned_data.get("product_sku")
 
-        if RmaRequests.objects.filter(
-            email=email, order_ref=order_ref, product_sku=product_sku
-        ).exists():
-            raise forms.ValidationError(
-                "An RMA request already exists for this product SKU with the same email and order reference."
-            )
+        if self.is_duplicate(email, order_ref, product_sku):
+            raise forms.ValidationError(self.DUPLICATE_ERROR)
 
         return cleaned_data
+
+    DUPLICATE_ERROR = "An RMA request already exists for this product SKU with the same email and order reference."
+
+    @staticmethod
+    def is_duplicate(email, order_ref, product_sku):
+        """
+        Checks whether an RMA request with the same fingerprint exists.
+
+        Args:
+            email (str): The order email.
+            order_ref (str): The order reference.
+            product_sku (str): The product SKU.
+
+        Returns:
+            bool: True if such a request exists.
+        """
+        return RmaRequests.objects.filter(
+            fingerprint=rma_fingerprint(email, order_ref, product_sku)
+        ).exists()
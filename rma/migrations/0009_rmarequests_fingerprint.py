@@ -0,0 +1,63 @@
+import hashlib
+
+from django.db import migrations, models
+
+
+def rma_fingerprint(email, order_ref, product_sku):
+    """
+    Frozen copy of `rma.models.rma_fingerprint` as of this migration.
+
+    Kept here so that later changes to the model helper cannot break this
+    migration or make it backfill different hashes.
+    """
+    normalized = "|".join(
+        [
+            (email or "").strip().casefold(),
+            (order_ref or "").strip(),
+            "".join((product_sku or "").split()).upper(),
+        ]
+    )
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def backfill_fingerprints(apps, schema_editor):
+    """
+    Fingerprints the existing RMA requests, oldest first.
+
+    Duplicates created before the unique index existed keep a null
+    fingerprint, only the oldest request of each group gets one.
+    """
+    RmaRequests = apps.get_model("rma", "RmaRequests")
+    seen = set()
+    batch = []
+    rows = RmaRequests.objects.order_by("id").only(
+        "id", "email", "order_ref", "product_sku"
+    )
+    for rma in rows.iterator(chunk_size=1000):
+        fingerprint = rma_fingerprint(rma.email, rma.order_ref, rma.product_sku)
+        if fingerprint in seen:
+            continue
+        seen.add(fingerprint)
+        rma.fingerprint = fingerprint
+        batch.append(rma)
+        if len(batch) >= 1000:
+            RmaRequests.objects.bulk_update(batch, ["fingerprint"])
+            batch = []
+    if batch:
+        RmaRequests.objects.bulk_update(batch, ["fingerprint"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rma', '0008_alter_rmarequests_rma_instructions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rmarequests',
+            name='fingerprint',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(backfill_fingerprints, migrations.RunPython.noop),
+    ]
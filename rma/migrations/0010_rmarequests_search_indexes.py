@@ -0,0 +1,46 @@
+from django.db import migrations, models
+
+FULLTEXT_INDEX = "rma_search_ft"
+FULLTEXT_COLUMNS = "customer_name, email, order_ref, product_sku"
+
+
+def create_fulltext_index(apps, schema_editor):
+    """
+    Creates the FULLTEXT index used by the admin search for multi-word terms (MySQL only).
+    """
+    if schema_editor.connection.vendor != "mysql":
+        return
+    table = apps.get_model("rma", "RmaRequests")._meta.db_table
+    schema_editor.execute(
+        f"CREATE FULLTEXT INDEX {FULLTEXT_INDEX} ON {table} ({FULLTEXT_COLUMNS})"
+    )
+
+
+def drop_fulltext_index(apps, schema_editor):
+    """
+    Drops the FULLTEXT index of the admin search again (MySQL only).
+    """
+    if schema_editor.connection.vendor != "mysql":
+        return
+    table = apps.get_model("rma", "RmaRequests")._meta.db_table
+    schema_editor.execute(f"DROP INDEX {FULLTEXT_INDEX} ON {table}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rma', '0009_rmarequests_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='rmarequests',
+            name='product_sku',
+            field=models.CharField(db_index=True, help_text='Product SKU', max_length=150),
+        ),
+        migrations.AddIndex(
+            model_name='rmarequests',
+            index=models.Index(fields=['status', 'created_at'], name='rma_status_created_idx'),
+        ),
+        migrations.RunPython(create_fulltext_index, drop_fulltext_index),
+    ]
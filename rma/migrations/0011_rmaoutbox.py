@@ -0,0 +1,21 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rma', '0010_rmarequests_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RmaOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('generation', 'RMA generation'), ('instruction', 'RMA instruction')], max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('rma', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='rma.rmarequests')),
+            ],
+        ),
+    ]
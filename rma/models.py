@@ -1,7 +1,34 @@
+import hashlib
+
 from django.db import models
 from django.conf import settings
 
 
+def rma_fingerprint(email, order_ref, product_sku):
+    """
+    Computes the duplicate-detection fingerprint of an RMA request.
+
+    Two requests for the same product of the same order by the same customer
+    get the same fingerprint, regardless of case and surrounding whitespace.
+
+    Args:
+        email (str): The order email, compared case-insensitively.
+        order_ref (str): The order reference, compared trimmed.
+        product_sku (str): The product SKU, compared upper-cased without whitespace.
+
+    Returns:
+        str: The sha256 hex digest of the normalized values.
+    """
+    normalized = "|".join(
+        [
+            (email or "").strip().casefold(),
+            (order_ref or "").strip(),
+            "".join((product_sku or "").split()).upper(),
+        ]
+    )
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
 # Create your models here.
 class RmaRequests(models.Model):
     """
@@ -28,7 +55,7 @@ class RmaRequests(models.Model):
             This field is required and indexed for optimized lookups. It has a maximum length of 155 characters.
 
         product_sku (str): The SKU (Stock Keeping Unit) of the product being returned.
-            This field has a maximum length of 150 characters.
+            This field has a maximum length of 150 characters. Indexed for the admin prefix search.
 
         reason_for_return (str): The reason provided by the customer for returning the product.
 
@@ -43,6 +70,10 @@ class RmaRequests(models.Model):
 
         created_at (datetime): The date and time when the RMA request was created.
             Automatically set to the current date and time when the record is created.
+
+        fingerprint (str): sha256 of the normalized email, order reference and SKU, see `rma_fingerprint`.
+            Unique, so a duplicate request is rejected by the database even under concurrency.
+            Set when the request is created; null for legacy duplicates kept from before it existed.
     """
 
     RMA_STATUS = settings.RMA_STATUS
@@ -59,7 +90,7 @@ class RmaRequests(models.Model):
         help_text="Enter order reference number, it is mandatory.",
         db_index=True,
     )
-    product_sku = models.CharField(help_text="Product SKU", max_length=150)
+    product_sku = models.CharField(help_text="Product SKU", max_length=150, db_index=True)
     reason_for_return = models.TextField(help_text="Why you want to return the product")
     rma_number = models.CharField(
         max_length=20,
@@ -88,6 +119,23 @@ class RmaRequests(models.Model):
         db_index=True,
     )
     created_at = models.DateTimeField(auto_now_add=True)
+    fingerprint = models.CharField(
+        max_length=64, unique=True, null=True, blank=True, editable=False
+    )
+
+    class Meta:
+        indexes = [
+            # Admin changelist: filter by status, newest first
+            models.Index(fields=["status", "created_at"], name="rma_status_created_idx"),
+        ]
+
+    def save(self, *args, **kwargs):
+        """
+        Sets the fingerprint of a new RMA request before inserting it.
+        """
+        if self._state.adding and not self.fingerprint:
+            self.fingerprint = rma_fingerprint(self.email, self.order_ref, self.product_sku)
+        super().save(*args, **kwargs)
 
     def __str__(self):
         """
@@ -98,3 +146,44 @@ class RmaRequests(models.Model):
             str: A formatted string representing the RMA request.
         """
         return f"RMA for orde {self.order_ref} - Status {self.status} - Order Email {self.email}"
+
+
+class RmaOutbox(models.Model):
+    """
+    Email notification waiting to be handed to Celery (transactional outbox).
+
+    A row is written in the same transaction as the RMA change it notifies
+    about, so the notification exists exactly when the change was committed.
+    `rma.tasks.relay_rma_outbox` drains the table in batches, publishes one
+    email task per kind and batch, and deletes the rows it published.
+
+    Attributes:
+        KIND_GENERATION (str): RMA created, the admin and the customer are notified.
+        KIND_INSTRUCTION (str): RMA set to 'rma_sent', the customer gets the return instructions.
+
+        rma (RmaRequests): The RMA request the email is about.
+
+        kind (str): Which email to send, one of the kinds above.
+
+        created_at (datetime): When the notification was recorded.
+    """
+
+    KIND_GENERATION = "generation"
+    KIND_INSTRUCTION = "instruction"
+    KINDS = [
+        (KIND_GENERATION, "RMA generation"),
+        (KIND_INSTRUCTION, "RMA instruction"),
+    ]
+
+    rma = models.ForeignKey(RmaRequests, on_delete=models.CASCADE, related_name="+")
+    kind = models.CharField(max_length=20, choices=KINDS)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        """
+        Returns a string representation of the outbox entry.
+
+        Returns:
+            str: A formatted string with the kind and the RMA id.
+        """
+        return f"Outbox {self.kind} for RMA {self.rma_id}"
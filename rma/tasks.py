@@ -0,0 +1,298 @@
+import logging
+
+from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+
+from common.mail import is_permanent_smtp_error
+from common.metrics import EMAIL_SEND_FAILURES, EMAIL_SEND_LATENCY
+from common.utils import SdMailService
+from rma.models import RmaOutbox, RmaRequests
+from rma.utils import RmaSnapshot
+
+log = logging.getLogger("log")
+
+# Set while a relay run is scheduled, so a burst of changes schedules one run.
+RELAY_SCHEDULED_KEY = "rma_outbox_relay_scheduled"
+
+
+def send_each(messages, connection, task_name):
+    """
+    Sends RMA emails one message at a time, so one failure does not stop the rest.
+
+    Django's `send_messages` stops at the first error, which would lose every
+    following message of the batch to a single refused recipient.
+
+    Args:
+        messages (list): `(rma_id, (subject, message, from_email, recipient_list))` pairs.
+        connection: An open email backend.
+        task_name (str): Label of the failures in `EMAIL_SEND_FAILURES`.
+
+    Returns:
+        tuple: `(sent, transient, permanent)`: the number of messages sent, and
+        the sets of RMA ids with a message that failed transiently (worth a
+        retry) or permanently.
+    """
+    sent = 0
+    transient, permanent = set(), set()
+    for rma_id, (subject, body, from_email, recipient_list) in messages:
+        email = EmailMessage(subject, body, from_email, recipient_list, connection=connection)
+        try:
+            sent += connection.send_messages([email]) or 0
+        except Exception as e:
+            EMAIL_SEND_FAILURES.labels(task_name).inc()
+            (permanent if is_permanent_smtp_error(e) else transient).add(rma_id)
+            log.warning(f"Could not send '{subject}' of RMA {rma_id} to {recipient_list}: {e}")
+    return sent, transient, permanent
+
+
+def email_retry_countdown(retries):
+    """
+    Computes the delay before retrying RMA emails that failed transiently.
+
+    Args:
+        retries (int): Retries done so far, i.e. `self.request.retries` in a task.
+
+    Returns:
+        int: Seconds to wait before the next attempt.
+    """
+    return settings.RMA_EMAIL_RETRY_BASE_DELAY * 2**retries
+
+
+@shared_task(bind=True)
+def send_rma_instructions(self, rma_ids: list):
+    """
+    Renders and sends the RMA instruction emails of many RMAs as a Celery task.
+
+    Used by the "Send RMA instructions" admin action. The RMAs are loaded and
+    rendered in chunks of `RMA_INSTRUCTION_CHUNK_SIZE`, and every message is
+    sent on its own over the same SMTP connection, opened once for the whole
+    task. RMAs whose email failed transiently are retried (only those) up to
+    `RMA_EMAIL_MAX_RETRIES` times. RMAs whose email could not be delivered in
+    the end are set back from 'rma_sent' to 'pending', so staff can send the
+    instructions again.
+
+    Args:
+        rma_ids (list): IDs of the RMA requests.
+
+    Returns:
+        str: A log message indicating the number of emails sent.
+
+    Raises:
+        Retry: If some emails failed transiently and may be retried.
+    """
+    mail_service = SdMailService()
+    chunk_size = settings.RMA_INSTRUCTION_CHUNK_SIZE
+    connection = get_connection(settings.TASK_EMAIL_BACKEND)
+    sent = 0
+    transient, permanent = set(), set()
+
+    connection.open()
+    try:
+        for start in range(0, len(rma_ids), chunk_size):
+            chunk = rma_ids[start : start + chunk_size]
+            try:
+                messages = [
+                    (rma.id, mail_service.rma_instruction_message(rma))
+                    for rma in RmaSnapshot.many_from_db(chunk)
+                ]
+            except Exception as e:
+                EMAIL_SEND_FAILURES.labels("send_rma_instructions").inc()
+                log.error(
+                    f"Error while rendering RMA instructions (send_rma_instructions) for {chunk}: {e}"
+                )
+                transient.update(chunk)
+                continue
+            with EMAIL_SEND_LATENCY.labels("send_rma_instructions").time():
+                chunk_sent, chunk_transient, chunk_permanent = send_each(
+                    messages, connection, "send_rma_instructions"
+                )
+            sent += chunk_sent
+            transient |= chunk_transient
+            permanent |= chunk_permanent
+    finally:
+        connection.close()
+
+    msg = f"RMA instruction emails sent: {sent} of {len(rma_ids)}"
+    log.info(msg)
+
+    retry = transient and self.request.retries < settings.RMA_EMAIL_MAX_RETRIES
+    # Permanent failures are final even when the transient ones are retried
+    undelivered = permanent if retry else permanent | transient
+    if undelivered:
+        RmaRequests.objects.filter(pk__in=undelivered, status="rma_sent").update(
+            status="pending"
+        )
+        log.error(
+            f"RMA instructions could not be delivered for RMAs {sorted(undelivered)}, "
+            "set back to pending"
+        )
+
+    if retry:
+        countdown = email_retry_countdown(self.request.retries)
+        log.warning(f"Retrying RMA instructions of {len(transient)} RMAs in {countdown} s")
+        raise self.retry(
+            args=(sorted(transient),),
+            countdown=countdown,
+            max_retries=settings.RMA_EMAIL_MAX_RETRIES,
+        )
+    return msg
+
+
+@shared_task(bind=True)
+def send_rma_generation_emails(self, rma_ids: list):
+    """
+    Renders and sends the RMA generation emails of new RMAs as a Celery task.
+
+    Published by `relay_rma_outbox`. All RMAs are loaded with one query, the
+    admin and customer emails are rendered in the worker with one shared
+    context, and every message is sent on its own over one SMTP connection.
+    RMAs with a message that failed transiently are retried (only those) up
+    to `RMA_EMAIL_MAX_RETRIES` times; both of their emails are sent again, so
+    the admin may get a notification twice rather than a customer none.
+
+    Args:
+        rma_ids (list): IDs of the newly created RMA requests.
+
+    Returns:
+        str: A log message indicating the number of emails sent.
+
+    Raises:
+        Retry: If some emails failed transiently and may be retried.
+    """
+    mail_service = SdMailService()
+    sent = 0
+    transient, permanent = set(), set()
+    try:
+        messages = [
+            (rma.id, message)
+            for rma in RmaSnapshot.many_from_db(rma_ids)
+            for message in mail_service.rma_generation_bundle(rma)
+        ]
+    except Exception as e:
+        EMAIL_SEND_FAILURES.labels("send_rma_generation_emails").inc()
+        log.error(
+            f"Error while rendering RMA generation emails (send_rma_generation_emails) for {rma_ids}: {e}"
+        )
+        transient.update(rma_ids)
+    else:
+        connection = get_connection(settings.TASK_EMAIL_BACKEND)
+        connection.open()
+        try:
+            with EMAIL_SEND_LATENCY.labels("send_rma_generation_emails").time():
+                sent, transient, permanent = send_each(
+                    messages, connection, "send_rma_generation_emails"
+                )
+        finally:
+            connection.close()
+
+    msg = f"RMA generation emails sent: {sent} for {len(rma_ids)} RMAs"
+    log.info(msg)
+
+    retry = transient and self.request.retries < settings.RMA_EMAIL_MAX_RETRIES
+    # Permanent failures are final even when the transient ones are retried
+    undelivered = permanent if retry else permanent | transient
+    if undelivered:
+        log.error(f"RMA generation emails could not be delivered for RMAs {sorted(undelivered)}")
+
+    if retry:
+        countdown = email_retry_countdown(self.request.retries)
+        log.warning(f"Retrying RMA generation emails of {len(transient)} RMAs in {countdown} s")
+        raise self.retry(
+            args=(sorted(transient),),
+            countdown=countdown,
+            max_retries=settings.RMA_EMAIL_MAX_RETRIES,
+        )
+    return msg
+
+
+# Task publishing the emails of each outbox kind, called with a list of RMA ids.
+OUTBOX_TASKS = {
+    RmaOutbox.KIND_GENERATION: send_rma_generation_emails,
+    RmaOutbox.KIND_INSTRUCTION: send_rma_instructions,
+}
+
+
+def kick_outbox_relay():
+    """
+    Schedules a relay run shortly, unless one is already scheduled.
+
+    Called after commit. A failure to publish is only logged: the rows stay
+    in the outbox and the periodic relay run picks them up.
+    """
+    try:
+        if cache.add(RELAY_SCHEDULED_KEY, True, timeout=30):
+            relay_rma_outbox.apply_async(countdown=1)
+    except Exception as e:
+        cache.delete(RELAY_SCHEDULED_KEY)
+        log.error(f"Could not schedule the RMA outbox relay, the periodic run will: {e}")
+
+
+def queue_rma_notifications(rma_ids, kind):
+    """
+    Records email notifications in the outbox, in the caller's transaction.
+
+    Must be called inside the `transaction.atomic()` block that writes the
+    RMA change, so the notification is committed or rolled back with it. The
+    relay is kicked once the transaction commits.
+
+    Args:
+        rma_ids (list): IDs of the RMA requests.
+        kind (str): `RmaOutbox.KIND_GENERATION` or `RmaOutbox.KIND_INSTRUCTION`.
+    """
+    RmaOutbox.objects.bulk_create(
+        [RmaOutbox(rma_id=rma_id, kind=kind) for rma_id in rma_ids]
+    )
+    transaction.on_commit(kick_outbox_relay)
+
+
+@shared_task
+def relay_rma_outbox():
+    """
+    Drains the RMA outbox into the email tasks, in batches, as a Celery task.
+
+    Each batch of up to `RMA_OUTBOX_BATCH_SIZE` rows is locked with
+    `SELECT ... FOR UPDATE SKIP LOCKED`, so concurrent relays never publish
+    the same row. The rows are coalesced into one task per kind (duplicate
+    RMAs collapse) and deleted in the same transaction; if publishing fails,
+    the transaction rolls back and the rows are retried by the next run.
+    Runs shortly after every change and periodically from Celery beat.
+
+    Returns:
+        str: A log message indicating the number of notifications relayed.
+    """
+    # Clear the flag first, rows committed from now on will schedule a new run.
+    cache.delete(RELAY_SCHEDULED_KEY)
+
+    batch_size = settings.RMA_OUTBOX_BATCH_SIZE
+    relayed = 0
+    while True:
+        with transaction.atomic():
+            rows = list(
+                RmaOutbox.objects.select_for_update(skip_locked=True)
+                .order_by("id")
+                .values_list("id", "rma_id", "kind")[:batch_size]
+            )
+            if not rows:
+                break
+
+            rma_ids_by_kind = {}
+            for _, rma_id, kind in rows:
+                rma_ids = rma_ids_by_kind.setdefault(kind, [])
+                if rma_id not in rma_ids:
+                    rma_ids.append(rma_id)
+            for kind, rma_ids in rma_ids_by_kind.items():
+                OUTBOX_TASKS[kind].delay(rma_ids)
+
+            RmaOutbox.objects.filter(id__in=[row_id for row_id, _, _ in rows]).delete()
+        relayed += len(rows)
+        if len(rows) < batch_size:
+            break
+
+    msg = f"Relayed {relayed} RMA notifications"
+    if relayed:
+        log.info(msg)
+    return msg
+
@@ -1,3 +1,501 @@
-from django.test import TestCase
+import importlib
+import os
+import smtplib
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from celery.exceptions import Retry
+from django.apps import apps
+from django.contrib import admin
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail.backends import locmem
+from django.db import IntegrityError
+from django.conf import settings
+from django.test import RequestFactory, TestCase, override_settings
+from django_redis import get_redis_connection
+
+from common.context_processor import bump_site_data_version
+from common.tests import FakeRedisTestMixin
+from rma import admin as rma_admin, tasks, views as rma_views
+from rma.admin import (
+    ApproximateCountPaginator,
+    RmaRequestsAdmin,
+    split_fulltext_words,
+)
+from rma.forms import RmaForm
+from rma.models import RmaOutbox, RmaRequests, rma_fingerprint
+from rma.utils import (
+    RMA_NUMBER_KEY,
+    _block,
+    discard_rma_number_block,
+    generate_rma_number,
+)
+from rma.views import save_rma_request
+
+# Recipients the test email backend refuses, with the SMTP code it answers.
+REFUSED = {"refused@example.com": 550, "busy@example.com": 450}
+
+
+class RefusingEmailBackend(locmem.EmailBackend):
+    """
+    In-memory email backend that refuses the addresses in `REFUSED` like an SMTP server.
+    """
+
+    def send_messages(self, messages):
+        for message in messages:
+            for recipient in message.recipients():
+                if recipient in REFUSED:
+                    raise smtplib.SMTPRecipientsRefused(
+                        {recipient: (REFUSED[recipient], b"refused")}
+                    )
+        return super().send_messages(messages)
+
+
+def make_rma(number, email="customer@example.com", status="pending"):
+    """
+    Creates an RMA request with the given number.
+
+    Args:
+        number (int): The numeric part of the RMA number, also used in the order reference.
+        email (str): The customer email.
+        status (str): The RMA status.
+
+    Returns:
+        RmaRequests: The saved RMA request.
+    """
+    return RmaRequests.objects.create(
+        customer_name="Jane Doe",
+        email=email,
+        order_ref=f"ORD-{number}",
+        product_sku="SKU-1",
+        reason_for_return="Broken on arrival",
+        rma_number=f"RMA-{number:05d}",
+        status=status,
+    )
+
+
+class RmaNumberTests(FakeRedisTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        discard_rma_number_block()
+        self.addCleanup(discard_rma_number_block)
+
+    @override_settings(RMA_NUMBER_BLOCK_SIZE=3)
+    def test_numbers_come_from_blocks_of_the_shared_counter(self):
+        numbers = [generate_rma_number() for _ in range(4)]
+
+        self.assertEqual(numbers, ["RMA-00001", "RMA-00002", "RMA-00003", "RMA-00004"])
+        # Two blocks of 3 were reserved
+        counter = get_redis_connection("default").get(cache.make_key(RMA_NUMBER_KEY))
+        self.assertEqual(int(counter), 6)
+
+    @override_settings(RMA_NUMBER_BLOCK_SIZE=3)
+    def test_processes_never_share_a_block(self):
+        with mock.patch("rma.utils.os.getpid", return_value=1001):
+            first = generate_rma_number()
+        with mock.patch("rma.utils.os.getpid", return_value=1002):
+            second = generate_rma_number()
+
+        self.assertEqual(first, "RMA-00001")
+        self.assertEqual(second, "RMA-00004")
+
+    def test_first_block_starts_after_the_table_max(self):
+        make_rma(41)
+
+        self.assertEqual(generate_rma_number(), "RMA-00042")
+
+    @override_settings(RMA_NUMBER_BLOCK_SIZE=10)
+    def test_discarded_block_is_reconciled_after_a_flush(self):
+        self.assertEqual(generate_rma_number(), "RMA-00001")
+        make_rma(15)
+        get_redis_connection("default").flushall()
+
+        discard_rma_number_block()
+
+        self.assertEqual(generate_rma_number(), "RMA-00016")
+
+    @override_settings(RMA_NUMBER_BLOCK_SIZE=10)
+    def test_save_retries_a_number_taken_by_another_process(self):
+        # This process still holds numbers 2..3 from before a Redis flush,
+        # another process already used number 2.
+        make_rma(2)
+        _block.update({"pid": os.getpid(), "next": 2, "end": 3})
+        form = mock.Mock()
+        form.save.return_value = RmaRequests(
+            customer_name="John Doe",
+            email="john@example.com",
+            order_ref="ORD-100",
+            product_sku="SKU-9",
+            reason_for_return="Wrong size",
+        )
+
+        rma = save_rma_request(form)
+
+        self.assertIsNotNone(rma.pk)
+        self.assertEqual(rma.rma_number, "RMA-00003")
+        form.add_error.assert_not_called()
+        self.assertTrue(
+            RmaOutbox.objects.filter(rma=rma, kind=RmaOutbox.KIND_GENERATION).exists()
+        )
+
+
+class RmaFingerprintTests(FakeRedisTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        discard_rma_number_block()
+        self.addCleanup(discard_rma_number_block)
+
+    def unsaved_rma(self, **fields):
+        values = {
+            "customer_name": "Jane Doe",
+            "email": "customer@example.com",
+            "order_ref": "ORD-1",
+            "product_sku": "SKU-1",
+            "reason_for_return": "Broken on arrival",
+        }
+        values.update(fields)
+        return RmaRequests(**values)
+
+    def test_ignores_case_and_whitespace(self):
+        self.assertEqual(
+            rma_fingerprint(" Customer@Example.com", "ORD-1 ", "sku - 1"),
+            rma_fingerprint("customer@example.com", "ORD-1", "SKU-1"),
+        )
+        self.assertNotEqual(
+            rma_fingerprint("customer@example.com", "ORD-2", "SKU-1"),
+            rma_fingerprint("customer@example.com", "ORD-1", "SKU-1"),
+        )
+
+    def test_database_rejects_a_duplicate(self):
+        make_rma(1)
+
+        self.assertTrue(RmaForm.is_duplicate("CUSTOMER@example.com", "ORD-1", "sku-1"))
+        with self.assertRaises(IntegrityError):
+            self.unsaved_rma(order_ref=" ORD-1", rma_number="RMA-00002").save()
+
+    def test_concurrent_duplicate_becomes_a_form_error(self):
+        make_rma(1)
+        form = mock.Mock()
+        form.save.return_value = self.unsaved_rma(email="Customer@Example.com")
+
+        self.assertIsNone(save_rma_request(form))
+
+        form.add_error.assert_called_once_with(None, RmaForm.DUPLICATE_ERROR)
+        self.assertEqual(RmaRequests.objects.count(), 1)
+        self.assertFalse(RmaOutbox.objects.exists())
+
+    def test_backfill_leaves_legacy_duplicates_null(self):
+        migration = importlib.import_module("rma.migrations.0009_rmarequests_fingerprint")
+        RmaRequests.objects.bulk_create(
+            [
+                self.unsaved_rma(rma_number="RMA-00001"),
+                self.unsaved_rma(rma_number="RMA-00002", email="CUSTOMER@example.com"),
+                self.unsaved_rma(rma_number="RMA-00003", order_ref="ORD-3"),
+            ]
+        )
+
+        migration.backfill_fingerprints(apps, None)
+
+        fingerprints = list(
+            RmaRequests.objects.order_by("rma_number").values_list("fingerprint", flat=True)
+        )
+        self.assertEqual(
+            fingerprints,
+            [
+                rma_fingerprint("customer@example.com", "ORD-1", "SKU-1"),
+                None,
+                rma_fingerprint("customer@example.com", "ORD-3", "SKU-1"),
+            ],
+        )
+
+
+class RmaOutboxRelayTests(FakeRedisTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.generation = mock.Mock()
+        self.instruction = mock.Mock()
+        patcher = mock.patch.dict(
+            tasks.OUTBOX_TASKS,
+            {
+                RmaOutbox.KIND_GENERATION: self.generation,
+                RmaOutbox.KIND_INSTRUCTION: self.instruction,
+            },
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(RMA_OUTBOX_BATCH_SIZE=2)
+    def test_relays_in_batches_and_deletes_the_rows(self):
+        rmas = [make_rma(number) for number in range(1, 6)]
+        tasks.queue_rma_notifications([rma.id for rma in rmas], RmaOutbox.KIND_GENERATION)
+
+        tasks.relay_rma_outbox()
+
+        self.assertEqual(
+            [call.args[0] for call in self.generation.delay.call_args_list],
+            [[rmas[0].id, rmas[1].id], [rmas[2].id, rmas[3].id], [rmas[4].id]],
+        )
+        self.instruction.delay.assert_not_called()
+        self.assertFalse(RmaOutbox.objects.exists())
+
+    @override_settings(RMA_OUTBOX_BATCH_SIZE=100)
+    def test_coalesces_one_task_per_kind_with_distinct_rmas(self):
+        first, second = make_rma(1), make_rma(2)
+        tasks.queue_rma_notifications([first.id, first.id], RmaOutbox.KIND_GENERATION)
+        tasks.queue_rma_notifications([second.id], RmaOutbox.KIND_GENERATION)
+        tasks.queue_rma_notifications([first.id], RmaOutbox.KIND_INSTRUCTION)
+
+        tasks.relay_rma_outbox()
+
+        self.generation.delay.assert_called_once_with([first.id, second.id])
+        self.instruction.delay.assert_called_once_with([first.id])
+
+    @override_settings(RMA_OUTBOX_BATCH_SIZE=100)
+    def test_rows_stay_when_publishing_fails(self):
+        rma = make_rma(1)
+        tasks.queue_rma_notifications([rma.id], RmaOutbox.KIND_GENERATION)
+        tasks.queue_rma_notifications([rma.id], RmaOutbox.KIND_INSTRUCTION)
+        self.instruction.delay.side_effect = ConnectionError("broker down")
+
+        with self.assertRaises(ConnectionError):
+            tasks.relay_rma_outbox()
+
+        self.assertEqual(RmaOutbox.objects.count(), 2)
+
+    def test_relay_is_kicked_once_per_burst_after_commit(self):
+        rma = make_rma(1)
+        with mock.patch.object(tasks.relay_rma_outbox, "apply_async") as apply_async:
+            with self.captureOnCommitCallbacks(execute=True):
+                tasks.queue_rma_notifications([rma.id], RmaOutbox.KIND_GENERATION)
+                tasks.queue_rma_notifications([rma.id], RmaOutbox.KIND_INSTRUCTION)
+                apply_async.assert_not_called()
+
+        apply_async.assert_called_once_with(countdown=1)
+
+
+class SendRmaInstructionsActionTests(FakeRedisTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.model_admin = RmaRequestsAdmin(RmaRequests, admin.site)
+        self.request = RequestFactory().post("/admin/rma/rmarequests/")
+        patcher = mock.patch.object(RmaRequestsAdmin, "message_user")
+        self.message_user = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_action(self, rmas):
+        queryset = RmaRequests.objects.filter(pk__in=[rma.pk for rma in rmas])
+        with self.captureOnCommitCallbacks():
+            self.model_admin.send_rma_instructions_action(self.request, queryset)
+
+    def test_marks_and_queues_only_unsent_rmas(self):
+        pending = make_rma(1)
+        sent = make_rma(2, status="rma_sent")
+
+        self.run_action([pending, sent])
+
+        pending.refresh_from_db()
+        self.assertEqual(pending.status, "rma_sent")
+        self.assertEqual(
+            list(RmaOutbox.objects.values_list("rma_id", "kind")),
+            [(pending.id, RmaOutbox.KIND_INSTRUCTION)],
+        )
+        self.assertIn("skipped 1 already sent", self.message_user.call_args.args[1])
+
+    def test_running_it_twice_queues_nothing_more(self):
+        rmas = [make_rma(1), make_rma(2)]
+
+        self.run_action(rmas)
+        self.run_action(rmas)
+
+        self.assertEqual(RmaOutbox.objects.count(), 2)
+
+
+@override_settings(
+    TASK_EMAIL_BACKEND="rma.tests.RefusingEmailBackend", RMA_INSTRUCTION_CHUNK_SIZE=2
+)
+class SendRmaInstructionsTests(FakeRedisTestMixin, TestCase):
+    def test_refused_recipient_does_not_stop_the_chunk(self):
+        first = make_rma(1, email="first@example.com", status="rma_sent")
+        refused = make_rma(2, email="refused@example.com", status="rma_sent")
+        last = make_rma(3, email="last@example.com", status="rma_sent")
+
+        tasks.send_rma_instructions([first.id, refused.id, last.id])
+
+        self.assertEqual(
+            sorted(message.to[0] for message in mail.outbox),
+            ["first@example.com", "last@example.com"],
+        )
+        # Refused for good: set back so staff can send it again
+        self.assertEqual(
+            dict(RmaRequests.objects.values_list("id", "status")),
+            {first.id: "rma_sent", refused.id: "pending", last.id: "rma_sent"},
+        )
+
+    def test_only_transient_failures_are_retried(self):
+        sent = make_rma(1, email="first@example.com", status="rma_sent")
+        busy = make_rma(2, email="busy@example.com", status="rma_sent")
+
+        with mock.patch.object(
+            tasks.send_rma_instructions, "retry", side_effect=Retry()
+        ) as retry:
+            with self.assertRaises(Retry):
+                tasks.send_rma_instructions([sent.id, busy.id])
+
+        self.assertEqual(retry.call_args.kwargs["args"], ([busy.id],))
+        self.assertEqual(len(mail.outbox), 1)
+        busy.refresh_from_db()
+        self.assertEqual(busy.status, "rma_sent")
+
+    def test_permanent_failures_are_reset_when_transient_ones_are_retried(self):
+        refused = make_rma(1, email="refused@example.com", status="rma_sent")
+        busy = make_rma(2, email="busy@example.com", status="rma_sent")
+
+        with mock.patch.object(
+            tasks.send_rma_instructions, "retry", side_effect=Retry()
+        ) as retry:
+            with self.assertRaises(Retry):
+                tasks.send_rma_instructions([refused.id, busy.id])
+
+        self.assertEqual(retry.call_args.kwargs["args"], ([busy.id],))
+        self.assertEqual(
+            dict(RmaRequests.objects.values_list("id", "status")),
+            {refused.id: "pending", busy.id: "rma_sent"},
+        )
+
+
+@override_settings(TASK_EMAIL_BACKEND="rma.tests.RefusingEmailBackend")
+class SendRmaGenerationEmailsTests(FakeRedisTestMixin, TestCase):
+    def test_permanent_failures_are_logged_when_transient_ones_are_retried(self):
+        refused = make_rma(1, email="refused@example.com")
+        busy = make_rma(2, email="busy@example.com")
+
+        with mock.patch.object(
+            tasks.send_rma_generation_emails, "retry", side_effect=Retry()
+        ) as retry:
+            with self.assertLogs("log", "ERROR") as logs, self.assertRaises(Retry):
+                tasks.send_rma_generation_emails([refused.id, busy.id])
+
+        self.assertEqual(retry.call_args.kwargs["args"], ([busy.id],))
+        self.assertIn(f"could not be delivered for RMAs [{refused.id}]", logs.output[0])
+
+
+class RmaSearchTests(TestCase):
+    def setUp(self):
+        self.model_admin = RmaRequestsAdmin(RmaRequests, admin.site)
+        self.request = RequestFactory().get("/admin/rma/rmarequests/")
+
+    def search(self, term):
+        queryset, _ = self.model_admin.get_search_results(
+            self.request, RmaRequests.objects.all(), term
+        )
+        return queryset
+
+    def test_short_words_and_stopwords_are_left_out_of_the_fulltext_query(self):
+        self.assertEqual(
+            split_fulltext_words("SO 123 the +box"), (["123", "box"], ["SO", "the"])
+        )
+        self.assertEqual(split_fulltext_words("a b"), ([], ["a", "b"]))
+
+    def test_unindexed_words_must_begin_a_field(self):
+        with mock.patch.object(rma_admin.connection, "vendor", "mysql"):
+            sql = str(self.search("SO 123").query)
+
+        self.assertIn("+123*", sql)
+        self.assertNotIn("+SO", sql)
+        self.assertIn("SO%", sql)
+
+    def test_only_unindexed_words_skip_the_fulltext_index(self):
+        make_rma(7)
+        with mock.patch.object(rma_admin.connection, "vendor", "mysql"):
+            queryset = self.search("ord-7 sk")
+
+        self.assertNotIn("MATCH", str(queryset.query))
+        self.assertEqual(list(queryset.values_list("rma_number", flat=True)), ["RMA-00007"])
+
+    def test_rma_number_is_looked_up_exactly(self):
+        make_rma(42)
+        make_rma(420)
+
+        self.assertEqual(
+            list(self.search("rma-42").values_list("rma_number", flat=True)), ["RMA-00042"]
+        )
+
+
+class ApproximateCountPaginatorTests(TestCase):
+    def paginator(self):
+        return ApproximateCountPaginator(
+            RmaRequests.objects.filter(status="pending").order_by("id"), 20
+        )
+
+    @mock.patch("rma.admin.APPROXIMATE_COUNT_THRESHOLD", 2)
+    def test_large_filtered_results_are_capped_and_qualified(self):
+        for number in range(1, 4):
+            make_rma(number)
+        paginator = self.paginator()
+
+        self.assertEqual(paginator.count, 2)
+        self.assertEqual(paginator.count_qualifier, "more than")
+
+    @mock.patch("rma.admin.APPROXIMATE_COUNT_THRESHOLD", 2)
+    def test_small_results_are_counted_exactly(self):
+        make_rma(1)
+        make_rma(2, status="rma_sent")
+        paginator = self.paginator()
+
+        self.assertEqual(paginator.count, 1)
+        self.assertEqual(paginator.count_qualifier, "")
+
+
+@override_settings(RMA_PAGE_CACHE_TIMEOUT=600, SITE_DATA_CHECK_INTERVAL=0)
+class RmaPageShellTests(FakeRedisTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        # includes/preload.html is generated by build_static_assets, which the
+        # tests do not run; an empty one stands in for it.
+        generated = tempfile.TemporaryDirectory()
+        self.addCleanup(generated.cleanup)
+        os.makedirs(os.path.join(generated.name, "includes"))
+        open(os.path.join(generated.name, "includes", "preload.html"), "w").close()
+        templates = [dict(settings.TEMPLATES[0])]
+        templates[0]["DIRS"] = [*templates[0]["DIRS"], generated.name]
+        storages = {
+            **settings.STORAGES,
+            "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+        }
+        test_settings = self.settings(TEMPLATES=templates, STORAGES=storages)
+        test_settings.enable()
+        self.addCleanup(test_settings.disable)
+
+        render = mock.patch.object(rma_views, "render", wraps=rma_views.render)
+        self.render = render.start()
+        self.addCleanup(render.stop)
+
+    def test_shell_is_rendered_once_without_the_form(self):
+        first = self.client.get("/")
+        second = self.client.get("/")
+
+        self.assertEqual(self.render.call_count, 1)
+        self.assertEqual(first.content, second.content)
+        self.assertContains(second, 'hx-get="/rma-form/"')
+        self.assertNotContains(second, "csrfmiddlewaretoken")
+
+    def test_query_strings_are_not_cached(self):
+        self.client.get("/?utm_source=mail")
+        self.client.get("/?utm_source=mail")
+
+        self.assertEqual(self.render.call_count, 2)
+
+    def test_site_meta_change_renders_a_new_shell(self):
+        self.client.get("/")
+        bump_site_data_version()
+        self.client.get("/")
+
+        self.assertEqual(self.render.call_count, 2)
+
+    def test_form_fragment_is_never_cached(self):
+        response = self.client.get("/rma-form/")
+
+        self.assertContains(response, "csrfmiddlewaretoken")
+        self.assertIn("no-cache", response["Cache-Control"])
+        self.assertEqual(response["X-Robots-Tag"], "noindex, nofollow")
@@ -1,27 +1,188 @@
 
+import os
 import random
 import string
+import threading
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.functions import Length
+from django_redis import get_redis_connection
 from rma.models import RmaRequests
 
+# Redis counter of the last RMA number handed out to any process.
+RMA_NUMBER_KEY = "rma_number_seq"
+
+# Raises the counter to at least ARGV[1], for a counter that is missing or behind the table.
+# KEYS = [counter], ARGV = [table max]
+RECONCILE_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if current < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+return redis.call('GET', KEYS[1])
+"""
+
+# Numbers reserved by this process, as {"pid", "next", "end"}. Keyed by pid so
+# forked workers never hand out their parent's block.
+_block = {"pid": None, "next": 0, "end": 0}
+_block_lock = threading.Lock()
+
+
+def parse_rma_number(rma_number):
+    """
+    Extracts the numeric part of an RMA number.
+
+    Args:
+        rma_number (str): An RMA number like `RMA-00042`.
+
+    Returns:
+        int: The number, e.g. 42.
+    """
+    return int(rma_number.split("-")[-1])
+
+
+def _table_max_rma_number():
+    """
+    Returns the highest RMA number stored in the table.
+
+    Numbers handed out in blocks are not ordered by id, so this looks at the
+    number itself (longest, then highest, as the padding is only 5 digits).
+
+    Returns:
+        int: The highest number, or 0 for an empty table.
+    """
+    last_number = (
+        RmaRequests.objects.exclude(rma_number="")
+        .order_by(Length("rma_number").desc(), "-rma_number")
+        .values_list("rma_number", flat=True)
+        .first()
+    )
+    return parse_rma_number(last_number) if last_number else 0
+
+
+def _reserve_block():
+    """
+    Reserves the next block of RMA numbers for this process.
+
+    The first reservation of a process reconciles the Redis counter with the
+    table, so a flushed or restored Redis never hands out numbers that exist.
+
+    Returns:
+        tuple: The first and last number of the block.
+    """
+    redis_conn = get_redis_connection("default")
+    key = cache.make_key(RMA_NUMBER_KEY)
+    if _block["pid"] != os.getpid():
+        redis_conn.eval(RECONCILE_SCRIPT, 1, key, _table_max_rma_number())
+
+    size = settings.RMA_NUMBER_BLOCK_SIZE
+    end = redis_conn.incrby(key, size)
+    return end - size + 1, end
+
 
 def generate_rma_number():
     """
     Generate a unique RMA number.
 
-    This function retrieves the last RMA request from the database, 
-    increments the numeric portion, and formats the new RMA number with 
-    a prefix.
+    Numbers come from a Redis counter shared by all processes. Each process
+    reserves `RMA_NUMBER_BLOCK_SIZE` numbers with one `INCRBY` and hands them
+    out from memory, so concurrent submissions never get the same number and
+    most submissions need no query at all. Numbers left in the block of a
+    process that exits are skipped, so RMA numbers may have gaps.
 
     Returns:
         str: The newly generated RMA number.
     """
-    last_rma = RmaRequests.objects.order_by('id').last()
-    if last_rma:
-        # Extract the numeric part from the previous RMA number.
-        last_number = int(last_rma.rma_number.split('-')[-1])
-        new_number = last_number + 1
-    else:
-        new_number = 1
-        
+    with _block_lock:
+        if _block["pid"] != os.getpid() or _block["next"] > _block["end"]:
+            start, end = _reserve_block()
+            _block.update({"pid": os.getpid(), "next": start, "end": end})
+        new_number = _block["next"]
+        _block["next"] += 1
+
     # Format the new RMA number with a prefix and zero padding.
-    return f'RMA-{new_number:05d}'
\ No newline at end of file
+    return f'RMA-{new_number:05d}'
+
+
+def discard_rma_number_block():
+    """
+    Drops the numbers left in this process's block.
+
+    Called when an insert hit an RMA number that already exists, e.g. when
+    Redis was flushed while this process still held an old block. The next
+    `generate_rma_number` reserves a new block and reconciles the counter
+    with the table first.
+    """
+    with _block_lock:
+        _block.update({"pid": None, "next": 0, "end": 0})
+
+
+class RmaSnapshot:
+    """
+    Immutable, read-only copy of the RMA fields used by the emails.
+
+    The email tasks load the snapshots of a whole batch with one `values_list`
+    query, and `SdMailService` renders every email of an RMA from its snapshot.
+    """
+
+    __slots__ = (
+        "id",
+        "rma_number",
+        "customer_name",
+        "email",
+        "phone",
+        "order_ref",
+        "product_sku",
+        "reason_for_return",
+        "rma_instructions",
+        "status",
+        "created_at",
+    )
+
+    def __init__(self, *values):
+        """
+        Initializes the RmaSnapshot instance.
+
+        Args:
+            *values: One value per field, in `__slots__` order.
+        """
+        if len(values) != len(self.__slots__):
+            raise TypeError(
+                f"RmaSnapshot takes {len(self.__slots__)} values, got {len(values)}"
+            )
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"RmaSnapshot is read-only, cannot set {name}")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"RmaSnapshot is read-only, cannot delete {name}")
+
+    def __repr__(self):
+        return f"RmaSnapshot({self.id}, {self.rma_number})"
+
+    @classmethod
+    def many_from_db(cls, rma_ids):
+        """
+        Reads the snapshots of several RMAs with one query.
+
+        Args:
+            rma_ids (list): IDs of the RMA requests.
+
+        Returns:
+            list: The snapshots of the RMAs that exist, ordered by id.
+        """
+        rows = (
+            RmaRequests.objects.filter(pk__in=rma_ids)
+            .order_by("pk")
+            .values_list(*cls.__slots__)
+        )
+        return [cls(*row) for row in rows]
+
+    def admin_instruction(self):
+        """
+        Returns:
+            str: The admin instructions, with `$rma_number` replaced by the RMA number.
+        """
+        return self.rma_instructions.replace("$rma_number", self.rma_number)
@@ -1,20 +1,128 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse
 from django.shortcuts import render
+from django.views.decorators.cache import never_cache
+from django.views.decorators.http import require_GET
 from common.context_processor import site_info
-from common.utils import SdMailService
 from rma.forms import RmaForm
-from rma.utils import generate_rma_number
-from django.core.cache import cache
+from rma.models import RmaOutbox, RmaRequests
+from rma.tasks import queue_rma_notifications
+from rma.utils import discard_rma_number_block, generate_rma_number
+
+
+# Inserts tried with a fresh RMA number when the number turns out to be taken.
+RMA_NUMBER_ATTEMPTS = 3
+
+# Rendered RMA page shell, per site data version and absolute URL.
+PAGE_SHELL_KEY = "rma_page_shell_{}_{}"
+
 
-EMAIL_SERVICE = SdMailService()
+def render_page_shell(request, context):
+    """
+    Renders the RMA page without the form, from the cache when possible.
+
+    The page is the same for every visitor once the form is left out; the
+    form, with its per-user CSRF token and reCAPTCHA widget, is loaded by htmx
+    from `rma_form_view`. A cache hit costs one Redis read. Requests with a
+    query string are never cached, and editing the site metadata changes the
+    key through its version.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+        context (dict): The page context, `site_data` included.
+
+    Returns:
+        HttpResponse: The rendered page shell.
+    """
+    timeout = settings.RMA_PAGE_CACHE_TIMEOUT
+    cacheable = bool(timeout) and not request.GET
+    key = PAGE_SHELL_KEY.format(
+        context["site_data"]["version"], request.build_absolute_uri()
+    )
+    if cacheable:
+        content = cache.get(key)
+        if content is not None:
+            return HttpResponse(content)
+
+    context["defer_form"] = True
+    response = render(request, "rma/rma_request.html", context=context)
+    if cacheable:
+        cache.set(key, response.content, timeout=timeout)
+    return response
+
+
+@never_cache
+@require_GET
+def rma_form_view(request):
+    """
+    Renders the RMA form fragment loaded by htmx into the cached page shell.
+
+    This response carries the per-user parts of the page (CSRF token and
+    cookie, reCAPTCHA widget), so it is never cached.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        HttpResponse: The rendered `rma/rma_form.html` fragment.
+    """
+    response = render(request, "rma/rma_form.html", context={"form": RmaForm()})
+    response["X-Robots-Tag"] = "noindex, nofollow"
+    return response
+
+
+def save_rma_request(form):
+    """
+    Saves a validated RMA form with a new RMA number.
+
+    The generation email is recorded in the outbox in the same transaction
+    as the insert, so it is sent if and only if the RMA is committed.
+
+    The form's duplicate check and the insert are not atomic; if a concurrent
+    submission of the same RMA is inserted in between, the unique fingerprint
+    index rejects this one and the form gets the duplicate error instead.
+
+    If the RMA number is already taken (after a Redis flush, another process
+    may still hand out numbers from an old block), the block of this process
+    is discarded and the insert is retried with a freshly reserved number.
+
+    Args:
+        form (RmaForm): A valid RMA form.
+
+    Returns:
+        RmaRequests: The saved RMA request, or None if it is a duplicate.
+    """
+    rma_request = form.save(commit=False)
+    for attempt in range(1, RMA_NUMBER_ATTEMPTS + 1):
+        rma_request.rma_number = generate_rma_number()
+        try:
+            with transaction.atomic():
+                rma_request.save()
+                queue_rma_notifications([rma_request.id], RmaOutbox.KIND_GENERATION)
+            return rma_request
+        except IntegrityError:
+            if RmaForm.is_duplicate(
+                rma_request.email, rma_request.order_ref, rma_request.product_sku
+            ):
+                form.add_error(None, RmaForm.DUPLICATE_ERROR)
+                return None
+            number_taken = RmaRequests.objects.filter(
+                rma_number=rma_request.rma_number
+            ).exists()
+            if not number_taken or attempt == RMA_NUMBER_ATTEMPTS:
+                raise
+            discard_rma_number_block()
 
 
 def rma_request_view(request):
     """
     Handle the RMA request form submission.
 
-    This view renders the RMA request form, validates submitted data,
-    generates an RMA number, and sends an email notification upon successful
-    form submission.
+    This view renders the RMA request page (see `render_page_shell`), validates
+    submitted data, generates an RMA number, and sends an email notification
+    upon successful form submission.
 
     Args:
         request (HttpRequest): The HTTP request object.
@@ -33,19 +141,8 @@ def rma_request_view(request):
 
     if request.method == "POST":
         post_form = RmaForm(request.POST)
-        if post_form.is_valid():
-
-            rma_request = post_form.save(commit=False)
-            rma_request.rma_number = generate_rma_number()
-            rma_request.save()
-
-            rma_id = rma_request.id
-
-            # To reduce database hit, it will delete inside send_rma_genaration_email function
-            cache.set(f"rma_{rma_id}", rma_request, timeout=900)
-
-            EMAIL_SERVICE.send_rma_genaration_email(rma_id)
-
+        rma_request = save_rma_request(post_form) if post_form.is_valid() else None
+        if rma_request is not None:
             context["rma_number"] = rma_request.rma_number
             response = render(
                 request, "rma/rma_form_block_with_success_message.html", context=context
@@ -58,6 +155,6 @@ def rma_request_view(request):
             response["X-Robots-Tag"] = "noindex, nofollow"
             return response
     else:
-        response = render(request, "rma/rma_request.html", context=context)
+        response = render_page_shell(request, context)
         response["X-Robots-Tag"] = "noindex, nofollow"
         return response